@@ -0,0 +1,228 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import threading
+import aiohttp
+from tqdm import tqdm
+
+# Asynchronous crawler for the berkeleyearth mirrors (data_crawler.py, berkley_data_combiner.ipynb).
+# All requests share one connection pool (aiohttp.ClientSession) and at most `concurrency` of them run at once.
+#  - Failed requests (connection errors, timeouts, 429 and 5xx) are retried with exponential backoff and jitter.
+#  - The ETag and Last-Modified header of every downloaded file are stored inside a state file (STATE_FILE in the
+#    download directory). With refresh=True the files are requested conditionally and only changed files are
+#    downloaded again (304 Not Modified). With refresh=False files which are already complete are skipped without
+#    any request.
+#  - Files are downloaded into "<file>.part" and renamed when complete, so a file never exists half-written. An
+#    interrupted download is resumed with a range request (if the server still has the same version of the file).
+# The synchronous wrappers (download_files, fetch_pages) also work if an event loop is already running (jupyter),
+# then the crawler gets its own loop inside a thread (no nest_asyncio needed).
+#
+# Usage:
+#   stats = download_files(urls, paths, concurrency=20, refresh=True)
+#   python data/async_crawler.py http://berkeleyearth.lbl.gov/auto/Local/TAVG/Text/ data/sources/berkley_local_summaries --suffix -TAVG-Trend.txt
+
+STATE_FILE = ".crawler_state.json"
+PART_SUFFIX = ".part"
+CHUNK_SIZE = 2**16
+RETRY_STATUS = {408, 429, 500, 502, 503, 504}
+
+results = ['downloaded', 'not_modified', 'skipped', 'failed']
+
+
+class RetryableError(Exception):
+    pass
+
+
+# State (ETag, Last-Modified and size of every downloaded file) of one download directory
+class CrawlerState:
+    def __init__(self, directory):
+        self.path = os.path.join(directory, STATE_FILE)
+        self.entries = {}
+        if os.path.isfile(self.path):
+            with open(self.path) as file:
+                self.entries = json.load(file)
+
+    # A file is complete if it exists with the size it had when it was downloaded
+    def is_complete(self, path):
+        entry = self.entries.get(os.path.basename(path))
+        return entry is not None and os.path.isfile(path) and os.path.getsize(path) == entry['size']
+
+    def save(self):
+        with open(self.path + ".tmp", "w") as file:
+            json.dump(self.entries, file)
+        os.replace(self.path + ".tmp", self.path)
+
+
+async def _with_retries(coroutine_function, retries, backoff):
+    for attempt in range(retries + 1):
+        try:
+            return await coroutine_function()
+        except (aiohttp.ClientError, asyncio.TimeoutError, RetryableError):
+            if attempt == retries:
+                raise
+            await asyncio.sleep(backoff * 2**attempt * (1 + random.random()))
+
+async def _fetch_page(session, semaphore, url, retries, backoff):
+    async def request():
+        async with semaphore, session.get(url) as resp:
+            if resp.status in RETRY_STATUS:
+                raise RetryableError(f"Status {resp.status}")
+            if resp.status != 200:
+                return None
+            return await resp.text()
+    try:
+        return await _with_retries(request, retries, backoff)
+    except (aiohttp.ClientError, asyncio.TimeoutError, RetryableError):
+        return None
+
+async def _download_file(session, semaphore, state, url, path, refresh, retries, backoff):
+    name = os.path.basename(path)
+    entry = state.entries.get(name)
+    complete = state.is_complete(path)
+    if complete and not refresh:
+        return 'skipped'
+
+    async def request():
+        headers = {}
+        if complete:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        # Resume an interrupted download (also one of a previous attempt)
+        part_path = path + PART_SUFFIX
+        part_size = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+        partial = state.entries.get(name)
+        if part_size > 0 and partial is not None and partial.get('partial') and (partial.get('etag') or partial.get('last_modified')):
+            headers['Range'] = f"bytes={part_size}-"
+            headers['If-Range'] = partial.get('etag') or partial['last_modified']
+
+        async with semaphore, session.get(url, headers=headers) as resp:
+            if resp.status == 304:
+                return 'not_modified'
+            if resp.status in RETRY_STATUS:
+                raise RetryableError(f"Status {resp.status}")
+            if resp.status not in (200, 206):
+                return 'failed'
+            # Store the validators first, so an interrupted download can be resumed with them
+            state.entries[name] = {'etag': resp.headers.get('ETag'), 'last_modified': resp.headers.get('Last-Modified'), 'size': None, 'partial': True}
+            with open(part_path, "ab" if resp.status == 206 else "wb") as file:
+                async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                    file.write(chunk)
+        os.replace(part_path, path)
+        state.entries[name]['size'] = os.path.getsize(path)
+        state.entries[name]['partial'] = False
+        return 'downloaded'
+
+    try:
+        return await _with_retries(request, retries, backoff)
+    except (aiohttp.ClientError, asyncio.TimeoutError, RetryableError):
+        return 'failed'
+
+
+def _session(concurrency, timeout):
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=concurrency),
+        timeout=aiohttp.ClientTimeout(total=None, sock_connect=timeout, sock_read=timeout)
+    )
+
+# Returns the text of every url (None if it couldn't be fetched) in the order of the urls
+async def fetch_pages_async(urls, concurrency = 20, retries = 4, backoff = 0.5, timeout = 60, desc = "Fetching pages"):
+    semaphore = asyncio.Semaphore(concurrency)
+    async with _session(concurrency, timeout) as session:
+        pbar = tqdm(total=len(urls), desc=desc)
+        async def fetch(url):
+            text = await _fetch_page(session, semaphore, url, retries, backoff)
+            pbar.update(1)
+            return text
+        try:
+            return await asyncio.gather(*[fetch(url) for url in urls])
+        finally:
+            pbar.close()
+
+# Downloads the urls into the paths (all paths have to be inside the same directory).
+# Returns the amount of files per result (see results) and the list of urls which failed.
+async def download_files_async(urls, paths, concurrency = 20, refresh = False, retries = 4, backoff = 0.5, timeout = 60, save_every = 500):
+    if len(urls) != len(paths):
+        raise Exception(f"Amount of urls ({len(urls)}) and paths ({len(paths)}) differ")
+    if len(paths) == 0:
+        return {result: 0 for result in results}, []
+    directories = {os.path.dirname(os.path.abspath(path)) for path in paths}
+    if len(directories) != 1:
+        raise Exception(f"All paths have to be inside the same directory ({len(directories)} given)")
+    directory = directories.pop()
+    os.makedirs(directory, exist_ok=True)
+
+    state = CrawlerState(directory)
+    semaphore = asyncio.Semaphore(concurrency)
+    stats = {result: 0 for result in results}
+    failed = []
+    async with _session(concurrency, timeout) as session:
+        pbar = tqdm(total=len(urls), desc="Downloading files")
+        async def download(url, path):
+            result = await _download_file(session, semaphore, state, url, path, refresh, retries, backoff)
+            stats[result] += 1
+            if result == 'failed':
+                failed.append(url)
+            pbar.update(1)
+            pbar.set_postfix(stats, refresh=False)
+            if result == 'downloaded' and stats['downloaded'] % save_every == 0:
+                state.save()
+        try:
+            await asyncio.gather(*[download(url, path) for url, path in zip(urls, paths)])
+        finally:
+            pbar.close()
+            state.save()
+    return stats, failed
+
+
+# Runs the coroutine to completion, inside a thread with its own event loop if there is already a running one
+def _run(coroutine):
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    result = {}
+    def target():
+        try:
+            result['value'] = asyncio.run(coroutine)
+        except BaseException as e:
+            result['error'] = e
+    thread = threading.Thread(target=target)
+    thread.start()
+    thread.join()
+    if 'error' in result:
+        raise result['error']
+    return result['value']
+
+def fetch_pages(urls, **kwargs):
+    return _run(fetch_pages_async(urls, **kwargs))
+
+def download_files(urls, paths, **kwargs):
+    return _run(download_files_async(urls, paths, **kwargs))
+
+
+if __name__ == '__main__':
+    from lxml import etree
+
+    parser = argparse.ArgumentParser(description="Mirrors all files of a directory listing into a local directory")
+    parser.add_argument("url", help="Url of the directory listing (e.g. http://berkeleyearth.lbl.gov/auto/Local/TAVG/Text/)")
+    parser.add_argument("directory", help="Local download directory")
+    parser.add_argument("--suffix", default=".txt", help="Only download files ending with this suffix")
+    parser.add_argument("--concurrency", type=int, default=20, help="Maximum amount of parallel requests")
+    parser.add_argument("--retries", type=int, default=4, help="Retries per request")
+    parser.add_argument("--refresh", action="store_true", help="Check already downloaded files for changes (conditional requests)")
+    args = parser.parse_args()
+
+    listing = fetch_pages([args.url], concurrency=1, retries=args.retries, desc="Fetching listing")[0]
+    if listing is None:
+        raise Exception(f"Couldn't download the listing {args.url}")
+    filenames = [href.rsplit('/', 1)[-1] for href in etree.HTML(listing).xpath("//a/@href") if href.endswith(args.suffix)]
+    url = args.url if args.url.endswith("/") else args.url + "/"
+    stats, failed = download_files([url + name for name in filenames], [os.path.join(args.directory, name) for name in filenames],
+                                   concurrency=args.concurrency, refresh=args.refresh, retries=args.retries)
+    print(f" -> {stats}")
+    for url in failed:
+        print(f"Couldn't download file {url}")
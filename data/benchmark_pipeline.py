@@ -0,0 +1,310 @@
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from parquet_store import create_store, write_store
+
+# Offline benchmark of the data pipeline on synthetic climate datasets.
+# For every scale (amount of rows) a dataset is generated and every stage runs in a fresh process, so that the
+# peak resident memory (peak RSS) of a stage isn't hidden by the ones before:
+#  - combine:             data_combiner.combinePositions on synthetic Berkeley local summaries (-TAVG-Trend/-Counts)
+#  - interpolate:         interpolate_data.main on the dataset with NaN temperatures
+#  - interpolate_sharded: interpolate_data.main_sharded
+#  - compress:            compress.compress_dataset on the parquet store of the dataset
+#  - compress_stream:     compress_stream.compress_dataset_streaming on the same store
+# The synthetic dataset has `locations` locations with one contiguous range of months each (Kaggle like city names,
+# positions with 2 decimals). gap_rate drops months (gaps inside the series), nan_rate sets temperatures to NaN (filled
+# by the interpolation) and duplicate_rate adds a second record for the same location and month (merged by compress).
+# Each result is appended as json line (stage, scale, seconds, peak RSS, commit, ...) to the output file, so runs of
+# different commits can be compared with --compare.
+#
+# Usage:
+#   python data/benchmark_pipeline.py --rows 10000 1000000 --output benchmark.jsonl
+#   python data/benchmark_pipeline.py --rows 1000000 --stages compress --compare benchmark.jsonl
+
+stage_names = ['combine', 'interpolate', 'interpolate_sharded', 'compress', 'compress_stream']
+input_formats = ['parquet', 'csv']
+
+FIRST_YEAR = 1750
+LAST_YEAR = 2020
+CHUNK_ROWS = 2000000
+RESULT_KEYS = ['stage', 'rows', 'locations', 'gap_rate', 'nan_rate', 'duplicate_rate', 'input_format', 'workers']
+
+
+def _format_position(values, positive, negative):
+    return np.char.add(np.char.mod("%.2f", np.abs(values)), np.where(values < 0, negative, positive))
+
+# Generates the dataset chunk by chunk (every chunk contains whole locations). Yields frames in the layout of the
+# Kaggle csv (dt, AverageTemperature, AverageTemperatureUncertainty, City, Country, Latitude, Longitude) plus Year/Month
+def generate_chunks(rows, locations, gap_rate = 0.05, nan_rate = 0.02, duplicate_rate = 0.01, seed = 0, chunk_rows = CHUNK_ROWS):
+    count_months = (LAST_YEAR - FIRST_YEAR + 1) * 12
+    months_per_location = int(np.ceil(rows / (locations * (1 - gap_rate) * (1 + duplicate_rate))))
+    if months_per_location > count_months:
+        raise Exception(f"{rows} rows need at least {int(np.ceil(rows / count_months))} locations ({locations} given)")
+    rng = np.random.default_rng(seed)
+    lat = np.round(rng.uniform(-60, 75, locations), 2)
+    long = np.round(rng.uniform(-180, 180, locations), 2)
+    cities = np.char.add("City ", (np.arange(locations) % max(locations // 2, 1)).astype(str))  # some cities share a name
+    countries = np.char.add("Country ", (np.arange(locations) % 200).astype(str))
+    climate = 25 - np.abs(lat) * 0.4
+    first_months = rng.integers(0, count_months - months_per_location + 1, locations)
+
+    locations_per_chunk = max(chunk_rows // months_per_location, 1)
+    for first_location in range(0, locations, locations_per_chunk):
+        ids = np.arange(first_location, min(first_location + locations_per_chunk, locations))
+        loc = np.repeat(ids, months_per_location)
+        month = np.tile(np.arange(months_per_location), len(ids)) + first_months[loc]
+        keep = rng.random(len(loc)) >= gap_rate
+        loc, month = loc[keep], month[keep]
+        duplicates = rng.random(len(loc)) < duplicate_rate
+        order = np.argsort(np.concatenate([np.arange(len(loc)), np.flatnonzero(duplicates)]), kind='stable')
+        loc, month = np.concatenate([loc, loc[duplicates]])[order], np.concatenate([month, month[duplicates]])[order]
+        season = 10 * np.sin(2 * np.pi * ((month % 12) - 3) / 12) * np.sign(lat[loc])
+        temperature = climate[loc] + season + 0.01 * (month / 12) + rng.normal(0, 1.5, len(loc))
+        temperature[rng.random(len(loc)) < nan_rate] = np.nan
+        years, months = FIRST_YEAR + month // 12, month % 12 + 1
+        yield pd.DataFrame({
+            'dt': np.char.add(np.char.add(years.astype(str), np.char.add("-", np.char.zfill(months.astype(str), 2))), "-01"),
+            'AverageTemperature': temperature,
+            'AverageTemperatureUncertainty': rng.uniform(0.05, 2.0, len(loc)),
+            'City': cities[loc],
+            'Country': countries[loc],
+            'Latitude': _format_position(lat[loc], "N", "S"),
+            'Longitude': _format_position(long[loc], "E", "W"),
+            'Year': years,
+            'Month': months
+        })
+
+# Writes the dataset as parquet store (and csv if needed). Returns the amount of rows
+def generate_dataset(store_path, csv_path = None, **kwargs):
+    create_store(store_path)
+    count_rows = 0
+    for part, df in enumerate(generate_chunks(**kwargs)):
+        write_store(df, store_path, part=part)
+        if csv_path is not None:
+            df.drop(columns=['Year', 'Month']).to_csv(csv_path, index=False, mode='w' if part == 0 else 'a', header=(part == 0))
+        count_rows += len(df)
+    return count_rows
+
+# Writes synthetic Berkeley local summaries (one -TAVG-Trend.txt and -TAVG-Counts.txt per location)
+def generate_local_summaries(directory, rows, locations, seed = 0, **kwargs):
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    for df in generate_chunks(rows, locations, seed=seed, **kwargs):
+        df = df.drop_duplicates(['Latitude', 'Longitude', 'Year', 'Month'])
+        for (lat, long), df_location in df.groupby(['Latitude', 'Longitude'], sort=False):
+            name = f"{lat}-{long}"
+            monthly = df_location.groupby('Month')['AverageTemperature'].mean().reindex(range(1, 13)).fillna(0.0).to_numpy()
+            anomaly = (df_location['AverageTemperature'] - monthly[df_location['Month'].to_numpy() - 1]).fillna(0.0).to_numpy()
+            with open(f"{directory}/{name}-TAVG-Trend.txt", "w") as file:
+                file.write(f"% Berkeley Earth (synthetic)\n% Country: {df_location['Country'].iloc[0]}\n% Nearby Cities: {df_location['City'].iloc[0]}\n%\n")
+                file.write("% Estimated Jan 1951-Dec 1980 monthly absolute temperature (C):\n%      Jan    Feb    Mar    Apr    May    Jun    Jul    Aug    Sep    Oct    Nov    Dec\n")
+                file.write("%%  " + "  ".join(f"{value:.2f}" for value in monthly) + "  %%\n%\n")
+                # Monthly anomaly and uncertainty, the annual/five-/ten-/twenty-year columns are NaN
+                data = np.column_stack([df_location['Year'], df_location['Month'], anomaly, df_location['AverageTemperatureUncertainty']] + [np.full(len(anomaly), np.nan)] * 8)
+                np.savetxt(file, data, fmt=["%d", "%d"] + ["%.3f"] * 10, delimiter="  ")
+            counts = rng.integers(0, 4, len(df_location))
+            with open(f"{directory}/{name}-TAVG-Counts.txt", "w") as file:
+                file.write("% Station counts (synthetic)\n")
+                np.savetxt(file, np.column_stack([df_location['Year'], df_location['Month'], np.zeros(len(counts), dtype=int)] + [counts] * 6), fmt="%d", delimiter="  ")
+
+
+def _stage_combine(config):
+    import data_combiner
+    positions = data_combiner.getPositionsFromDirectory(config['summaries'])
+    return len(data_combiner.combinePositions(positions, workers=config['workers'], local_file_path=config['summaries']))
+
+def _stage_interpolate(config):
+    import interpolate_data
+    interpolate_data.input_filepath = config['interpolation_input']
+    interpolate_data.main(output_format="parquet")
+
+def _stage_interpolate_sharded(config):
+    import interpolate_data
+    interpolate_data.input_filepath = config['interpolation_input']
+    interpolate_data.main_sharded(workers=config['workers'], output_format="parquet")
+
+def _stage_compress(config):
+    import compress
+    compress.compress_dataset(config['store'], config['output'], filename="benchmark.cce", compression=config['compression'], workers=config['workers'])
+
+def _stage_compress_stream(config):
+    import compress_stream
+    compress_stream.compress_dataset_streaming(config['store'], config['output'], filename="benchmark_stream.cce", compression="lzma" if config['compression'] != "none" else "none")
+
+stages = {
+    'combine': _stage_combine,
+    'interpolate': _stage_interpolate,
+    'interpolate_sharded': _stage_interpolate_sharded,
+    'compress': _stage_compress,
+    'compress_stream': _stage_compress_stream
+}
+
+
+# Peak resident memory of this process and of its (finished) child processes in MB. On linux VmHWM is used for the
+# process itself, since ru_maxrss keeps the peak of the parent from before the exec of the spawned process.
+def _peak_rss():
+    try:
+        import resource
+    except ImportError:
+        # windows
+        import psutil
+        return psutil.Process().memory_info().peak_wset / 1e6, float('nan')
+    scale = 1 if sys.platform == "darwin" else 1024  # bytes on macOS, kilobytes on linux
+    peak, peak_children = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 1e6, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale / 1e6
+    if os.path.isfile("/proc/self/status"):
+        with open("/proc/self/status") as file:
+            peak = next((int(line.split()[1]) * 1024 / 1e6 for line in file if line.startswith("VmHWM:")), peak)
+    return peak, peak_children
+
+def _run_stage(name, config, queue, verbose):
+    if not verbose:
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 1)
+        os.dup2(devnull, 2)
+    try:
+        start = time.perf_counter()
+        stages[name](config)
+        seconds = time.perf_counter() - start
+        peak_rss, peak_rss_children = _peak_rss()
+        queue.put({'status': "ok", 'seconds': seconds, 'peak_rss_mb': peak_rss, 'peak_rss_children_mb': peak_rss_children})
+    except Exception as e:
+        queue.put({'status': f"error: {e!r}", 'seconds': float('nan'), 'peak_rss_mb': float('nan'), 'peak_rss_children_mb': float('nan')})
+
+# Runs the stage inside a new process (spawn: only the modules of the stage get imported)
+def run_stage(name, config, verbose = False):
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=_run_stage, args=(name, config, queue, verbose))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        return {'status': f"crashed (exit code {process.exitcode})", 'seconds': float('nan'), 'peak_rss_mb': float('nan'), 'peak_rss_children_mb': float('nan')}
+    return queue.get()
+
+
+def _commit():
+    try:
+        directory = os.path.dirname(os.path.abspath(__file__))
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=directory, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=directory, capture_output=True, text=True, check=True).stdout.strip()
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+# Generates the dataset of every scale and runs the stages. Returns the results as frame (and appends them to output)
+def benchmark_pipeline(
+        scales,                 # amounts of rows
+        stage_list = stage_names,
+        locations = None,       # amount of locations (None = one location per 1200 rows, i.e. ~100 years)
+        gap_rate = 0.05,
+        nan_rate = 0.02,
+        duplicate_rate = 0.01,
+        input_format = "parquet",   # input of the interpolation ("parquet" store or "csv" file)
+        compression = "none",
+        workers = None,
+        work_dir = None,        # directory for the datasets and outputs (None = temporary directory)
+        output = None,          # json lines file the results get appended to
+        seed = 0,
+        verbose = False
+):
+    if not set(stage_list).issubset(stage_names):
+        raise Exception(f"Unsupported stages ({', '.join(set(stage_list) - set(stage_names))})")
+    if not input_format in input_formats:
+        raise Exception(f"Unsupported input format ({input_format})")
+    temporary = work_dir is None
+    work_dir = tempfile.mkdtemp(prefix="cce_benchmark_") if temporary else work_dir
+    commit = _commit()
+    results = []
+    try:
+        for rows in scales:
+            count_locations = locations or max(rows // 1200, 1)
+            parameters = {'rows': rows, 'locations': count_locations, 'gap_rate': gap_rate, 'nan_rate': nan_rate, 'duplicate_rate': duplicate_rate, 'seed': seed}
+            scale_dir = os.path.join(work_dir, f"r{rows}_l{count_locations}")
+            os.makedirs(os.path.join(scale_dir, "output"), exist_ok=True)
+            config = {
+                'store': os.path.join(scale_dir, "dataset"),
+                'summaries': os.path.join(scale_dir, "local_summaries"),
+                'output': os.path.join(scale_dir, "output"),
+                'compression': compression,
+                'workers': workers
+            }
+            config['interpolation_input'] = config['store'] if input_format == "parquet" else os.path.join(scale_dir, "dataset.csv")
+
+            print(f"Generating {rows} rows ({count_locations} locations)...", end="", flush=True)
+            start = time.perf_counter()
+            count_rows = generate_dataset(config['store'], config['interpolation_input'] if input_format == "csv" else None, **parameters)
+            if "combine" in stage_list:
+                generate_local_summaries(config['summaries'], **parameters)
+            print(f" {time.perf_counter() - start:.2f}s ({count_rows} rows)")
+
+            for stage in stage_list:
+                print(f" -> {stage}...", end="", flush=True)
+                result = run_stage(stage, config, verbose)
+                print(f" {result['seconds']:.2f}s, peak RSS {result['peak_rss_mb']:.0f} MB ({result['status']})")
+                results.append({
+                    'stage': stage, 'rows': rows, 'locations': count_locations, 'gap_rate': gap_rate, 'nan_rate': nan_rate,
+                    'duplicate_rate': duplicate_rate, 'input_format': input_format, 'workers': workers or os.cpu_count(),
+                    **result,
+                    'commit': commit, 'date': datetime.datetime.now().isoformat(timespec="seconds"),
+                    'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count()
+                })
+                if output is not None:
+                    with open(output, "a") as file:
+                        file.write(json.dumps(results[-1]) + "\n")
+            if temporary:
+                shutil.rmtree(scale_dir)
+    finally:
+        if temporary:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return pd.DataFrame(results)
+
+
+def read_results(path):
+    with open(path) as file:
+        return pd.DataFrame([json.loads(line) for line in file if line.strip()])
+
+# Joins the results with the latest baseline result of the same stage and scale (ratio > 1 = slower/more memory)
+def compare_results(df_results, df_baseline):
+    df_baseline = df_baseline.drop_duplicates(RESULT_KEYS, keep='last')[RESULT_KEYS + ['seconds', 'peak_rss_mb', 'commit']]
+    df = df_results[RESULT_KEYS + ['seconds', 'peak_rss_mb', 'commit']].merge(df_baseline, on=RESULT_KEYS, how='left', suffixes=("", "_baseline"))
+    df['time ratio'] = df['seconds'] / df['seconds_baseline']
+    df['memory ratio'] = df['peak_rss_mb'] / df['peak_rss_mb_baseline']
+    return df[['stage', 'rows', 'locations', 'commit_baseline', 'seconds_baseline', 'seconds', 'time ratio', 'peak_rss_mb_baseline', 'peak_rss_mb', 'memory ratio']]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks the data pipeline stages on synthetic datasets (offline)")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 100000, 1000000], help="Scales (amount of rows) to benchmark")
+    parser.add_argument("--locations", type=int, default=None, help="Amount of locations (default: one per 1200 rows)")
+    parser.add_argument("--gap-rate", type=float, default=0.05, help="Fraction of missing months inside the series")
+    parser.add_argument("--nan-rate", type=float, default=0.02, help="Fraction of NaN temperatures")
+    parser.add_argument("--duplicate-rate", type=float, default=0.01, help="Fraction of records with a duplicate (same location and month)")
+    parser.add_argument("--stages", nargs="+", choices=stage_names, default=stage_names, help="Stages to benchmark")
+    parser.add_argument("--input-format", choices=input_formats, default="parquet", help="Input of the interpolation stages")
+    parser.add_argument("--compression", default="none", help="Compression of the compress stage (see cce_codecs.py)")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes of the stages (default: cpu count)")
+    parser.add_argument("--work-dir", default=None, help="Keep the datasets and outputs inside this directory (default: temporary directory)")
+    parser.add_argument("--output", default="benchmark_results.jsonl", help="Json lines file the results get appended to")
+    parser.add_argument("--compare", default=None, help="Json lines file of a previous run to compare with")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true", help="Show the output of the stages")
+    args = parser.parse_args()
+
+    df_baseline = read_results(args.compare) if args.compare else None
+    df_results = benchmark_pipeline(args.rows, args.stages, args.locations, args.gap_rate, args.nan_rate, args.duplicate_rate,
+                                    args.input_format, args.compression, args.workers, args.work_dir, args.output, args.seed, args.verbose)
+    with pd.option_context('display.max_rows', 500, 'display.width', 200):
+        if df_baseline is not None:
+            print(compare_results(df_results, df_baseline).to_string(index=False, float_format=lambda x: f"{x:.3f}"))
+        else:
+            print(df_results[['stage', 'rows', 'locations', 'seconds', 'peak_rss_mb', 'peak_rss_children_mb', 'status']].to_string(index=False, float_format=lambda x: f"{x:.3f}"))
@@ -0,0 +1,77 @@
+import numpy as np
+from cce_format import PREFIX_SUM_DTYPE, AGGREGATE_YEAR_INDEX_DTYPE, AGGREGATE_DTYPE, file_flags, pack_section
+
+# Precomputed temporal aggregates of the (undiscretized) temperatures, so that the mean of a location over
+# a time range doesn't require a scan over all its months (like comp_aggregate.wgsl does on every interaction).
+# All tables are cumulative with a leading zero entry, a sum/count over a range is the difference of two entries.
+#  - prefix:  APFX, prefix sum over all temperatures in file order. The temperatures of a location inside a
+#             month range are contiguous, the count is the difference of the temperature indices.
+#  - yearly:  AYRS, cumulative sum/count per location and year. Every location has one row per year from its
+#             first to its last year (AYIX contains the first year and first row of every location).
+#  - monthly: AMON, like AYRS but with one column per calendar month (the monthComparison mode of the viewer).
+#
+# The sums are built out of the undiscretized values, so they match a scan over the file (see CCEReader.aggregate).
+
+aggregate_types = ['prefix', 'yearly', 'monthly']
+
+
+# Combines the names of the aggregates to the respective file_flags
+def aggregate_flags(aggregates):
+    flags = 0
+    for name in aggregates:
+        if not name in aggregate_types:
+            raise Exception(f"Unknown aggregate ({name})")
+        flags |= file_flags['aggregate_' + name]
+    return flags
+
+
+# Cumulative sums/counts along the first axis with a leading zero entry
+def _cumulative(sums, counts):
+    table = np.zeros((len(sums) + 1,) + sums.shape[1:], dtype=AGGREGATE_DTYPE)
+    table['sum'][1:] = np.cumsum(sums, axis=0)
+    table['count'][1:] = np.cumsum(counts, axis=0)
+    return table
+
+
+# Builds the sections of the given aggregates. temperatures are the undiscretized values in file order,
+# years/months (1-12) their date and location_starts the first temperature of every location.
+def build_aggregate_sections(temperatures, years, months, location_starts, aggregates):
+    temperatures = np.asarray(temperatures, dtype=np.float64)
+    sections = []
+    if 'prefix' in aggregates:
+        prefix = np.zeros(len(temperatures) + 1, dtype=PREFIX_SUM_DTYPE)
+        prefix[1:] = np.cumsum(temperatures)
+        sections.append(pack_section('APFX', prefix.tobytes()))
+    if not {'yearly', 'monthly'} & set(aggregates):
+        return sections
+
+    years = np.asarray(years, dtype=np.int64)
+    location_sizes = np.diff(np.r_[location_starts, len(temperatures)])
+    first_years = years[location_starts]
+    spans = years[np.asarray(location_starts) + location_sizes - 1] - first_years + 1
+    index = np.empty(len(location_starts), dtype=AGGREGATE_YEAR_INDEX_DTYPE)
+    index['first_year'] = first_years
+    index['id_row_min'] = np.r_[0, np.cumsum(spans)[:-1]]
+    sections.append(pack_section('AYIX', index.tobytes()))
+    count_rows = spans.sum().item()
+    rows = np.repeat(index['id_row_min'].astype(np.int64) - first_years, location_sizes) + years
+    if 'yearly' in aggregates:
+        sums = np.bincount(rows, weights=temperatures, minlength=count_rows)
+        counts = np.bincount(rows, minlength=count_rows)
+        sections.append(pack_section('AYRS', _cumulative(sums, counts).tobytes()))
+    if 'monthly' in aggregates:
+        cells = rows * 12 + np.asarray(months, dtype=np.int64) - 1
+        sums = np.bincount(cells, weights=temperatures, minlength=count_rows * 12).reshape(-1, 12)
+        counts = np.bincount(cells, minlength=count_rows * 12).reshape(-1, 12)
+        sections.append(pack_section('AMON', _cumulative(sums, counts).tobytes()))
+    return sections
+
+
+# Year rows [row_first, row_last) of every location covering the years [first_year, last_year]
+def year_rows(year_index, count_rows, first_year, last_year):
+    location_first_years = year_index['first_year'].astype(np.int64)
+    id_row_min = year_index['id_row_min'].astype(np.int64)
+    id_row_max = np.r_[id_row_min[1:], count_rows]
+    row_first = np.clip(id_row_min + first_year - location_first_years, id_row_min, id_row_max)
+    row_last = np.clip(id_row_min + last_year - location_first_years + 1, row_first, id_row_max)
+    return row_first, row_last
@@ -0,0 +1,241 @@
+import lzma
+import itertools
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from tqdm import tqdm
+from cce_format import DEFAULT_BLOCK_SIZE, DICTIONARY_SIZE_DTYPE, compression_methods, pack_block_index, unpack_block_index
+
+# lz4 and zstandard are optional, they are only required when the respective codec gets used
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Registry of the compression methods for the TEMPERATURES|CTILBS|LOCATIONS payload of a CCE file.
+# Whole-payload codecs compress everything as one stream. Block-wise codecs split the payload into
+# blocks of block_size bytes which are compressed independently (in parallel) and are preceded by a
+# BLOCK INDEX (and optionally a trained DICTIONARY), see the file layout in compress.py.
+#
+# Benchmark of all codecs/presets on the payload of an existing file:
+#   python data/cce_codecs.py data/sources/t15M_c498k_l40k_2b_none.cce --block-size 1048576
+
+DEFAULT_DICTIONARY_SIZE = 112640 # zstd default (110 KiB)
+
+
+### Codec implementations. Have to be module level functions, so that they can be sent to worker processes
+def _none_compress(data, preset, dictionary = None):
+    return bytes(data)
+
+def _none_decompress(data, dictionary = None):
+    return bytes(data)
+
+# NOTE: LZMA2 and XZ not supported by JS Implementation. Also different dict_size than standard (64MByte) not supported.
+def lzma_compress(data, preset, dictionary = None):
+    return lzma.compress(data, format=lzma.FORMAT_ALONE, filters=[{"id": lzma.FILTER_LZMA1, "preset": preset}])
+
+def lzma_decompress(data, dictionary = None):
+    return lzma.decompress(data, format=lzma.FORMAT_ALONE)
+
+def _require(module, name, package):
+    if module is None:
+        raise Exception(f"Compression '{name}' requires the package {package} (pip install {package})")
+
+def lz4_compress(data, preset, dictionary = None):
+    _require(lz4, "lz4", "lz4")
+    return lz4.frame.compress(data, compression_level=preset)
+
+def lz4_decompress(data, dictionary = None):
+    _require(lz4, "lz4", "lz4")
+    return lz4.frame.decompress(data)
+
+def zstd_compress(data, preset, dictionary = None):
+    _require(zstandard, "zstd", "zstandard")
+    dict_data = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+    return zstandard.ZstdCompressor(level=preset, dict_data=dict_data).compress(data)
+
+def zstd_decompress(data, dictionary = None):
+    _require(zstandard, "zstd", "zstandard")
+    dict_data = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+    return zstandard.ZstdDecompressor(dict_data=dict_data).decompress(data)
+
+
+class Codec:
+    def __init__(self, name, compress, decompress, presets, blockwise = False, dictionary = False):
+        self.name = name
+        self.id = compression_methods[name]
+        self.compress = compress        # (data, preset, dictionary) -> bytes
+        self.decompress = decompress    # (data, dictionary) -> bytes
+        self.presets = list(presets)    # presets/levels worth benchmarking
+        self.blockwise = blockwise
+        self.dictionary = dictionary    # does the codec support a trained dictionary?
+
+codecs = {codec.name: codec for codec in [
+    Codec('none', _none_compress, _none_decompress, [0]),
+    Codec('lzma', lzma_compress, lzma_decompress, range(10)),
+    Codec('lzma_blocks', lzma_compress, lzma_decompress, range(10), blockwise=True),
+    Codec('lz4', lz4_compress, lz4_decompress, [0, 3, 6, 9, 12, 16]),
+    Codec('zstd', zstd_compress, zstd_decompress, [1, 3, 6, 9, 12, 15, 19, 22]),
+    Codec('zstd_blocks', zstd_compress, zstd_decompress, [1, 3, 6, 9, 12, 15, 19, 22], blockwise=True, dictionary=True)
+]}
+codecs_by_id = {codec.id: codec for codec in codecs.values()}
+
+
+def get_codec(compression):
+    if isinstance(compression, int):
+        if not compression in codecs_by_id:
+            raise Exception(f"Unsupported compression type ({compression})")
+        return codecs_by_id[compression]
+    if compression == "":
+        compression = "none"
+    if not compression in codecs:
+        raise Exception(f"Unsupported compression type ({compression})")
+    return codecs[compression]
+
+
+# Trains a zstd dictionary on samples of the data (only pays off for small blocks)
+def train_dictionary(data, dictionary_size = DEFAULT_DICTIONARY_SIZE, sample_size = 16384):
+    _require(zstandard, "zstd", "zstandard")
+    view = memoryview(data)
+    samples = [view[start:start + sample_size].tobytes() for start in range(0, len(view), sample_size)]
+    try:
+        return zstandard.train_dictionary(dictionary_size, samples).as_bytes()
+    except zstandard.ZstdError as e:
+        raise Exception(f"Couldn't train dictionary ({e}). The payload might be too small for a dictionary of {dictionary_size} Bytes")
+
+
+# Compresses the payload with the given compression method. Block-wise methods compress their blocks
+# in parallel on a process pool. Returns everything that follows the header inside the file.
+def compress_payload(data, compression, preset, block_size = DEFAULT_BLOCK_SIZE, workers = None, dictionary_size = 0, progress = True):
+    codec = get_codec(compression)
+    if not codec.blockwise:
+        return codec.compress(data, preset)
+
+    bd_dictionary = b""
+    dictionary = None
+    if codec.dictionary:
+        if dictionary_size > 0:
+            dictionary = train_dictionary(data, dictionary_size)
+        bd_dictionary = np.array([len(dictionary) if dictionary else 0], dtype=DICTIONARY_SIZE_DTYPE).tobytes() + (dictionary or b"")
+    view = memoryview(data)
+    blocks = [view[start:start + block_size].tobytes() for start in range(0, len(view), block_size)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        blocks = list(tqdm(executor.map(codec.compress, blocks, itertools.repeat(preset), itertools.repeat(dictionary)), total=len(blocks), desc="Compressing blocks", disable=not progress))
+    return bd_dictionary + pack_block_index(block_size, [len(block) for block in blocks]) + b"".join(blocks)
+
+
+# Random access onto the blocks of a block-wise compressed payload
+class BlockReader:
+    def __init__(self, codec, payload):
+        self.codec = codec
+        payload = memoryview(payload)
+        offset = 0
+        self.dictionary = None
+        if codec.dictionary:
+            dictionary_size = np.frombuffer(payload, dtype=DICTIONARY_SIZE_DTYPE, count=1)[0].item()
+            offset = DICTIONARY_SIZE_DTYPE.itemsize + dictionary_size
+            self.dictionary = payload[DICTIONARY_SIZE_DTYPE.itemsize:offset].tobytes() if dictionary_size > 0 else None
+        self.block_size, self.block_offsets, index_size = unpack_block_index(payload[offset:])
+        self.count_blocks = len(self.block_offsets) - 1
+        self.data = payload[offset + index_size:]
+
+    def decompress_block(self, block):
+        return self.codec.decompress(self.data[self.block_offsets[block]:self.block_offsets[block + 1]], self.dictionary)
+
+    # Decompresses the given blocks, in parallel if there are several (lzma and zstd release the GIL)
+    def decompress_blocks(self, blocks, workers = None):
+        blocks = list(blocks)
+        if len(blocks) <= 1:
+            return [self.decompress_block(block) for block in blocks]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(self.decompress_block, blocks))
+
+    def release(self):
+        self.data.release()
+
+
+def decompress_payload(payload, compression, workers = None):
+    codec = get_codec(compression)
+    if not codec.blockwise:
+        return codec.decompress(payload)
+    reader = BlockReader(codec, payload)
+    data = b"".join(reader.decompress_blocks(range(reader.count_blocks), workers))
+    reader.release()
+    return data
+
+
+# Compresses the payload with every codec and preset. Reports compression ratio, compression throughput,
+# python decompression throughput and an estimate for the time to first frame (download + decompression)
+def benchmark_codecs(payload, compressions = None, block_size = DEFAULT_BLOCK_SIZE, workers = None, dictionary_size = DEFAULT_DICTIONARY_SIZE, bandwidth_mbit = 50.0):
+    payload = bytes(payload)
+    results = []
+    skipped = set()
+    runs = []
+    for name in compressions or codecs.keys():
+        codec = get_codec(name)
+        for preset in codec.presets:
+            runs.append((codec, preset, 0))
+            if codec.dictionary and dictionary_size > 0:
+                runs.append((codec, preset, dictionary_size))
+    for codec, preset, dict_size in tqdm(runs, desc="Benchmarking codecs"):
+        # A failing dictionary training only skips the runs with dictionary
+        if (codec.name, dict_size > 0) in skipped:
+            continue
+        try:
+            start = time.perf_counter()
+            compressed = compress_payload(payload, codec.name, preset, block_size, workers, dict_size, progress=False)
+            time_compress = time.perf_counter() - start
+            start = time.perf_counter()
+            decompressed = decompress_payload(compressed, codec.name, workers)
+            time_decompress = time.perf_counter() - start
+        except Exception as e:
+            tqdm.write(f" -> Skipped {codec.name} ({e})")
+            skipped.add((codec.name, dict_size > 0))
+            continue
+        if decompressed != payload:
+            raise Exception(f"Roundtrip of {codec.name} (preset {preset}) failed")
+        time_download = len(compressed) * 8 / (bandwidth_mbit * 1e6)
+        results.append({
+            'codec': codec.name,
+            'preset': preset,
+            'dictionary': dict_size,
+            'size [MB]': len(compressed) / 1e6,
+            'ratio': len(payload) / len(compressed),
+            'compress [MB/s]': len(payload) / 1e6 / time_compress,
+            'decompress [MB/s]': len(payload) / 1e6 / time_decompress,
+            f'first frame @{bandwidth_mbit:g}Mbit [s]': time_download + time_decompress
+        })
+    return pd.DataFrame(results)
+
+
+if __name__ == '__main__':
+    from cce_reader import CCEReader
+
+    parser = argparse.ArgumentParser(description="Benchmarks all compression codecs on the payload of a .cce file")
+    parser.add_argument("file", help="Path to a .cce file (any compression, segmented files get consolidated)")
+    parser.add_argument("--codecs", nargs="+", default=None, choices=list(codecs.keys()), help="Codecs to benchmark (default: all)")
+    parser.add_argument("--block-size", type=int, default=DEFAULT_BLOCK_SIZE, help="Uncompressed bytes per block for block-wise codecs")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes/threads for block-wise codecs")
+    parser.add_argument("--dictionary-size", type=int, default=DEFAULT_DICTIONARY_SIZE, help="Size of the trained dictionary (0 = no dictionary runs)")
+    parser.add_argument("--bandwidth", type=float, default=50.0, help="Bandwidth in Mbit/s for the time to first frame estimate")
+    parser.add_argument("--output", default=None, help="Optional path of a csv file for the results")
+    args = parser.parse_args()
+
+    with CCEReader(args.file) as db:
+        if db.buffer is None:
+            # Segmented file: the payload of the consolidated file (merged TEMPERATURES|CTILBS|LOCATIONS)
+            payload = b"".join(table.tobytes() for table in (db.temperatures, db.ctilbs, db.locations))
+        else:
+            payload = db.buffer.tobytes()
+    print(f"Payload of {args.file}: {len(payload)} Bytes")
+    df_results = benchmark_codecs(payload, args.codecs, args.block_size, args.workers, args.dictionary_size, args.bandwidth)
+    with pd.option_context('display.max_rows', 500, 'display.width', 200):
+        print(df_results.sort_values(by=df_results.columns[-1]).to_string(index=False, float_format=lambda x: f"{x:.3f}"))
+    if args.output:
+        df_results.to_csv(args.output, index=False)
@@ -0,0 +1,140 @@
+import argparse
+import itertools
+import time
+import numpy as np
+import pandas as pd
+from cce_format import file_flags, temperature_dtype
+from cce_codecs import compress_payload, decompress_payload, get_codec
+
+# Reversible pre-filters for the TEMPERATURES section. They make the discretized temperatures easier
+# to compress: the seasonality is removed by the deltas and the byte-planes group the (mostly equal)
+# high bytes. Which filters got applied is stored in the file_flags of the header (see cce_format.py).
+#
+# Encoding order: delta_year -> delta_month -> shuffle (decoding in reverse). The deltas are computed
+# on the discretized values modulo 2^(8*bc_temperature) and only within a CTILB, the first value(s)
+# of every CTILB stay untouched. So every CTILB can be decoded on its own.
+#
+# Compressed size of every filter combination for an existing file:
+#   python data/cce_filters.py data/sources/t15M_c498k_l40k_2b_none.cce --codecs lzma zstd
+
+temperature_filters = ['delta_year', 'delta_month', 'shuffle']
+
+
+# Combines the names of the filters to the respective file_flags
+def filter_flags(filters):
+    flags = 0
+    for name in filters:
+        if not name in temperature_filters:
+            raise Exception(f"Unknown temperature filter ({name})")
+        flags |= file_flags['filter_' + name]
+    return flags
+
+
+FILTER_FLAGS_MASK = filter_flags(temperature_filters)
+
+
+# Position of every temperature inside its CTILB and the id of the CTILB
+def _ctilb_positions(count_temperatures, ctilb_starts):
+    ctilb_starts = np.asarray(ctilb_starts, dtype=np.int64)
+    sizes = np.diff(np.r_[ctilb_starts, count_temperatures])
+    ctilb_ids = np.repeat(np.arange(len(ctilb_starts)), sizes)
+    return np.arange(count_temperatures) - ctilb_starts[ctilb_ids], ctilb_ids
+
+# Delta to the value `distance` entries before (if it is inside the same CTILB)
+def _delta_encode(values, positions, distance, mask):
+    result = values.copy()
+    idx = np.flatnonzero(positions >= distance)
+    result[idx] = (values[idx] - values[idx - distance]) & mask
+    return result
+
+# Cumulative sum (modulo mask+1) which restarts at every segment. The segments have to be contiguous.
+def _segmented_cumsum(values, segment_ids, mask):
+    cumsum = np.cumsum(values) # overflows of uint64 don't matter because of the mask
+    segment_starts = np.flatnonzero(np.r_[True, segment_ids[1:] != segment_ids[:-1]])
+    base = np.r_[np.uint64(0), cumsum][segment_starts]
+    return (cumsum - np.repeat(base, np.diff(np.r_[segment_starts, len(values)]))) & mask
+
+
+# Applies the filters of the flags onto the discretized temperatures. Returns the bytes of the TEMPERATURES section
+def encode_temperatures(distemps, ctilb_starts, bc_temperature, flags):
+    mask = np.uint64(2**(bc_temperature*8)-1)
+    values = np.asarray(distemps).astype(np.uint64)
+    positions, _ = _ctilb_positions(len(values), ctilb_starts)
+    if flags & file_flags['filter_delta_year']:
+        values = _delta_encode(values, positions, 12, mask)
+    if flags & file_flags['filter_delta_month']:
+        values = _delta_encode(values, positions, 1, mask)
+    values = values.astype(temperature_dtype(bc_temperature))
+    if flags & file_flags['filter_shuffle'] and bc_temperature > 1:
+        return values.view(np.uint8).reshape(-1, bc_temperature).T.tobytes()
+    return values.tobytes()
+
+
+# Inverse of encode_temperatures. Returns the discretized temperatures (big endian, like unfiltered files)
+def decode_temperatures(buffer, ctilb_starts, bc_temperature, flags):
+    dtype_temperature = temperature_dtype(bc_temperature)
+    if flags & file_flags['filter_shuffle'] and bc_temperature > 1:
+        values = np.frombuffer(buffer, dtype=np.uint8).reshape(bc_temperature, -1).T.copy().view(dtype_temperature).ravel()
+    else:
+        values = np.frombuffer(buffer, dtype=dtype_temperature)
+    if not flags & (file_flags['filter_delta_year'] | file_flags['filter_delta_month']):
+        return values
+    mask = np.uint64(2**(bc_temperature*8)-1)
+    values = values.astype(np.uint64)
+    positions, ctilb_ids = _ctilb_positions(len(values), ctilb_starts)
+    if flags & file_flags['filter_delta_month']:
+        values = _segmented_cumsum(values, ctilb_ids, mask)
+    if flags & file_flags['filter_delta_year']:
+        # Every (CTILB, calendar month) pair is one sequence with a stride of 12 entries
+        order = np.argsort(ctilb_ids * 12 + positions % 12, kind='stable')
+        sequence_ids = (ctilb_ids * 12 + positions % 12)[order]
+        values[order] = _segmented_cumsum(values[order], sequence_ids, mask)
+    return values.astype(dtype_temperature)
+
+
+# Compresses the payload of the reader with every combination of filters and every given codec.
+# Reports the compressed size and the time for decompression + filter decoding.
+def measure_filters(db, compressions = ('lzma',), preset = 6, block_size = None):
+    bc_temperature = db.header['bc_temperature']
+    ctilb_starts = db.ctilbs['id_temp_min'].astype(np.int64)
+    distemps = db.read_temperatures(0, db.header['count_temperatures'])
+    tables = db.ctilbs.tobytes() + db.locations.tobytes()
+    shuffle_options = [False, True] if bc_temperature > 1 else [False]
+    results = []
+    for delta_year, delta_month, shuffle in itertools.product([False, True], [False, True], shuffle_options):
+        filters = [name for name, active in zip(temperature_filters, (delta_year, delta_month, shuffle)) if active]
+        flags = filter_flags(filters)
+        payload = encode_temperatures(distemps, ctilb_starts, bc_temperature, flags) + tables
+        for compression in compressions:
+            kwargs = {'block_size': block_size} if block_size and get_codec(compression).blockwise else {}
+            compressed = compress_payload(payload, compression, preset, progress=False, **kwargs)
+            start = time.perf_counter()
+            decoded = decode_temperatures(decompress_payload(compressed, compression)[:distemps.nbytes], ctilb_starts, bc_temperature, flags)
+            time_decode = time.perf_counter() - start
+            if not np.array_equal(decoded, distemps):
+                raise Exception(f"Roundtrip of filters {filters} failed")
+            results.append({
+                'filters': "+".join(filters) if filters else "none",
+                'codec': compression,
+                'size [Bytes]': len(compressed),
+                'ratio': len(payload) / len(compressed),
+                'decode [s]': time_decode
+            })
+    df_results = pd.DataFrame(results)
+    df_results['vs. unfiltered'] = df_results['size [Bytes]'] / df_results.groupby('codec')['size [Bytes]'].transform('first')
+    return df_results
+
+
+if __name__ == '__main__':
+    from cce_reader import CCEReader
+
+    parser = argparse.ArgumentParser(description="Measures the compressed size of a .cce file for every combination of temperature filters")
+    parser.add_argument("file", help="Path to a .cce file (any compression/filters)")
+    parser.add_argument("--codecs", nargs="+", default=["lzma"], help="Codecs to measure (see cce_codecs.py)")
+    parser.add_argument("--preset", type=int, default=6, help="Preset/level for the codecs")
+    parser.add_argument("--block-size", type=int, default=None, help="Uncompressed bytes per block for block-wise codecs")
+    args = parser.parse_args()
+
+    with CCEReader(args.file) as db:
+        df_results = measure_filters(db, args.codecs, args.preset, args.block_size)
+    print(df_results.to_string(index=False, float_format=lambda x: f"{x:.3f}"))
@@ -0,0 +1,269 @@
+import numpy as np
+
+# Shared definitions of the binary CCE file layout. The full description of the
+# layout can be found in compress.py. Everything is stored in big endian.
+
+FILEIDENTIFICATION = "CCE"
+FILEVERSION = 4
+HEADER_SIZE = 32
+# Files using any of the file_flags are written as version 5, which appends a HEADER EXTENSION to the
+# version 4 header. Files without flags stay version 4, so they can still be read by older readers.
+FILEVERSION_EXTENDED = 5
+HEADER_EXTENSION_SIZE = 4
+# Appendable files (see cce_segments.py): the header (always with extension) is followed by SEGMENTS until the end of the file
+FILEVERSION_SEGMENTED = 6
+
+# Bits of file_flags
+file_flags = {
+    'filter_delta_year': 1 << 0,   # TEMPERATURES: delta to the same month of the previous year (within a CTILB)
+    'filter_delta_month': 1 << 1,  # TEMPERATURES: delta to the previous month (within a CTILB)
+    'filter_shuffle': 1 << 2,      # TEMPERATURES: stored as byte-planes (all high bytes first)
+    'quantization_location': 1 << 3,  # TEMPERATURES: discretized with the bounds of their location (QRNG section)
+    'quantization_ctilb': 1 << 4,     # TEMPERATURES: discretized with the bounds of their CTILB (QRNG section)
+    'aggregate_prefix': 1 << 5,    # APFX section: prefix sums over all temperatures
+    'aggregate_yearly': 1 << 6,    # AYIX + AYRS sections: cumulative sums/counts per location and year
+    'aggregate_monthly': 1 << 7,   # AYIX + AMON sections: cumulative sums/counts per location, year and calendar month
+    'spatial_kdtree': 1 << 8,      # KDTR section: balanced kd-tree over the locations
+    'layout_time_major': 1 << 9    # TEMPERATURES: dense month x location matrix, validity bitmap in the VALD section
+}
+
+# Implementations of the compression methods can be found in cce_codecs.py
+compression_methods = {
+    'none': 0,
+    'lzma': 1,
+    'lzma_blocks': 2,
+    'lz4': 3,
+    'zstd': 4,
+    'zstd_blocks': 5
+}
+
+# Default amount of uncompressed bytes per block for the block-wise compression methods
+DEFAULT_BLOCK_SIZE = 4 * 2**20
+
+### FILE IDENTIFICATION + HEADER [32 byte]
+HEADER_DTYPE = np.dtype([
+    ('fileidentification', 'S3'),
+    ('fileversion', 'u1'),
+    ('count_temperatures', '>u4'),
+    ('count_locations', '>u4'),
+    ('count_ctilb', '>u4'),
+    ('db_first_year', '>u2'),
+    ('db_first_month', 'u1'),
+    ('db_last_year', '>u2'),
+    ('db_last_month', 'u1'),
+    ('db_min_temp', '>f4'),
+    ('db_max_temp', '>f4'),
+    ('bc_temperature', 'u1'),
+    ('file_compression', 'u1')
+])
+
+### HEADER EXTENSION [4 byte] (only version 5)
+HEADER_EXTENSION_DTYPE = np.dtype([
+    ('file_flags', '>u4')
+])
+
+### CTILBS [8*count_ctilb]
+CTILB_DTYPE = np.dtype([
+    ('first_month', '>u4'),
+    ('id_temp_min', '>u4')
+])
+
+### LOCATIONS [12*count_locations]
+LOCATION_DTYPE = np.dtype([
+    ('latitude', '>f4'),
+    ('longitude', '>f4'),
+    ('id_ctilb_min', '>u4')
+])
+
+### DICTIONARY [4 + dictionary_size byte] (only for block-wise compression methods with dictionary)
+DICTIONARY_SIZE_DTYPE = np.dtype('>u4')
+
+### BLOCK INDEX [8 + 8*(count_blocks+1) byte] (only for block-wise compression methods)
+BLOCK_INDEX_DTYPE = np.dtype([
+    ('block_size', '>u4'),
+    ('count_blocks', '>u4')
+])
+BLOCK_OFFSET_DTYPE = np.dtype('>u8')
+
+### SECTIONS [(8+size) byte each] (only version 5, optional sections after the LOCATIONS until the end of the payload)
+SECTION_DTYPE = np.dtype([
+    ('tag', 'S4'),
+    ('size', '>u4')
+])
+
+### QRNG section [8*count_locations or 8*count_ctilb] (quantization_location/quantization_ctilb)
+QUANTIZATION_DTYPE = np.dtype([
+    ('min_temp', '>f4'),
+    ('max_temp', '>f4')
+])
+
+### APFX section [8*(count_temperatures+1) byte] (aggregate_prefix)
+PREFIX_SUM_DTYPE = np.dtype('>f8')
+
+### AYIX section [8*count_locations byte] (aggregate_yearly/aggregate_monthly)
+AGGREGATE_YEAR_INDEX_DTYPE = np.dtype([
+    ('first_year', '>u4'),
+    ('id_row_min', '>u4')
+])
+
+### AYRS section [12*(count_rows+1) byte] (aggregate_yearly), AMON section [12*12*(count_rows+1) byte] (aggregate_monthly)
+AGGREGATE_DTYPE = np.dtype([
+    ('sum', '>f8'),
+    ('count', '>u4')
+])
+
+### KDTR section [20*count_locations byte] (spatial_kdtree)
+KDTREE_NODE_DTYPE = np.dtype([
+    ('x', '>f4'),
+    ('y', '>f4'),
+    ('left', '>i4'),
+    ('right', '>i4'),
+    ('id', '>u4')
+])
+
+### SEGMENT HEADER [24 byte] (only version 6)
+SEGMENT_DTYPE = np.dtype([
+    ('tag', 'S4'),
+    ('count_temperatures', '>u4'),
+    ('count_ctilb', '>u4'),
+    ('count_locations', '>u4'),
+    ('size_index', '>u4'),
+    ('size_temperatures', '>u4')
+])
+
+### SEGMENT CTILBS [12*count_ctilb] (only version 6, inside the index of a segment)
+SEGMENT_CTILB_DTYPE = np.dtype([
+    ('first_month', '>u4'),
+    ('id_temp_min', '>u4'),
+    ('location', '>u4')
+])
+
+### SEGMENT LOCATIONS [8*count_locations] (only version 6, inside the index of a segment)
+SEGMENT_LOCATION_DTYPE = np.dtype([
+    ('latitude', '>f4'),
+    ('longitude', '>f4')
+])
+
+assert HEADER_DTYPE.itemsize == HEADER_SIZE
+assert HEADER_EXTENSION_DTYPE.itemsize == HEADER_EXTENSION_SIZE
+assert SEGMENT_DTYPE.itemsize == 24
+
+
+# Returns the dtype of the discretized temperature values for the given byte-count
+def temperature_dtype(bc_temperature):
+    return np.dtype(f'>u{bc_temperature}')
+
+
+# Min/Max normalization of the temperatures onto the full range of an unsigned integer with bc_temperature bytes
+def discretize_temperatures(temperatures, temperaturebounds, bc_temperature):
+    max_temperature_dis = 2**(bc_temperature*8)-1
+    return (((temperatures - temperaturebounds['db_min_temp'])/(temperaturebounds['db_max_temp']-temperaturebounds['db_min_temp'])) * max_temperature_dis).astype(np.uint32)
+
+# Inverse of discretize_temperatures (same computation as undiscretize in db_read_worker.js)
+def undiscretize_temperatures(distemps, temperaturebounds, bc_temperature):
+    max_temperature_dis = 2**(bc_temperature*8)-1
+    return (distemps.astype(np.float32) / max_temperature_dis) * (temperaturebounds['db_max_temp']-temperaturebounds['db_min_temp']) + temperaturebounds['db_min_temp']
+
+# Min/Max of the temperatures of every group (location or CTILB) for the QRNG section. The groups have
+# to be contiguous and start at group_starts. Groups with only one distinct value get a range of 1 degree.
+def quantization_bounds(temperatures, group_starts):
+    bounds = np.empty(len(group_starts), dtype=QUANTIZATION_DTYPE)
+    bounds['min_temp'] = np.minimum.reduceat(temperatures, group_starts)
+    bounds['max_temp'] = np.maximum.reduceat(temperatures, group_starts)
+    flat = bounds['max_temp'] <= bounds['min_temp']
+    bounds['max_temp'][flat] = bounds['min_temp'][flat] + 1.0
+    return bounds
+
+# Temperaturebounds (per value) for discretize_temperatures/undiscretize_temperatures out of the QRNG
+# bounds and the group id of every value
+def group_temperaturebounds(bounds, group_ids):
+    return {
+        "db_min_temp": bounds['min_temp'].astype(np.float32)[group_ids],
+        "db_max_temp": bounds['max_temp'].astype(np.float32)[group_ids]
+    }
+
+
+# Packs the file identification and header into its 32 byte representation (36 byte if there are file_flags or
+# the file is segmented)
+def pack_header(count_temperatures, count_locations, count_ctilb, datebounds, temperaturebounds, bc_temperature, file_compression, file_flags = 0, segmented = False):
+    header = np.zeros(1, dtype=HEADER_DTYPE)
+    header['fileidentification'] = FILEIDENTIFICATION.encode("ascii")
+    header['fileversion'] = FILEVERSION_SEGMENTED if segmented else FILEVERSION_EXTENDED if file_flags else FILEVERSION
+    header['count_temperatures'] = count_temperatures
+    header['count_locations'] = count_locations
+    header['count_ctilb'] = count_ctilb
+    for key in ('db_first_year', 'db_first_month', 'db_last_year', 'db_last_month'):
+        header[key] = datebounds[key]
+    for key in ('db_min_temp', 'db_max_temp'):
+        header[key] = temperaturebounds[key]
+    header['bc_temperature'] = bc_temperature
+    header['file_compression'] = file_compression
+    if not file_flags and not segmented:
+        return header.tobytes()
+    extension = np.zeros(1, dtype=HEADER_EXTENSION_DTYPE)
+    extension['file_flags'] = file_flags
+    return header.tobytes() + extension.tobytes()
+
+
+# Unpacks the file identification and header (and header extension) into a dictionary. The
+# buffer has to contain at least the first HEADER_SIZE + HEADER_EXTENSION_SIZE bytes of the file
+# (or the whole file if it is smaller). header_size is the offset of the payload.
+def unpack_header(buffer):
+    if len(buffer) < HEADER_SIZE:
+        raise Exception(f"File is too small to contain a header ({len(buffer)} Bytes)")
+    header = np.frombuffer(buffer, dtype=HEADER_DTYPE, count=1)[0]
+    if header['fileidentification'].decode("ascii", errors="replace") != FILEIDENTIFICATION:
+        raise Exception("Not a CCE file (wrong file identification)")
+    result = {key: header[key].item() for key in HEADER_DTYPE.names if key != 'fileidentification'}
+    result['file_flags'] = 0
+    result['header_size'] = HEADER_SIZE
+    if result['fileversion'] in (FILEVERSION_EXTENDED, FILEVERSION_SEGMENTED):
+        extension = np.frombuffer(buffer, dtype=HEADER_EXTENSION_DTYPE, count=1, offset=HEADER_SIZE)[0]
+        result['file_flags'] = extension['file_flags'].item()
+        result['header_size'] += HEADER_EXTENSION_SIZE
+    elif result['fileversion'] != FILEVERSION:
+        raise Exception(f"Unsupported File-Version ({result['fileversion']})")
+    return result
+
+
+# Packs the block index out of the uncompressed block size and the compressed size of every block.
+# The offsets are relative to the first byte after the block index (count_blocks+1 entries, the last one is the end)
+def pack_block_index(block_size, compressed_sizes):
+    index = np.zeros(1, dtype=BLOCK_INDEX_DTYPE)
+    index['block_size'] = block_size
+    index['count_blocks'] = len(compressed_sizes)
+    offsets = np.zeros(len(compressed_sizes) + 1, dtype=BLOCK_OFFSET_DTYPE)
+    offsets[1:] = np.cumsum(compressed_sizes)
+    return index.tobytes() + offsets.tobytes()
+
+
+# Returns the uncompressed block size, the block offsets and the byte size of the block index
+def unpack_block_index(buffer):
+    index = np.frombuffer(buffer, dtype=BLOCK_INDEX_DTYPE, count=1)[0]
+    count_blocks = index['count_blocks'].item()
+    offsets = np.frombuffer(buffer, dtype=BLOCK_OFFSET_DTYPE, count=count_blocks + 1, offset=BLOCK_INDEX_DTYPE.itemsize).astype(np.int64)
+    return index['block_size'].item(), offsets, BLOCK_INDEX_DTYPE.itemsize + offsets.nbytes
+
+
+# Packs an optional section (tag = 4 ASCII characters)
+def pack_section(tag, data):
+    section = np.zeros(1, dtype=SECTION_DTYPE)
+    section['tag'] = tag.encode("ascii")
+    section['size'] = len(data)
+    return section.tobytes() + bytes(data)
+
+
+# Returns a dictionary tag -> data of all sections inside the buffer
+def unpack_sections(buffer):
+    buffer = memoryview(buffer)
+    sections = {}
+    offset = 0
+    while offset + SECTION_DTYPE.itemsize <= len(buffer):
+        section = np.frombuffer(buffer, dtype=SECTION_DTYPE, count=1, offset=offset)[0]
+        offset += SECTION_DTYPE.itemsize
+        size = section['size'].item()
+        if offset + size > len(buffer):
+            raise Exception(f"Section {section['tag']} exceeds the payload")
+        sections[section['tag'].decode("ascii")] = buffer[offset:offset + size]
+        offset += size
+    return sections
@@ -0,0 +1,104 @@
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from cce_format import temperature_dtype
+
+# Layouts of the TEMPERATURES section:
+#  - location: The series of every location are stored one after another (CTILB order, see compress.py). Good for
+#              per-location scans, but a time slice over all locations touches the whole section.
+#  - time:     Dense month x location matrix (month-major), so a range of months is one contiguous range of bytes
+#              (with block-wise compression only the blocks of these months get decompressed). Missing values are
+#              0 and marked in the validity bitmap (VALD section). Only pays off if most of the matrix is filled.
+#  - auto:     time if the density (count_temperatures / (count_months*count_locations)) reaches TIME_MAJOR_MIN_DENSITY
+#
+# Benchmark of both layouts for per-location and time slice queries with the data of an existing file:
+#   python data/cce_layout.py data/sources/t15M_c498k_l40k_2b_none.cce --compressions none zstd_blocks
+
+layouts = ['location', 'time', 'auto']
+
+TIME_MAJOR_MIN_DENSITY = 0.8
+
+
+def layout_density(count_temperatures, count_locations, count_months):
+    return count_temperatures / (count_locations * count_months)
+
+# Resolves the "auto" layout
+def choose_layout(layout, count_temperatures, count_locations, count_months):
+    if not layout in layouts:
+        raise Exception(f"Unsupported layout ({layout})")
+    if layout != "auto":
+        return layout
+    return "time" if layout_density(count_temperatures, count_locations, count_months) >= TIME_MAJOR_MIN_DENSITY else "location"
+
+
+# Builds the month x location matrix of the discretized temperatures and its validity bitmap (packed, row-major)
+def build_time_major(distemps, months, locids, count_months, count_locations, bc_temperature):
+    matrix = np.zeros((count_months, count_locations), dtype=temperature_dtype(bc_temperature))
+    validity = np.zeros((count_months, count_locations), dtype=bool)
+    matrix[months, locids] = distemps
+    validity[months, locids] = True
+    return matrix, np.packbits(validity.ravel())
+
+
+# Writes the frame in both layouts and measures the time (open + query on a fresh reader) for the two query shapes:
+#  - series: the whole series of one random location
+#  - slice:  all locations for a random range of `years` years
+def benchmark_layouts(df_data, output_path, compressions = ('none', 'zstd_blocks'), count_queries = 10, years = 30, block_size = 2**20, seed = 0):
+    import compress
+    from cce_reader import CCEReader
+
+    rng = np.random.default_rng(seed)
+    results = []
+    for compression in compressions:
+        for layout in ('location', 'time'):
+            filename = f"benchmark_{layout}_{compression}.cce"
+            compress.compress_dataset(df_data, output_path, filename=filename, compression=compression, layout=layout, block_size=block_size)
+            path = f"{output_path}/{filename}"
+            with CCEReader(path, lazy_blocks=True) as db:
+                count_locations, count_months = db.header['count_locations'], db.count_months
+            queries = {
+                'series': [(rng.integers(count_locations).item(),) for _ in range(count_queries)],
+                'slice': [(first, min(first + years * 12, count_months) - 1) for first in rng.integers(0, max(count_months - years * 12, 1), count_queries).tolist()]
+            }
+            for shape, arguments in queries.items():
+                times, blocks = [], []
+                for args in arguments:
+                    start = time.perf_counter()
+                    with CCEReader(path, lazy_blocks=True) as db:
+                        db.series(*args) if shape == 'series' else db.time_slice(*args)
+                        times.append(time.perf_counter() - start)
+                        blocks.append(len(db._block_cache) if db._blocks is not None else 0)
+                results.append({
+                    'compression': compression,
+                    'layout': layout,
+                    'query': shape,
+                    'size [MB]': os.path.getsize(path) / 1e6,
+                    'mean [ms]': np.mean(times) * 1e3,
+                    'max [ms]': np.max(times) * 1e3,
+                    'blocks read': np.mean(blocks)
+                })
+            os.remove(path)
+    return pd.DataFrame(results)
+
+
+if __name__ == '__main__':
+    from cce_reader import CCEReader
+
+    parser = argparse.ArgumentParser(description="Benchmarks the location- and time-major TEMPERATURES layout with the data of a .cce file")
+    parser.add_argument("file", help="Path to a .cce file (any layout/compression)")
+    parser.add_argument("--compressions", nargs="+", default=["none", "zstd_blocks"], help="Compressions to benchmark (see cce_codecs.py)")
+    parser.add_argument("--queries", type=int, default=10, help="Amount of queries per query shape")
+    parser.add_argument("--years", type=int, default=30, help="Length of the time slices in years")
+    parser.add_argument("--block-size", type=int, default=2**20, help="Uncompressed bytes per block for block-wise codecs")
+    args = parser.parse_args()
+
+    with CCEReader(args.file) as db:
+        df_data = db.to_dataframe()
+        count_locations, count_months = db.header['count_locations'], db.count_months
+    print(f"Density of {args.file}: {layout_density(len(df_data), count_locations, count_months):.3f}")
+    with tempfile.TemporaryDirectory() as output_path:
+        df_results = benchmark_layouts(df_data, output_path, args.compressions, args.queries, args.years, args.block_size)
+    print(df_results.to_string(index=False, float_format=lambda x: f"{x:.3f}"))
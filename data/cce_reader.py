@@ -0,0 +1,397 @@
+import mmap
+import numpy as np
+import pandas as pd
+from cce_format import HEADER_SIZE, HEADER_EXTENSION_SIZE, FILEVERSION_SEGMENTED, CTILB_DTYPE, LOCATION_DTYPE, QUANTIZATION_DTYPE, PREFIX_SUM_DTYPE, AGGREGATE_YEAR_INDEX_DTYPE, AGGREGATE_DTYPE, KDTREE_NODE_DTYPE, file_flags, temperature_dtype, undiscretize_temperatures, group_temperaturebounds, unpack_header, unpack_sections
+from cce_codecs import BlockReader, get_codec
+from cce_filters import FILTER_FLAGS_MASK, decode_temperatures
+from cce_aggregates import year_rows
+from cce_spatial import kdtree_box_query
+
+# Python counterpart of src/assets/scripts/db_read_worker.js. Reads .cce files as written by
+# compress.compress_dataset. Uncompressed files are memory mapped and all tables are zero-copy
+# (big endian) numpy views onto the mapping, so even huge files open instantly and only the
+# pages which are actually queried get loaded. Compressed files get decompressed once into memory.
+# Block-wise compressed files (lzma_blocks, zstd_blocks) get decompressed in parallel. With lazy_blocks=True only
+# the CTILB and LOCATION tables get decompressed on open; temperatures are then only available through
+# read_temperatures/series, which decompress (and cache) just the blocks covering the requested range.
+# Files with temperature filters (see cce_filters.py) get their TEMPERATURES decoded into memory on open.
+# Files quantized per location/CTILB carry their bounds in the QRNG section (self.quantization), undiscretize
+# then needs the location/CTILB ids of the values. Files with precomputed aggregates (see cce_aggregates.py)
+# answer the time range means of aggregate with a few lookups instead of a scan.
+# Segmented files (see cce_segments.py) get all segments decompressed on open and merged into the tables of a
+# regular file.
+#
+# Months are addressed as month difference to the first month of the dataset (dm), the same
+# representation as used inside the CTILB table. Use month_index/month_date to convert.
+#
+# Usage:
+#   with CCEReader("sources/t15M_c498k_l40k_2b_none.cce") as db:
+#       months, temps = db.series(42, db.month_index(1950, 1), db.month_index(1980, 12))
+class CCEReader:
+    def __init__(self, path, lazy_blocks = False, workers = None):
+        self.path = path
+        self.workers = workers
+        self._file = open(path, "rb")
+        self._mmap = None
+        self._blocks = None
+        self.buffer = None
+        try:
+            self.header = unpack_header(self._file.read(HEADER_SIZE + HEADER_EXTENSION_SIZE))
+            if self.header['fileversion'] == FILEVERSION_SEGMENTED:
+                self._read_segmented()
+                return
+            header_size = self.header['header_size']
+            codec = get_codec(self.header['file_compression'])
+            if codec.name == "none":
+                self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+                self.buffer = memoryview(self._mmap)[header_size:]
+            elif not codec.blockwise:
+                self._file.seek(header_size)
+                self.buffer = memoryview(codec.decompress(self._file.read()))
+            else:
+                self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+                self._blocks = BlockReader(codec, memoryview(self._mmap)[header_size:])
+                self._block_cache = {}
+                if not lazy_blocks:
+                    self.buffer = memoryview(b"".join(self._read_blocks(range(self._blocks.count_blocks))))
+            self._map_sections()
+        except:
+            self.close()
+            raise
+
+    def _read_segmented(self):
+        from cce_segments import read_segments, canonical_tables
+        self.temperatures, self.ctilbs, self.locations = canonical_tables(read_segments(self.path, workers=self.workers))
+        self.header['count_ctilb'] = len(self.ctilbs)
+        self.layout = "location"
+        self.sections = {}
+        self.quantization = None
+        self.quantization_group = None
+        self.kdtree = None
+
+    # Decompresses the given blocks (in parallel). In lazy mode decompressed blocks get cached
+    def _read_blocks(self, block_ids):
+        block_ids = list(block_ids)
+        if self.buffer is None:
+            missing = [b for b in block_ids if b not in self._block_cache]
+            self._block_cache.update(zip(missing, self._blocks.decompress_blocks(missing, self.workers)))
+            return [self._block_cache[b] for b in block_ids]
+        return self._blocks.decompress_blocks(block_ids, self.workers)
+
+    # Returns the bytes [start, stop) of the uncompressed TEMPERATURES|CTILBS|LOCATIONS payload
+    def _read_payload(self, start, stop):
+        if self.buffer is not None:
+            return self.buffer[start:stop]
+        if stop <= start:
+            return b""
+        block_size = self._blocks.block_size
+        first_block, last_block = start // block_size, (stop - 1) // block_size
+        data = b"".join(self._read_blocks(range(first_block, last_block + 1)))
+        offset = first_block * block_size
+        return data[start - offset:stop - offset]
+
+    def _map_sections(self):
+        h = self.header
+        dtype_temperature = temperature_dtype(h['bc_temperature'])
+        self.layout = "time" if h['file_flags'] & file_flags['layout_time_major'] else "location"
+        size_temperatures = dtype_temperature.itemsize*(h['count_temperatures'] if self.layout == "location" else self.count_months*h['count_locations'])
+        size_ctilbs = CTILB_DTYPE.itemsize*h['count_ctilb']
+        size_locations = LOCATION_DTYPE.itemsize*h['count_locations']
+        expected_size = size_temperatures + size_ctilbs + size_locations
+        if self.buffer is not None and len(self.buffer) < expected_size:
+            raise Exception(f"Binary Data Size is incosistent. Expected: {expected_size} Bytes, Actual: {len(self.buffer)}")
+        offset = 0
+        # TEMPERATURES (not mapped for lazy blocks, decoded after the CTILBS if filtered)
+        self.temperatures = None
+        offset_temperatures = offset
+        offset += size_temperatures
+        # CTILBS
+        self.ctilbs = np.frombuffer(self._read_payload(offset, offset + size_ctilbs), dtype=CTILB_DTYPE)
+        offset += size_ctilbs
+        if h['file_flags'] & FILTER_FLAGS_MASK:
+            self.temperatures = decode_temperatures(self._read_payload(offset_temperatures, offset_temperatures + size_temperatures), self.ctilbs['id_temp_min'], h['bc_temperature'], h['file_flags'])
+        elif self.buffer is not None and self.layout == "location":
+            self.temperatures = np.frombuffer(self._read_payload(offset_temperatures, offset_temperatures + size_temperatures), dtype=dtype_temperature)
+        # LOCATIONS
+        self.locations = np.frombuffer(self._read_payload(offset, offset + size_locations), dtype=LOCATION_DTYPE)
+        offset += size_locations
+        # SECTIONS (only version 5)
+        self.sections = {}
+        if h['file_flags']:
+            self.sections = unpack_sections(self._read_payload(offset, self._payload_size()))
+        self.quantization = None
+        self.quantization_group = None
+        for group in ('location', 'ctilb'):
+            if h['file_flags'] & file_flags['quantization_' + group]:
+                if not 'QRNG' in self.sections:
+                    raise Exception("The QRNG section is missing")
+                self.quantization = np.frombuffer(self.sections['QRNG'], dtype=QUANTIZATION_DTYPE)
+                self.quantization_group = group
+        self.kdtree = np.frombuffer(self.sections['KDTR'], dtype=KDTREE_NODE_DTYPE) if 'KDTR' in self.sections else None
+        if self.layout == "time" and not 'VALD' in self.sections:
+            raise Exception("The VALD section is missing")
+        return offset
+
+    # Byte size of the uncompressed payload (the last block has to be decompressed in lazy mode)
+    def _payload_size(self):
+        if self.buffer is not None:
+            return len(self.buffer)
+        last_block = self._blocks.count_blocks - 1
+        return last_block * self._blocks.block_size + len(self._read_blocks([last_block])[0])
+
+    def close(self):
+        # The views have to be released before the mapping can be closed
+        self.temperatures = self.ctilbs = self.locations = self.quantization = self.kdtree = None
+        self.sections = {}
+        if getattr(self, "buffer", None) is not None:
+            self.buffer.release()
+            self.buffer = None
+        if getattr(self, "_blocks", None) is not None:
+            self._blocks.release()
+            self._blocks = None
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def temperaturebounds(self):
+        return {key: self.header[key] for key in ('db_min_temp', 'db_max_temp')}
+
+    @property
+    def count_months(self):
+        h = self.header
+        return (h['db_last_year'] - h['db_first_year']) * 12 + h['db_last_month'] - h['db_first_month'] + 1
+
+    def month_index(self, year, month):
+        return (year - self.header['db_first_year']) * 12 + month - self.header['db_first_month']
+
+    def month_date(self, dm):
+        ym = self.header['db_first_year'] * 12 + self.header['db_first_month'] - 1 + np.asarray(dm)
+        return ym // 12, ym % 12 + 1
+
+    # locations/ctilbs: id(s) of the location/CTILB of the values, required by files quantized per location/CTILB
+    def undiscretize(self, distemps, locations = None, ctilbs = None):
+        temperaturebounds = self.temperaturebounds
+        if self.quantization is not None:
+            group_ids = locations if self.quantization_group == "location" else ctilbs
+            if group_ids is None:
+                raise Exception(f"The file is quantized per {self.quantization_group}, undiscretize needs the {self.quantization_group} ids")
+            temperaturebounds = group_temperaturebounds(self.quantization, group_ids)
+        return undiscretize_temperatures(np.asarray(distemps), temperaturebounds, self.header['bc_temperature'])
+
+    # Discretized temperatures [first, last) (in CTILB order). A view if the file is uncompressed
+    def read_temperatures(self, first, last):
+        if self.temperatures is not None:
+            return self.temperatures[first:last]
+        if self.layout == "time":
+            return self.read_temperatures_at(np.arange(first, last))
+        dtype_temperature = temperature_dtype(self.header['bc_temperature'])
+        return np.frombuffer(self._read_payload(first * dtype_temperature.itemsize, last * dtype_temperature.itemsize), dtype=dtype_temperature)
+
+    # Discretized temperatures at the given (sorted) indices. Only the rows/bytes between the first and last index
+    # get read (views if the file is uncompressed), so the result is the only copy.
+    def read_temperatures_at(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        if len(indices) == 0:
+            return np.empty(0, dtype=temperature_dtype(self.header['bc_temperature']))
+        if self.layout == "time":
+            ctilbs = np.searchsorted(self.ctilbs['id_temp_min'], indices, side='right') - 1
+            locations = np.searchsorted(self.locations['id_ctilb_min'], ctilbs, side='right') - 1
+            months = self.ctilbs['first_month'].astype(np.int64)[ctilbs] + indices - self.ctilbs['id_temp_min'].astype(np.int64)[ctilbs]
+            return self._read_matrix(months.min(), months.max() + 1)[months - months.min(), locations]
+        return self.read_temperatures(indices[0], indices[-1] + 1)[indices - indices[0]]
+
+    # Rows [first_month, last_month) of the month x location matrix (only time-major layout)
+    def _read_matrix(self, first_month, last_month):
+        dtype_temperature = temperature_dtype(self.header['bc_temperature'])
+        row_size = dtype_temperature.itemsize * self.header['count_locations']
+        return np.frombuffer(self._read_payload(first_month * row_size, last_month * row_size), dtype=dtype_temperature).reshape(-1, self.header['count_locations'])
+
+    # Rows [first_month, last_month) of the validity bitmap (only time-major layout)
+    def _read_validity(self, first_month, last_month):
+        count_locations = self.header['count_locations']
+        first_bit, last_bit = first_month * count_locations, last_month * count_locations
+        bits = np.unpackbits(np.frombuffer(self.sections['VALD'][first_bit // 8:(last_bit + 7) // 8], dtype=np.uint8))
+        return bits[first_bit % 8:first_bit % 8 + last_bit - first_bit].astype(bool).reshape(-1, count_locations)
+
+    # Range [first, last) of the CTILBs belonging to the given location
+    def ctilb_range(self, location):
+        if location < 0 or location >= self.header['count_locations']:
+            raise Exception(f"Location {location} outside bounds")
+        first = self.locations['id_ctilb_min'][location].item()
+        last = self.locations['id_ctilb_min'][location + 1].item() if location + 1 < self.header['count_locations'] else self.header['count_ctilb']
+        return first, last
+
+    # Range [first, last) of the temperatures belonging to the given ctilb
+    def temperature_range(self, ctilb):
+        first = self.ctilbs['id_temp_min'][ctilb].item()
+        last = self.ctilbs['id_temp_min'][ctilb + 1].item() if ctilb + 1 < self.header['count_ctilb'] else self.header['count_temperatures']
+        return first, last
+
+    # Returns the months (dm) and temperatures of one location between the months first_month and
+    # last_month (both inclusive). The CTILBs covering the range are found by binary search.
+    def series(self, location, first_month = 0, last_month = None, undiscretize = True):
+        if last_month is None:
+            last_month = self.count_months - 1
+        c_first, c_last = self.ctilb_range(location)
+        first_months = self.ctilbs['first_month'][c_first:c_last]
+        c_start = c_first + max(np.searchsorted(first_months, first_month, side='right') - 1, 0)
+        c_end = c_first + np.searchsorted(first_months, last_month, side='right')
+        months, values, ctilbs = [], [], []
+        for ctilb in range(c_start, c_end):
+            t_first, t_last = self.temperature_range(ctilb)
+            ctilb_month = self.ctilbs['first_month'][ctilb].item()
+            m_first = max(first_month, ctilb_month)
+            m_last = min(last_month, ctilb_month + t_last - t_first - 1)
+            if m_first > m_last:
+                continue
+            months.append(np.arange(m_first, m_last + 1))
+            values.append(self.read_temperatures(t_first + m_first - ctilb_month, t_first + m_last - ctilb_month + 1))
+            ctilbs.append(np.full(m_last - m_first + 1, ctilb))
+        months = np.concatenate(months) if months else np.empty(0, dtype=np.int64)
+        values = np.concatenate(values) if values else np.empty(0, dtype=temperature_dtype(self.header['bc_temperature']))
+        ctilbs = np.concatenate(ctilbs) if ctilbs else np.empty(0, dtype=np.int64)
+        return months, self.undiscretize(values, location, ctilbs) if undiscretize else values
+
+    # CTILB id of every temperature entry
+    def ctilb_index(self):
+        ctilb_starts = self.ctilbs['id_temp_min'].astype(np.int64)
+        return np.repeat(np.arange(self.header['count_ctilb']), np.diff(np.r_[ctilb_starts, self.header['count_temperatures']]))
+
+    # Ids of all locations inside the box (bounds inclusive). Uses the kd-tree of the file if there is one
+    def locations_in_box(self, lat_min, lat_max, lon_min, lon_max):
+        if self.kdtree is not None:
+            return kdtree_box_query(self.kdtree, lat_min, lat_max, lon_min, lon_max)
+        lat, lon = self.locations['latitude'], self.locations['longitude']
+        return np.flatnonzero((lat >= lat_min) & (lat <= lat_max) & (lon >= lon_min) & (lon <= lon_max))
+
+    # Location id and month (dm) of every temperature entry (computed from the CTILB and LOCATION tables)
+    def temperature_index(self):
+        h = self.header
+        ctilb_starts = self.ctilbs['id_temp_min'].astype(np.int64)
+        location_starts = self.locations['id_ctilb_min'].astype(np.int64)
+        location_sizes = np.diff(np.r_[location_starts, h['count_ctilb']])
+        ctilb_of_temp = self.ctilb_index()
+        location_of_ctilb = np.repeat(np.arange(h['count_locations']), location_sizes)
+        months = self.ctilbs['first_month'].astype(np.int64)[ctilb_of_temp] + np.arange(h['count_temperatures']) - ctilb_starts[ctilb_of_temp]
+        return location_of_ctilb[ctilb_of_temp], months
+
+    # Undiscretized temperatures of the whole file (locids as returned by temperature_index)
+    def _undiscretize_all(self, locids):
+        return self.undiscretize(self.read_temperatures(0, self.header['count_temperatures']), locids, self.ctilb_index() if self.quantization_group == "ctilb" else None)
+
+    # The CTILBs are sorted by location and first month, so this combined key is sorted as well
+    def _ctilb_keys(self):
+        h = self.header
+        location_sizes = np.diff(np.r_[self.locations['id_ctilb_min'].astype(np.int64), h['count_ctilb']])
+        return np.repeat(np.arange(h['count_locations']), location_sizes) * (self.count_months + 1) + self.ctilbs['first_month'].astype(np.int64)
+
+    # Last CTILB of every location starting before or at the month (the first CTILB of the location if there is none)
+    def _ctilb_of(self, locations, months, keys = None):
+        keys = self._ctilb_keys() if keys is None else keys
+        ctilbs = np.searchsorted(keys, np.asarray(locations, dtype=np.int64) * (self.count_months + 1) + months, side='right') - 1
+        return np.maximum(ctilbs, self.locations['id_ctilb_min'].astype(np.int64)[locations])
+
+    # Temperature indices [first, last) of every location covering the months [first_month, last_month]
+    def temperature_ranges(self, first_month, last_month):
+        h = self.header
+        ctilb_first_months = self.ctilbs['first_month'].astype(np.int64)
+        ctilb_starts = self.ctilbs['id_temp_min'].astype(np.int64)
+        ctilb_sizes = np.diff(np.r_[ctilb_starts, h['count_temperatures']])
+        keys = self._ctilb_keys()
+        def first_index(month):
+            month = min(max(month, 0), self.count_months)
+            ctilbs = self._ctilb_of(np.arange(h['count_locations']), month, keys)
+            return ctilb_starts[ctilbs] + np.clip(month - ctilb_first_months[ctilbs], 0, ctilb_sizes[ctilbs])
+        first = first_index(first_month)
+        return first, np.maximum(first_index(last_month + 1), first)
+
+    # Temperatures of all locations for the months [first_month, last_month] as (months x locations) matrices.
+    # Returns the validity (False = no value) and the (undiscretized, NaN if not valid) temperatures. With the
+    # time-major layout only the rows of the months get read.
+    def time_slice(self, first_month, last_month, undiscretize = True):
+        h = self.header
+        first_month, last_month = max(first_month, 0), min(last_month, self.count_months - 1)
+        count_months = max(last_month - first_month + 1, 0)
+        if self.layout == "time":
+            values = self._read_matrix(first_month, first_month + count_months)
+            valid = self._read_validity(first_month, first_month + count_months)
+        else:
+            first, last = self.temperature_ranges(first_month, last_month)
+            sizes = last - first
+            locations = np.repeat(np.arange(h['count_locations']), sizes)
+            indices = np.arange(sizes.sum()) + np.repeat(first - (np.cumsum(sizes) - sizes), sizes)
+            ctilbs = np.searchsorted(self.ctilbs['id_temp_min'], indices, side='right') - 1
+            months = self.ctilbs['first_month'].astype(np.int64)[ctilbs] + indices - self.ctilbs['id_temp_min'].astype(np.int64)[ctilbs]
+            values = np.zeros((count_months, h['count_locations']), dtype=temperature_dtype(h['bc_temperature']))
+            valid = np.zeros((count_months, h['count_locations']), dtype=bool)
+            if len(indices):
+                values[months - first_month, locations] = self.read_temperatures(indices.min(), indices.max() + 1)[indices - indices.min()]
+                valid[months - first_month, locations] = True
+        if not undiscretize:
+            return valid, values
+        months, locations = np.nonzero(valid)
+        ctilbs = self._ctilb_of(locations, months + first_month) if self.quantization_group == "ctilb" else None
+        temperatures = np.full(valid.shape, np.nan, dtype=np.float32)
+        temperatures[months, locations] = self.undiscretize(values[months, locations], locations, ctilbs)
+        return valid, temperatures
+
+    # Mean temperature (and amount of temperatures) of every location between the months first_month and
+    # last_month (both inclusive), optionally only of one calendar month (1-12). Uses the precomputed
+    # aggregates of the file if they cover the query, otherwise scans all temperatures (aggregate_scan).
+    def aggregate(self, first_month, last_month, month = None):
+        first_year, first_calendar_month = (x.item() for x in self.month_date(first_month))
+        last_year, last_calendar_month = (x.item() for x in self.month_date(last_month))
+        if month is None and 'APFX' in self.sections:
+            prefix = np.frombuffer(self.sections['APFX'], dtype=PREFIX_SUM_DTYPE)
+            first, last = self.temperature_ranges(first_month, last_month)
+            sums, counts = prefix[last] - prefix[first], last - first
+        elif month is None and 'AYRS' in self.sections and first_calendar_month == 1 and last_calendar_month == 12:
+            table = np.frombuffer(self.sections['AYRS'], dtype=AGGREGATE_DTYPE)
+            sums, counts = self._aggregate_years(table, first_year, last_year)
+        elif month is not None and 'AMON' in self.sections:
+            table = np.frombuffer(self.sections['AMON'], dtype=AGGREGATE_DTYPE).reshape(-1, 12)[:, month - 1]
+            # Years in which the calendar month lies inside the range
+            sums, counts = self._aggregate_years(table, first_year + (first_calendar_month > month), last_year - (last_calendar_month < month))
+        else:
+            return self.aggregate_scan(first_month, last_month, month)
+        counts = counts.astype(np.int64)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(counts > 0, sums / counts, np.nan), counts
+
+    def _aggregate_years(self, table, first_year, last_year):
+        year_index = np.frombuffer(self.sections['AYIX'], dtype=AGGREGATE_YEAR_INDEX_DTYPE)
+        row_first, row_last = year_rows(year_index, len(table) - 1, first_year, last_year)
+        return table['sum'][row_last] - table['sum'][row_first], table['count'][row_last].astype(np.int64) - table['count'][row_first]
+
+    # Same as aggregate, but always computed out of all temperatures
+    def aggregate_scan(self, first_month, last_month, month = None):
+        locids, months = self.temperature_index()
+        mask = (months >= first_month) & (months <= last_month)
+        if month is not None:
+            mask &= self.month_date(months)[1] == month
+        values = self._undiscretize_all(locids).astype(np.float64)
+        sums = np.bincount(locids[mask], weights=values[mask], minlength=self.header['count_locations'])
+        counts = np.bincount(locids[mask], minlength=self.header['count_locations'])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(counts > 0, sums / counts, np.nan), counts
+
+    # Decodes the whole file into a frame with the same columns as the input of compress_dataset
+    def to_dataframe(self):
+        locids, months = self.temperature_index()
+        years, months = self.month_date(months)
+        return pd.DataFrame({
+            'locid': locids.astype(np.uint32),
+            'Latitude': self.locations['latitude'][locids].astype(np.float32),
+            'Longitude': self.locations['longitude'][locids].astype(np.float32),
+            'Year': years.astype(np.uint32),
+            'Month': months.astype(np.uint32),
+            'AverageTemperature': self._undiscretize_all(locids)
+        })
@@ -0,0 +1,134 @@
+import json
+import sys
+import time
+import tracemalloc
+import pandas as pd
+
+# Instrumentation of compress_dataset (compress.py). Every STEP reports through one CompressReport:
+#  - wall and CPU time of the stage
+#  - peak memory of the stage, measured either as
+#      "rss":         peak resident set size (linux: VmHWM, reset at the start of every stage via /proc/self/clear_refs;
+#                     elsewhere the peak of the whole process so far)
+#      "tracemalloc": peak of the python/numpy allocations inside the stage (slower)
+#      None:          not measured
+#  - amount of input and output rows of the stage
+#  - bytes of every written section
+# Additional values (e.g. the header or the discretization error) are collected in `info`.
+# quiet = True suppresses all progress output of compress_dataset (print and tqdm).
+#
+# Usage:
+#   df, report = compress_dataset(df_data, "data/sources", quiet=True, return_report=True)
+#   print(report)
+#   report.to_json("report.json")
+
+memory_modes = ['rss', 'tracemalloc', None]
+
+
+# Resets the peak RSS of the process (linux only). Returns whether it worked
+def _reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+        return True
+    except OSError:
+        return False
+
+def _peak_rss():
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    except ImportError:
+        try:
+            import psutil
+            return psutil.Process().memory_info().peak_wset
+        except (ImportError, AttributeError):
+            return None
+
+
+class CompressReport:
+    def __init__(self, quiet = False, memory = "rss"):
+        if not memory in memory_modes:
+            raise Exception(f"Unsupported memory mode ({memory})")
+        self.quiet = quiet
+        self.memory = memory
+        self.stages = []
+        self.sections = []
+        self.info = {}
+        self._current = None
+        self._start = time.perf_counter()
+        self._tracemalloc_started = False
+        if memory == "tracemalloc" and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracemalloc_started = True
+
+    def log(self, *args, **kwargs):
+        if not self.quiet:
+            print(*args, **kwargs)
+
+    # Starts a new stage (the running one gets finished)
+    def begin(self, name, rows_in = None):
+        self.end()
+        self._current = {'stage': name, 'rows_in': rows_in, 'rows_out': None, 'wall [s]': 0.0, 'cpu [s]': 0.0, 'peak memory [MB]': None}
+        if self.memory == "tracemalloc":
+            tracemalloc.reset_peak()
+        elif self.memory == "rss":
+            self._current['_peak_reset'] = _reset_peak_rss()
+        self._current['_wall'] = time.perf_counter()
+        self._current['_cpu'] = time.process_time()
+
+    # Finishes the running stage
+    def end(self, rows_out = None):
+        stage = self._current
+        if stage is None:
+            return
+        stage['wall [s]'] = time.perf_counter() - stage.pop('_wall')
+        stage['cpu [s]'] = time.process_time() - stage.pop('_cpu')
+        stage['rows_out'] = rows_out
+        if self.memory == "tracemalloc":
+            stage['peak memory [MB]'] = tracemalloc.get_traced_memory()[1] / 1e6
+        elif self.memory == "rss":
+            # Without a reset (not linux) it is the peak of the process so far
+            stage.pop('_peak_reset')
+            peak = _peak_rss()
+            stage['peak memory [MB]'] = peak / 1e6 if peak is not None else None
+        self.stages.append(stage)
+        self._current = None
+
+    def section(self, name, nbytes):
+        self.sections.append({'section': name, 'bytes': int(nbytes)})
+
+    # Finishes the report (running stage, tracemalloc)
+    def close(self):
+        self.end()
+        self.info['total wall [s]'] = time.perf_counter() - self._start
+        if self._tracemalloc_started:
+            tracemalloc.stop()
+            self._tracemalloc_started = False
+
+    def stages_dataframe(self):
+        df = pd.DataFrame(self.stages, columns=['stage', 'rows_in', 'rows_out', 'wall [s]', 'cpu [s]', 'peak memory [MB]'])
+        return df.astype({'rows_in': 'Int64', 'rows_out': 'Int64'})
+
+    def sections_dataframe(self):
+        return pd.DataFrame(self.sections, columns=['section', 'bytes'])
+
+    def to_dict(self):
+        return {'memory': self.memory, 'stages': self.stages, 'sections': self.sections, 'info': self.info}
+
+    def to_json(self, path):
+        with open(path, "w") as file:
+            json.dump(self.to_dict(), file, indent=1, default=str)
+
+    def __str__(self):
+        return "\n".join([
+            self.stages_dataframe().to_string(index=False, float_format=lambda x: f"{x:.3f}"),
+            self.sections_dataframe().to_string(index=False),
+            f"Total: {self.info.get('total wall [s]', float('nan')):.3f}s, file size {self.info.get('file size', 'unknown')} Bytes"
+        ])
@@ -0,0 +1,459 @@
+import argparse
+import os
+import numpy as np
+import pandas as pd
+import compress
+from cce_format import HEADER_SIZE, HEADER_EXTENSION_SIZE, FILEVERSION_SEGMENTED, CTILB_DTYPE, LOCATION_DTYPE, SEGMENT_DTYPE, SEGMENT_CTILB_DTYPE, SEGMENT_LOCATION_DTYPE, DEFAULT_BLOCK_SIZE, compression_methods, pack_header, unpack_header, temperature_dtype, discretize_temperatures, undiscretize_temperatures
+from cce_codecs import compress_payload, decompress_payload, get_codec
+from cce_report import CompressReport
+from cce_spatial import location_key, location_from_key
+
+# Appendable .cce files (fileversion 6). Instead of one TEMPERATURES|CTILBS|LOCATIONS payload the file consists of
+# segments, every update (e.g. a new month of data) appends one segment which only contains the new temperatures:
+#  - create_dataset writes a new file with one segment holding all records
+#  - update_dataset appends the new months/locations of new_rows as a segment. Only the index payloads of the existing
+#    segments get decompressed (not their temperatures) and only the new segment gets compressed, so an update costs
+#    the size of the delta. Records which already exist inside the file are skipped (and reported).
+#  - The temperaturebounds of the header stay fixed (use temperature_margin on creation to leave room). New
+#    temperatures outside of them are detected: out_of_bounds = "error" raises, "clip" clips them onto the bounds and
+#    "requantize" rewrites the whole file with new bounds (costs a full rebuild).
+# The header (counts, datebounds) gets rewritten after the segment is written. Segments behind the counts of the
+# header (an interrupted update) are ignored by the readers and overwritten by the next update.
+# CCEReader merges the segments on open into the tables of a regular file. The viewer (db_read_worker.js) only reads
+# fileversion 4/5: consolidate_dataset converts a segmented file into a regular one.
+#
+# Usage:
+#   create_dataset("data/sources/combined", "sources/berkeley.cce", temperature_margin=5.0)
+#   info = update_dataset("sources/berkeley.cce", df_new_month)
+#   consolidate_dataset("sources/berkeley.cce", "../src/assets/db/berkeley.cce")
+#   python data/cce_segments.py update sources/berkeley.cce data/sources/new_month
+
+##### === SEGMENTED FILE LAYOUT (VERSION 6) ===
+### FILE IDENTIFICATION + HEADER + HEADER EXTENSION [36 byte] (see compress.py)
+# count_temperatures, count_locations: Totals of all segments
+# count_ctilb: Amount of CTILBs of all segments (a CTILB continued by a later segment counts twice)
+# datebounds: Datebounds of all segments
+# temperaturebounds: Bounds for the discretization of all segments (fixed at creation)
+# file_compression: Compression of every payload of the segments (block-wise: every payload has its own block index)
+# file_flags: always 0
+#
+### SEGMENT [(24+size_index+size_temperatures) byte], repeated until the end of the file
+# 4 byte, str(ASCII), tag = 'SEGM'
+# 4 byte, u32, count_temperatures
+# 4 byte, u32, count_ctilb
+# 4 byte, u32, count_locations, Amount of new locations (their ids continue after the locations of all previous segments)
+# 4 byte, u32, size_index, Stored (compressed) size of the INDEX
+# 4 byte, u32, size_temperatures, Stored (compressed) size of the TEMPERATURES
+#
+### INDEX (compressed)
+# CTILBS [12*count_ctilb]
+#   - u32, first_month, First month of this chunk (absolute: year*12 + month-1, the datebounds can grow)
+#   - u32, id_temp_min, First index inside the TEMPERATURES of this segment belonging to this ctilb
+#   - u32, location, Location id
+# LOCATIONS [8*count_locations], new locations of this segment
+#   - f32, latitude
+#   - f32, longitude
+#
+### TEMPERATURES (compressed) [A*count_temperatures]
+# A byte, u8|u16|u32, Discretized temperature value, sorted by location and month
+
+SEGMENT_TAG = "SEGM"
+
+out_of_bounds_modes = ['error', 'clip', 'requantize']
+
+
+# Absolute month (year*12 + month-1) of every row
+def absolute_months(years, months):
+    return years.astype(np.uint32) * 12 + months - 1
+
+def datebounds_of(first_ym, last_ym):
+    return {
+        "db_first_year": int(first_ym) // 12,
+        "db_first_month": int(first_ym) % 12 + 1,
+        "db_last_year": int(last_ym) // 12,
+        "db_last_month": int(last_ym) % 12 + 1
+    }
+
+def _read_exact(file, size):
+    data = file.read(size)
+    if len(data) < size:
+        raise Exception("The file is truncated")
+    return data
+
+
+# Reads the header and all segments. Returns a dictionary with
+#  - header, count_segments, end (offset behind the last segment counted by the header)
+#  - first_months, starts, counts, ctilb_locations: the CTILBs of all segments (absolute first month, global index of
+#    the first temperature, amount of temperatures, location id)
+#  - latitudes, longitudes: all locations in the order of their ids
+#  - temperatures: all discretized temperatures in the order of the segments (None if temperatures = False, then only
+#    the index payloads get decompressed)
+def read_segments(path, temperatures = True, workers = None):
+    with open(path, "rb") as file:
+        header = unpack_header(file.read(HEADER_SIZE + HEADER_EXTENSION_SIZE))
+        if header['fileversion'] != FILEVERSION_SEGMENTED:
+            raise Exception(f"Not a segmented file (File-Version {header['fileversion']})")
+        dtype_temperature = temperature_dtype(header['bc_temperature'])
+        offset = header['header_size']
+        file.seek(offset)
+        ctilbs, locations, values = [], [], []
+        count_temperatures = 0
+        while count_temperatures < header['count_temperatures']:
+            segment = np.frombuffer(_read_exact(file, SEGMENT_DTYPE.itemsize), dtype=SEGMENT_DTYPE)[0]
+            if segment['tag'].decode("ascii", errors="replace") != SEGMENT_TAG:
+                raise Exception(f"Invalid segment at offset {offset}")
+            count = segment['count_temperatures'].item()
+            size_index, size_temperatures = segment['size_index'].item(), segment['size_temperatures'].item()
+            index = decompress_payload(_read_exact(file, size_index), header['file_compression'], workers)
+            segment_ctilbs = np.frombuffer(index, dtype=SEGMENT_CTILB_DTYPE, count=segment['count_ctilb'].item())
+            locations.append(np.frombuffer(index, dtype=SEGMENT_LOCATION_DTYPE, count=segment['count_locations'].item(), offset=segment_ctilbs.nbytes))
+            ctilbs.append((segment_ctilbs, count_temperatures, count))
+            if temperatures:
+                values.append(np.frombuffer(decompress_payload(_read_exact(file, size_temperatures), header['file_compression'], workers), dtype=dtype_temperature, count=count))
+            else:
+                file.seek(size_temperatures, os.SEEK_CUR)
+            offset += SEGMENT_DTYPE.itemsize + size_index + size_temperatures
+            count_temperatures += count
+        if offset > os.fstat(file.fileno()).st_size:
+            raise Exception("The file is truncated")
+
+    locations = np.concatenate(locations) if locations else np.empty(0, dtype=SEGMENT_LOCATION_DTYPE)
+    if len(locations) != header['count_locations']:
+        raise Exception(f"Inconsistent amount of locations. Expected: {header['count_locations']}, Actual: {len(locations)}")
+    id_temp_min = [c['id_temp_min'].astype(np.int64) for c, _, _ in ctilbs]
+    return {
+        'header': header,
+        'count_segments': len(ctilbs),
+        'end': offset,
+        'first_months': np.concatenate([c['first_month'].astype(np.int64) for c, _, _ in ctilbs] or [np.empty(0, dtype=np.int64)]),
+        'starts': np.concatenate([ids + start for ids, (_, start, _) in zip(id_temp_min, ctilbs)] or [np.empty(0, dtype=np.int64)]),
+        'counts': np.concatenate([np.diff(np.r_[ids, count]) for ids, (_, _, count) in zip(id_temp_min, ctilbs)] or [np.empty(0, dtype=np.int64)]),
+        'ctilb_locations': np.concatenate([c['location'].astype(np.int64) for c, _, _ in ctilbs] or [np.empty(0, dtype=np.int64)]),
+        'latitudes': locations['latitude'].astype(np.float32),
+        'longitudes': locations['longitude'].astype(np.float32),
+        'temperatures': np.concatenate(values or [np.empty(0, dtype=dtype_temperature)]).astype(dtype_temperature, copy=False) if temperatures else None
+    }
+
+
+# Merges the segments (see read_segments) into the tables of a regular file: the temperatures sorted by location
+# and month, the CTILBs (pieces of different segments continuing each other are joined) and the locations.
+# Returns temperatures (None if the segments were read without them), ctilbs (CTILB_DTYPE) and locations (LOCATION_DTYPE).
+def canonical_tables(segments):
+    header = segments['header']
+    order = np.lexsort((segments['first_months'], segments['ctilb_locations']))
+    first_months, starts, counts, locations = (segments[key][order] for key in ('first_months', 'starts', 'counts', 'ctilb_locations'))
+    positions = np.r_[0, np.cumsum(counts)[:-1]].astype(np.int64)
+    new_ctilb = np.r_[True, (locations[1:] != locations[:-1]) | (first_months[1:] != first_months[:-1] + counts[:-1])]
+
+    temperatures = None
+    if segments['temperatures'] is not None:
+        temperatures = segments['temperatures'][np.repeat(starts - positions, counts) + np.arange(counts.sum())]
+    ctilbs = np.empty(np.count_nonzero(new_ctilb), dtype=CTILB_DTYPE)
+    ctilbs['first_month'] = first_months[new_ctilb] - (header['db_first_year'] * 12 + header['db_first_month'] - 1)
+    ctilbs['id_temp_min'] = positions[new_ctilb]
+    bd_locations = np.empty(len(segments['latitudes']), dtype=LOCATION_DTYPE)
+    bd_locations['latitude'] = segments['latitudes']
+    bd_locations['longitude'] = segments['longitudes']
+    bd_locations['id_ctilb_min'] = np.searchsorted(locations[new_ctilb], np.arange(len(bd_locations)))
+    return temperatures, ctilbs, bd_locations
+
+
+# Packs one segment out of the rows (sorted by location and absolute month, without duplicates) and the new locations.
+# Returns the segment and the amount of its CTILBs.
+def pack_segment(distemps, locids, yms, latitudes, longitudes, bc_temperature, compression, lzma_preset, block_size, workers):
+    ctilb_starts = np.flatnonzero(np.r_[True, (locids[1:] != locids[:-1]) | (np.diff(yms.astype(np.int64)) != 1)])
+    bd_ctilbs = np.empty(len(ctilb_starts), dtype=SEGMENT_CTILB_DTYPE)
+    bd_ctilbs['first_month'] = yms[ctilb_starts]
+    bd_ctilbs['id_temp_min'] = ctilb_starts
+    bd_ctilbs['location'] = locids[ctilb_starts]
+    bd_locations = np.empty(len(latitudes), dtype=SEGMENT_LOCATION_DTYPE)
+    bd_locations['latitude'] = latitudes
+    bd_locations['longitude'] = longitudes
+    bd_index = compress_payload(bd_ctilbs.tobytes() + bd_locations.tobytes(), compression, lzma_preset, block_size, workers, progress=False)
+    bd_temperatures = compress_payload(distemps.astype(temperature_dtype(bc_temperature)).tobytes(), compression, lzma_preset, block_size, workers, progress=False)
+    segment = np.zeros(1, dtype=SEGMENT_DTYPE)
+    segment['tag'] = SEGMENT_TAG.encode("ascii")
+    segment['count_temperatures'] = len(distemps)
+    segment['count_ctilb'] = len(ctilb_starts)
+    segment['count_locations'] = len(latitudes)
+    segment['size_index'] = len(bd_index)
+    segment['size_temperatures'] = len(bd_temperatures)
+    return segment.tobytes() + bd_index + bd_temperatures, len(ctilb_starts)
+
+
+# Writes a new segmented file out of the columns of compress.narrow_columns
+def _create(columns, filepath, discretizeresolution, compression, lzma_preset, temperature_margin, block_size, workers, report):
+    rows = compress.prepare_columns(columns, "latlon", report)
+    temperatures = rows['temperatures']
+    count = len(temperatures)
+    if count == 0:
+        raise Exception("There are no temperatures to write")
+    temperaturebounds = {
+        "db_min_temp": np.float32(temperatures.min() - temperature_margin).item(),
+        "db_max_temp": np.float32(temperatures.max() + temperature_margin).item()
+    }
+    yms = absolute_months(rows['years'], rows['months'])
+
+    report.begin("Discretize temperatures", count)
+    distemps = discretize_temperatures(temperatures, temperaturebounds, discretizeresolution)
+    report.end(count)
+
+    report.begin("Write segment", count)
+    bd_segment, count_ctilb = pack_segment(distemps, rows['locids'], yms, rows['latitudes'], rows['longitudes'], discretizeresolution, compression, lzma_preset, block_size, workers)
+    datebounds = datebounds_of(yms.min(), yms.max())
+    compress.log_header(report, count, len(rows['latitudes']), count_ctilb, datebounds, temperaturebounds, discretizeresolution)
+    bd_header = pack_header(count, len(rows['latitudes']), count_ctilb, datebounds, temperaturebounds, discretizeresolution, compression_methods[compression], segmented=True)
+    with open(filepath + ".tmp", "wb") as file:
+        file.write(bd_header)
+        file.write(bd_segment)
+    os.replace(filepath + ".tmp", filepath)
+    report.section("SEGMENT 0", len(bd_segment))
+    report.end(count)
+    report.log(f"Wrote {len(bd_header) + len(bd_segment)} Bytes ({count} temperatures) to {filepath}")
+    return {'file': filepath, 'count_temperatures': count, 'count_locations': len(rows['latitudes']), 'count_ctilb': count_ctilb, 'segment size': len(bd_segment)}
+
+def _read_input(df_data, report):
+    if isinstance(df_data, (str, os.PathLike)):
+        from parquet_store import read_store
+        report.begin("STEP 0: Read parquet store")
+        report.log("Reading parquet store...", end="")
+        df_data = read_store(df_data, columns=compress.input_columns)
+        report.log(f" -> {len(df_data)} rows")
+        report.end(len(df_data))
+    if not isinstance(df_data, pd.DataFrame):
+        raise Exception("df_data has to be a dataframe or the path to a parquet store")
+    if not {'Latitude', 'Longitude', 'AverageTemperature', 'Year', 'Month'}.issubset(df_data.columns):
+        raise Exception("A necessary column is missing inside the dataframe")
+    return compress.narrow_columns(df_data, report)
+
+
+# Creates a segmented file with all records of df_data as its first segment
+def create_dataset(
+        df_data,        # The pandas frame containing the data or the path to a parquet store (see compress_dataset)
+        filepath,       # Path of the new file
+        discretizeresolution = 2,   # byte-count for discretized temperature values. (1, 2 or 4)
+        compression = "lzma",   # compression of the segments (see compress_dataset)
+        lzma_preset = 0,        # preset for the compressor
+        temperature_margin = 0.0,   # widens the temperaturebounds on both sides (degrees), so that later updates with more extreme temperatures fit
+        block_size = DEFAULT_BLOCK_SIZE,  # uncompressed bytes per block for the block-wise compressions
+        workers = None,         # amount of worker processes for the block-wise compressions (None = cpu count)
+        quiet = False
+):
+    if not discretizeresolution in (1, 2, 4):
+        raise Exception(f"Only Discretize-Resolutions allowed are 1,2 or 4 byte")
+    if compression == "":
+        compression = "none"
+    if not compression in compression_methods:
+        raise Exception(f"Unsupported compression type ({compression})")
+    if temperature_margin < 0:
+        raise Exception("temperature_margin can't be negative")
+    report = CompressReport(quiet)
+    columns = _read_input(df_data, report)
+    df_data = None
+    info = _create(columns, filepath, discretizeresolution, compression, lzma_preset, temperature_margin, block_size, workers, report)
+    report.close()
+    return info
+
+
+# Appends the records of new_rows, which aren't inside the file yet, as a new segment. Returns a dictionary with
+#  - appended temperatures/appended ctilbs/new locations: content of the new segment
+#  - merged rows: duplicates inside new_rows (averaged like compress_dataset does)
+#  - skipped rows: records of months which already exist inside the file (their values are kept)
+#  - out of bounds: amount of new temperatures outside of the temperaturebounds of the file
+#  - requantized: whether the file had to be rewritten with new temperaturebounds
+#  - segment size: bytes appended to the file
+def update_dataset(
+        existing_path,  # Path of a segmented file (see create_dataset)
+        new_rows,       # The pandas frame containing the new records or the path to a parquet store (same columns as for compress_dataset)
+        lzma_preset = 0,        # preset for the compressor (the compression is the one of the file)
+        out_of_bounds = "error",    # what happens with new temperatures outside of the temperaturebounds (possible values: "error", "clip", "requantize")
+        temperature_margin = 0.0,   # margin of the new temperaturebounds if the file gets requantized
+        block_size = DEFAULT_BLOCK_SIZE,
+        workers = None,
+        quiet = False
+):
+    if not out_of_bounds in out_of_bounds_modes:
+        raise Exception(f"Unsupported out_of_bounds mode ({out_of_bounds})")
+    report = CompressReport(quiet)
+    log = report.log
+    report.begin("Read segment index")
+    segments = read_segments(existing_path, temperatures=False, workers=workers)
+    header = segments['header']
+    compression = get_codec(header['file_compression']).name
+    bc_temperature = header['bc_temperature']
+    count_locations = header['count_locations']
+    log(f"{existing_path}: {segments['count_segments']} segments, {header['count_temperatures']} temperatures, {count_locations} locations")
+    report.end()
+
+    columns = _read_input(new_rows, report)
+    new_rows = None
+    count = len(columns['temperatures'])
+
+    ### Location ids: existing locations keep their id, new ones get the next ids (in lat/lon order)
+    report.begin("Map locations", count)
+    keys = location_key(columns.pop('latitudes'), columns.pop('longitudes'))
+    locids = pd.Index(location_key(segments['latitudes'], segments['longitudes'])).get_indexer(keys).astype(np.int64)
+    new = locids < 0
+    new_keys = np.unique(keys[new])
+    locids[new] = count_locations + np.searchsorted(new_keys, keys[new])
+    locids = locids.astype(np.uint32)
+    del keys, new
+    log(f"{len(new_keys)} new locations")
+    report.end(count)
+
+    ### Merge duplicates and skip the months which already exist
+    report.begin("Merge rows", count)
+    yms = absolute_months(columns.pop('years'), columns.pop('months'))
+    order, row_starts, _, _, _ = compress.row_index(locids, yms)
+    temperatures = compress.group_mean_float32(columns.pop('temperatures')[order], row_starts)
+    rows = order[row_starts]
+    del order, row_starts
+    locids, yms = locids[rows], yms[rows]
+    count_merged = count - len(rows)
+    piece_order = np.lexsort((segments['first_months'], segments['ctilb_locations']))
+    piece_keys = (segments['ctilb_locations'][piece_order].astype(np.uint64) << np.uint64(32)) | segments['first_months'][piece_order].astype(np.uint64)
+    piece_ends = (segments['first_months'] + segments['counts'])[piece_order]
+    pieces = np.searchsorted(piece_keys, (locids.astype(np.uint64) << np.uint64(32)) | yms.astype(np.uint64), side='right') - 1
+    covered = (pieces >= 0) & (segments['ctilb_locations'][piece_order][np.maximum(pieces, 0)] == locids) & (yms < piece_ends[np.maximum(pieces, 0)])
+    count_skipped = np.count_nonzero(covered)
+    if count_skipped:
+        keep = ~covered
+        locids, yms, temperatures = locids[keep], yms[keep], temperatures[keep]
+    del pieces, covered
+    log(f"{count_merged} duplicate rows merged, {count_skipped} rows already inside the file (skipped)")
+    report.end(len(temperatures))
+
+    info = {
+        'file': existing_path,
+        'appended temperatures': 0,
+        'appended ctilbs': 0,
+        'new locations': 0,
+        'merged rows': count_merged,
+        'skipped rows': count_skipped,
+        'out of bounds': 0,
+        'requantized': False,
+        'segment size': 0
+    }
+    if len(temperatures) == 0:
+        log("Nothing to append")
+        report.close()
+        return info
+
+    ### Check the temperaturebounds
+    temperaturebounds = {key: header[key] for key in ('db_min_temp', 'db_max_temp')}
+    outside = (temperatures < temperaturebounds['db_min_temp']) | (temperatures > temperaturebounds['db_max_temp'])
+    info['out of bounds'] = count_outside = np.count_nonzero(outside)
+    if count_outside:
+        message = f"{count_outside} new temperatures ({temperatures[outside].min()} - {temperatures[outside].max()}) lie outside of the temperaturebounds [{temperaturebounds['db_min_temp']}, {temperaturebounds['db_max_temp']}] of the file"
+        if out_of_bounds == "error":
+            raise Exception(message + ", the file has to be requantized (out_of_bounds=\"requantize\")")
+        log(f"Note: {message} -> {'clipped' if out_of_bounds == 'clip' else 'requantizing the whole file'}")
+        if out_of_bounds == "clip":
+            temperatures = np.clip(temperatures, np.float32(temperaturebounds['db_min_temp']), np.float32(temperaturebounds['db_max_temp']))
+        else:
+            info.update(_requantize(existing_path, locids, yms, temperatures, new_keys, temperature_margin, lzma_preset, block_size, workers, report))
+            info.update({'appended temperatures': len(temperatures), 'new locations': len(new_keys), 'requantized': True})
+            report.close()
+            return info
+
+    ### Append the segment and update the header
+    report.begin("Write segment", len(temperatures))
+    distemps = discretize_temperatures(temperatures, temperaturebounds, bc_temperature)
+    latitudes, longitudes = location_from_key(new_keys)
+    bd_segment, count_ctilb = pack_segment(distemps, locids, yms, latitudes, longitudes, bc_temperature, compression, lzma_preset, block_size, workers)
+    first_ym = min(header['db_first_year'] * 12 + header['db_first_month'] - 1, yms.min().item())
+    last_ym = max(header['db_last_year'] * 12 + header['db_last_month'] - 1, yms.max().item())
+    counts = (header['count_temperatures'] + len(distemps), count_locations + len(new_keys), header['count_ctilb'] + count_ctilb)
+    datebounds = datebounds_of(first_ym, last_ym)
+    with open(existing_path, "r+b") as file:
+        file.truncate(segments['end']) # Leftovers of an interrupted update
+        file.seek(segments['end'])
+        file.write(bd_segment)
+        file.flush()
+        os.fsync(file.fileno())
+        # The segment only counts once the header has been updated
+        file.seek(0)
+        file.write(pack_header(*counts, datebounds, temperaturebounds, bc_temperature, header['file_compression'], segmented=True))
+    compress.log_header(report, *counts, datebounds, temperaturebounds, bc_temperature)
+    report.section(f"SEGMENT {segments['count_segments']}", len(bd_segment))
+    report.end(len(distemps))
+    log(f"Appended {len(distemps)} temperatures ({len(bd_segment)} Bytes) to {existing_path}")
+    report.close()
+    info.update({'appended temperatures': len(distemps), 'appended ctilbs': count_ctilb, 'new locations': len(new_keys), 'segment size': len(bd_segment)})
+    return info
+
+# Rewrites the whole file with new temperaturebounds out of the (undiscretized) temperatures of the file and the new rows
+def _requantize(path, locids, yms, temperatures, new_keys, temperature_margin, lzma_preset, block_size, workers, report):
+    report.begin("Read all segments")
+    segments = read_segments(path, workers=workers)
+    header = segments['header']
+    distemps, ctilbs, bd_locations = canonical_tables(segments)
+    counts = np.diff(np.r_[ctilbs['id_temp_min'].astype(np.int64), len(distemps)])
+    ctilb_locations = np.searchsorted(bd_locations['id_ctilb_min'], np.arange(len(ctilbs)), side='right') - 1
+    first_ym = header['db_first_year'] * 12 + header['db_first_month'] - 1
+    existing_locids = np.repeat(ctilb_locations, counts)
+    existing_yms = np.repeat(ctilbs['first_month'].astype(np.int64) + first_ym - ctilbs['id_temp_min'].astype(np.int64), counts) + np.arange(len(distemps))
+    latitudes, longitudes = location_from_key(new_keys)
+    latitudes = np.r_[segments['latitudes'], latitudes]
+    longitudes = np.r_[segments['longitudes'], longitudes]
+    locids = np.r_[existing_locids, locids]
+    yms = np.r_[existing_yms, yms]
+    columns = {
+        'latitudes': latitudes[locids],
+        'longitudes': longitudes[locids],
+        'years': (yms // 12).astype(np.uint16),
+        'months': (yms % 12 + 1).astype(np.uint8),
+        'temperatures': np.r_[undiscretize_temperatures(distemps, {key: header[key] for key in ('db_min_temp', 'db_max_temp')}, header['bc_temperature']), temperatures].astype(np.float32)
+    }
+    columns['uncertainties'] = np.zeros(len(locids), dtype=np.float32)
+    report.end(len(locids))
+    result = _create(columns, path, header['bc_temperature'], get_codec(header['file_compression']).name, lzma_preset, temperature_margin, block_size, workers, report)
+    return {'segment size': result['segment size']}
+
+
+# Writes the segmented file as a regular file (fileversion 4, e.g. for the viewer). Returns the path of the output
+def consolidate_dataset(path, output, compression = None, lzma_preset = 0, block_size = DEFAULT_BLOCK_SIZE, workers = None):
+    segments = read_segments(path, workers=workers)
+    header = segments['header']
+    compression = get_codec(header['file_compression'] if compression is None else compression).name
+    temperatures, ctilbs, bd_locations = canonical_tables(segments)
+    datebounds = {key: header[key] for key in ('db_first_year', 'db_first_month', 'db_last_year', 'db_last_month')}
+    temperaturebounds = {key: header[key] for key in ('db_min_temp', 'db_max_temp')}
+    bd_header = pack_header(len(temperatures), len(bd_locations), len(ctilbs), datebounds, temperaturebounds, header['bc_temperature'], compression_methods[compression])
+    bd_payload = temperatures.tobytes() + ctilbs.tobytes() + bd_locations.tobytes()
+    if compression != "none":
+        bd_payload = compress_payload(bd_payload, compression, lzma_preset, block_size, workers, progress=False)
+    with open(output, "wb") as file:
+        file.write(bd_header)
+        file.write(bd_payload)
+    return output
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Creates, updates and consolidates appendable (segmented) .cce files")
+    commands = parser.add_subparsers(dest="command", required=True)
+    create = commands.add_parser("create", help="Create a segmented file")
+    create.add_argument("input", help="Parquet store (see parquet_store.py)")
+    create.add_argument("output", help="Path of the new file")
+    create.add_argument("--discretizeresolution", type=int, default=2, choices=[1, 2, 4])
+    create.add_argument("--compression", default="lzma", choices=list(compression_methods))
+    create.add_argument("--preset", type=int, default=0)
+    create.add_argument("--temperature-margin", type=float, default=0.0, help="Room for more extreme temperatures of later updates (degrees)")
+    update = commands.add_parser("update", help="Append the new records of a parquet store")
+    update.add_argument("file", help="Segmented file")
+    update.add_argument("input", help="Parquet store with the new records")
+    update.add_argument("--preset", type=int, default=0)
+    update.add_argument("--out-of-bounds", choices=out_of_bounds_modes, default="error")
+    consolidate = commands.add_parser("consolidate", help="Write a regular (fileversion 4) file")
+    consolidate.add_argument("file", help="Segmented file")
+    consolidate.add_argument("output", help="Path of the regular file")
+    consolidate.add_argument("--compression", default=None, choices=list(compression_methods), help="Default: compression of the segments")
+    consolidate.add_argument("--preset", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.command == "create":
+        create_dataset(args.input, args.output, args.discretizeresolution, args.compression, args.preset, args.temperature_margin)
+    elif args.command == "update":
+        print(update_dataset(args.file, args.input, args.preset, args.out_of_bounds))
+    else:
+        consolidate_dataset(args.file, args.output, args.compression, args.preset)
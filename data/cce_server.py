@@ -0,0 +1,323 @@
+import argparse
+import asyncio
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+import aiohttp
+from aiohttp import web
+from cce_reader import CCEReader
+from cce_format import PREFIX_SUM_DTYPE
+
+# HTTP service answering the aggregation of comp_aggregate.wgsl for headless and non-WebGPU clients: the mean
+# temperature (and amount of temperatures) of every location over two time ranges A and B, optionally only of one
+# calendar month.
+#  - Every file is opened once with CCEReader (uncompressed files are memory mapped, compressed ones decoded once).
+#    No undiscretized copy of the temperatures is kept, only the values a query needs get read and undiscretized.
+#  - A range without month filter is answered by prefix sums: the APFX section of the file if it has one, otherwise
+#    every PREFIX_STEP-th prefix sum is built on open (8/PREFIX_STEP byte per temperature) and the at most
+#    PREFIX_STEP-1 values up to the range bounds get added. With a month filter only the temperatures inside the
+#    range are scanned (bincount).
+#  - The results of single ranges (file, first month, last month, month) are kept in an LRU cache, A and B are cached
+#    separately. The computation runs inside a thread pool, so the event loop keeps serving requests.
+# Unlike the shader the sums are built in float64.
+#
+# Endpoints
+#   GET /files      name, header and count_months of every file
+#   GET /aggregate  file=<name>, a=<first>,<last>, b=<first>,<last>, optional month=<1-12>, format=json|binary
+#                   The months are given as "YYYY-MM" or as month difference to the first month of the file (dm),
+#                   both inclusive. json: mean_a, count_a, mean_b, count_b (mean = null without temperatures).
+#                   binary: little endian float32 mean_a, mean_b (NaN without temperatures), uint32 count_a, count_b
+#   GET /stats      amount of queries, cache hits/misses
+#
+# Usage:
+#   python data/cce_server.py serve src/assets/db/*.cce --port 8080
+#   curl "http://localhost:8080/aggregate?file=t15M_c498k_l40k_2b_lzma.cce&a=1950-01,1979-12&b=1990-01,2019-12&month=7"
+#   python data/cce_server.py loadtest http://localhost:8080 t15M_c498k_l40k_2b_lzma.cce --requests 2000 --concurrency 32
+
+DEFAULT_CACHE_SIZE = 256
+PREFIX_STEP = 32 # temperatures per kept prefix sum
+PREFIX_CHUNKSIZE = PREFIX_STEP * 2**15 # temperatures undiscretized at once while building the prefix sums
+aggregate_formats = ['json', 'binary']
+
+
+class QueryError(Exception):
+    pass
+
+
+class LRUCache:
+    def __init__(self, maxsize = DEFAULT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock() # used from the threads of the executor
+
+    def get(self, key):
+        with self._lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+
+# One opened file with the prefix sums of its temperatures. The APFX section (see cce_aggregates.py) is used as it
+# is. Otherwise only every PREFIX_STEP-th prefix sum is kept (8/PREFIX_STEP byte per temperature), the rest of a sum
+# gets added from the temperatures of the file.
+class AggregateIndex:
+    def __init__(self, path, workers = None):
+        self.reader = CCEReader(path, workers=workers)
+        reader = self.reader
+        h = reader.header
+        self.count_locations = h['count_locations']
+        self.count_temperatures = h['count_temperatures']
+        self.first_month_index = h['db_first_month'] - 1 # calendar month of dm = 0 (0 = january)
+        self.ctilb_first_months = reader.ctilbs['first_month'].astype(np.int64)
+        self.ctilb_starts = reader.ctilbs['id_temp_min'].astype(np.int64)
+        self.location_ctilb_starts = reader.locations['id_ctilb_min'].astype(np.int64)
+        if 'APFX' in reader.sections:
+            self.prefix = np.frombuffer(reader.sections['APFX'], dtype=PREFIX_SUM_DTYPE)
+            self.prefix_step = 1
+        else:
+            sums = [np.zeros(1)]
+            for start in range(0, self.count_temperatures, PREFIX_CHUNKSIZE):
+                indices = np.arange(start, min(start + PREFIX_CHUNKSIZE, self.count_temperatures))
+                sums.append(np.add.reduceat(self.values(indices).astype(np.float64), np.arange(0, len(indices), PREFIX_STEP)))
+            self.prefix = np.cumsum(np.concatenate(sums))
+            self.prefix_step = PREFIX_STEP
+
+    def close(self):
+        self.prefix = None # may be a view onto the mapped file
+        self.reader.close()
+
+    # Undiscretized temperatures at the given (sorted) indices. Only these values are read (and copied)
+    def values(self, indices):
+        distemps = self.reader.read_temperatures_at(indices)
+        ctilbs = np.searchsorted(self.ctilb_starts, indices, side='right') - 1
+        locations = np.searchsorted(self.location_ctilb_starts, ctilbs, side='right') - 1
+        return self.reader.undiscretize(distemps, locations, ctilbs)
+
+    # Sums of all temperatures before the given indices
+    def prefix_sums(self, indices):
+        blocks, rests = np.divmod(indices, self.prefix_step)
+        sums = self.prefix[blocks].astype(np.float64)
+        if self.prefix_step > 1:
+            rows = np.repeat(np.arange(len(indices)), rests)
+            value_indices = np.repeat(blocks * self.prefix_step - (np.cumsum(rests) - rests), rests) + np.arange(rests.sum())
+            order = np.argsort(value_indices, kind='stable')
+            values = np.empty(len(value_indices), dtype=np.float64)
+            values[order] = self.values(value_indices[order])
+            sums += np.bincount(rows, weights=values, minlength=len(indices))
+        return sums
+
+    # Sums and counts of the temperatures of every location inside [first_month, last_month] (dm, inclusive),
+    # optionally only of one calendar month (1-12)
+    def range_sums(self, first_month, last_month, month = None):
+        first, last = self.reader.temperature_ranges(first_month, last_month)
+        if month is None:
+            sums = self.prefix_sums(np.r_[first, last])
+            return sums[self.count_locations:] - sums[:self.count_locations], last - first
+        sizes = last - first
+        indices = np.repeat(first - (np.cumsum(sizes) - sizes), sizes) + np.arange(sizes.sum())
+        locations = np.repeat(np.arange(self.count_locations), sizes)
+        ctilbs = np.searchsorted(self.ctilb_starts, indices, side='right') - 1
+        months = self.ctilb_first_months[ctilbs] + indices - self.ctilb_starts[ctilbs]
+        mask = (months + self.first_month_index) % 12 == month - 1
+        sums = np.bincount(locations[mask], weights=self.values(indices[mask]), minlength=self.count_locations)
+        counts = np.bincount(locations[mask], minlength=self.count_locations)
+        return sums, counts
+
+    # Month given as "YYYY-MM" or dm
+    def parse_month(self, value):
+        try:
+            if "-" in value.strip()[1:]:
+                year, month = value.strip().rsplit("-", 1)
+                year, month = int(year), int(month)
+                if not 1 <= month <= 12:
+                    raise QueryError(f"Unsupported month ({value})")
+                return self.reader.month_index(year, month)
+            return int(value)
+        except ValueError:
+            raise QueryError(f"Invalid month ({value})")
+
+
+class AggregateService:
+    def __init__(self, paths, cache_size = DEFAULT_CACHE_SIZE, workers = None):
+        self.files = {}
+        self.cache = LRUCache(cache_size)
+        self.queries = 0
+        self.workers = workers
+        for path in paths:
+            name = os.path.basename(path)
+            if name in self.files:
+                raise Exception(f"The file name {name} is used twice")
+            start = time.perf_counter()
+            self.files[name] = AggregateIndex(path, workers)
+            print(f"Opened {name} ({self.files[name].reader.header['count_temperatures']} temperatures) [{time.perf_counter() - start:.2f}s]")
+
+    def close(self):
+        for index in self.files.values():
+            index.close()
+        self.files = {}
+
+    # Means and counts of every location for one range (cached)
+    def range_aggregate(self, name, first_month, last_month, month = None):
+        key = (name, first_month, last_month, month)
+        result = self.cache.get(key)
+        if result is None:
+            sums, counts = self.files[name].range_sums(first_month, last_month, month)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                result = (np.where(counts > 0, sums / counts, np.nan), counts.astype(np.int64))
+            self.cache.put(key, result)
+        return result
+
+    def aggregate(self, name, range_a, range_b, month = None):
+        return self.range_aggregate(name, *range_a, month), self.range_aggregate(name, *range_b, month)
+
+    def parse_query(self, query):
+        name = query.get("file")
+        if not name in self.files:
+            raise QueryError(f"Unknown file ({name})")
+        index = self.files[name]
+        ranges = []
+        for key in ("a", "b"):
+            bounds = query.get(key, "").split(",")
+            if len(bounds) != 2:
+                raise QueryError(f"{key} has to be <first>,<last>")
+            ranges.append(tuple(index.parse_month(bound) for bound in bounds))
+        month = query.get("month")
+        if month is not None:
+            try:
+                month = int(month)
+            except ValueError:
+                raise QueryError(f"Invalid month filter ({month})")
+            if not 1 <= month <= 12:
+                raise QueryError(f"Unsupported month filter ({month})")
+        output_format = query.get("format", "json")
+        if not output_format in aggregate_formats:
+            raise QueryError(f"Unsupported format ({output_format})")
+        return name, ranges[0], ranges[1], month, output_format
+
+    async def handle_files(self, request):
+        return web.json_response({name: {**index.reader.header, 'count_months': int(index.reader.count_months)} for name, index in self.files.items()}, headers=_cors)
+
+    async def handle_aggregate(self, request):
+        try:
+            name, range_a, range_b, month, output_format = self.parse_query(request.query)
+        except QueryError as e:
+            raise web.HTTPBadRequest(text=str(e), headers=_cors)
+        self.queries += 1
+        (mean_a, count_a), (mean_b, count_b) = await asyncio.get_running_loop().run_in_executor(None, self.aggregate, name, range_a, range_b, month)
+        if output_format == "binary":
+            body = b"".join([mean_a.astype('<f4').tobytes(), mean_b.astype('<f4').tobytes(), count_a.astype('<u4').tobytes(), count_b.astype('<u4').tobytes()])
+            return web.Response(body=body, content_type="application/octet-stream", headers=_cors)
+        return web.json_response({
+            'file': name,
+            'a': list(range_a),
+            'b': list(range_b),
+            'month': month,
+            'mean_a': _json_values(mean_a),
+            'count_a': count_a.tolist(),
+            'mean_b': _json_values(mean_b),
+            'count_b': count_b.tolist()
+        }, headers=_cors)
+
+    async def handle_stats(self, request):
+        return web.json_response({'queries': self.queries, 'cache_entries': len(self.cache.entries), 'cache_hits': self.cache.hits, 'cache_misses': self.cache.misses}, headers=_cors)
+
+_cors = {'Access-Control-Allow-Origin': '*'}
+
+# NaN -> null
+def _json_values(values):
+    result = values.astype(object)
+    result[np.isnan(values)] = None
+    return result.tolist()
+
+
+def create_app(paths, cache_size = DEFAULT_CACHE_SIZE, workers = None):
+    service = AggregateService(paths, cache_size, workers)
+    app = web.Application()
+    app.router.add_get("/files", service.handle_files)
+    app.router.add_get("/aggregate", service.handle_aggregate)
+    app.router.add_get("/stats", service.handle_stats)
+    async def close(app):
+        service.close()
+    app.on_cleanup.append(close)
+    return app
+
+
+# Sends `requests` aggregate queries (at most `concurrency` at once) with random ranges out of `distinct` different
+# queries (smaller = more cache hits). Returns requests/s and latency percentiles.
+async def load_test(url, name, requests = 1000, concurrency = 16, distinct = 100, month_filter = 0.5, output_format = "binary", seed = 0):
+    rng = random.Random(seed)
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+        async with session.get(f"{url}/files") as response:
+            count_months = (await response.json())[name]['count_months']
+        def random_range():
+            first = rng.randrange(count_months)
+            return f"{first},{rng.randrange(first, count_months)}"
+        queries = []
+        for _ in range(distinct):
+            query = {'file': name, 'a': random_range(), 'b': random_range(), 'format': output_format}
+            if rng.random() < month_filter:
+                query['month'] = str(rng.randint(1, 12))
+            queries.append(query)
+        latencies = []
+        semaphore = asyncio.Semaphore(concurrency)
+        async def send(query):
+            async with semaphore:
+                start = time.perf_counter()
+                async with session.get(f"{url}/aggregate", params=query) as response:
+                    if response.status != 200:
+                        raise Exception(f"Request failed ({response.status}): {await response.text()}")
+                    await response.read()
+                latencies.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        await asyncio.gather(*[send(rng.choice(queries)) for _ in range(requests)])
+        duration = time.perf_counter() - start
+        async with session.get(f"{url}/stats") as response:
+            stats = await response.json()
+    latencies = np.array(latencies) * 1000
+    return {
+        'requests': requests,
+        'requests/s': requests / duration,
+        'p50 [ms]': np.percentile(latencies, 50),
+        'p95 [ms]': np.percentile(latencies, 95),
+        'p99 [ms]': np.percentile(latencies, 99),
+        'server': stats
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serves the time range aggregation of .cce files over HTTP")
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve = commands.add_parser("serve", help="Start the service")
+    serve.add_argument("files", nargs="+", help=".cce files")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8080)
+    serve.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_SIZE, help="Amount of cached range results")
+    loadtest = commands.add_parser("loadtest", help="Send random queries to a running service")
+    loadtest.add_argument("url", help="e.g. http://localhost:8080")
+    loadtest.add_argument("file", help="Name of the file on the service")
+    loadtest.add_argument("--requests", type=int, default=1000)
+    loadtest.add_argument("--concurrency", type=int, default=16)
+    loadtest.add_argument("--distinct", type=int, default=100, help="Amount of different queries")
+    loadtest.add_argument("--format", choices=aggregate_formats, default="binary")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        web.run_app(create_app(args.files, args.cache_size), host=args.host, port=args.port)
+    else:
+        for key, value in asyncio.run(load_test(args.url.rstrip("/"), args.file, args.requests, args.concurrency, args.distinct, output_format=args.format)).items():
+            print(f"{key}: {value:.2f}" if isinstance(value, float) else f"{key}: {value}")
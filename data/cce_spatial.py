@@ -0,0 +1,132 @@
+import numpy as np
+from cce_format import KDTREE_NODE_DTYPE
+
+# Spatial helpers for the LOCATIONS of a CCE file:
+#  - Locality preserving orders of the locations (Hilbert or Morton curve over longitude/latitude). Locations
+#    which are next to each other on the map get close ids, so neighbouring (similar) series are next to each
+#    other inside the TEMPERATURES (better compression) and the binning accesses the memory coherently.
+#  - A balanced kd-tree over the locations which is built offline and stored as KDTR section. The nodes are in
+#    pre-order (root = 0, the left subtree directly follows its parent), the same layout the renderer builds
+#    in KdPositionBuffer. The tree splits alternately by longitude (x) and latitude (y), starting with x.
+#  - uint64 keys of the positions which sort like (latitude, longitude), the location ids of compress.py and
+#    compress_stream.py are the ranks of these keys.
+
+location_orders = ['latlon', 'hilbert', 'morton']
+
+CURVE_BITS = 16
+
+
+# Maps float32 values onto uint32 values with the same ordering (flips the sign bit for
+# positive values and all bits for negative values)
+def _float_to_sortable_bits(values):
+    bits = (values.astype(np.float32) + np.float32(0.0)).view(np.uint32) # + 0.0 turns -0.0 into 0.0
+    return np.where(bits & 0x80000000, ~bits, bits | 0x80000000).astype(np.uint32)
+
+def _sortable_bits_to_float(bits):
+    bits = bits.astype(np.uint32)
+    return np.where(bits & 0x80000000, bits & 0x7FFFFFFF, ~bits).astype(np.uint32).view(np.float32)
+
+# Combines latitude and longitude to one uint64 key, which sorts like (Latitude, Longitude)
+def location_key(latitude, longitude):
+    return (_float_to_sortable_bits(latitude).astype(np.uint64) << np.uint64(32)) | _float_to_sortable_bits(longitude).astype(np.uint64)
+
+def location_from_key(keys):
+    return _sortable_bits_to_float(keys >> np.uint64(32)), _sortable_bits_to_float(keys & np.uint64(0xFFFFFFFF))
+
+
+# Position of the locations on a 2^CURVE_BITS x 2^CURVE_BITS grid over the whole globe
+def _curve_grid(latitudes, longitudes):
+    size = 2**CURVE_BITS - 1
+    x = np.clip((np.asarray(longitudes, dtype=np.float64) + 180.0) / 360.0, 0.0, 1.0) * size
+    y = np.clip((np.asarray(latitudes, dtype=np.float64) + 90.0) / 180.0, 0.0, 1.0) * size
+    return x.astype(np.int64), y.astype(np.int64)
+
+# Spreads the lower 16 bits of the values, so that there is a zero bit between each of them
+def _spread_bits(values):
+    values = values & 0xFFFF
+    values = (values | (values << 8)) & 0x00FF00FF
+    values = (values | (values << 4)) & 0x0F0F0F0F
+    values = (values | (values << 2)) & 0x33333333
+    values = (values | (values << 1)) & 0x55555555
+    return values
+
+def morton_keys(latitudes, longitudes):
+    x, y = _curve_grid(latitudes, longitudes)
+    return _spread_bits(x) | (_spread_bits(y) << 1)
+
+# Vectorized version of the xy -> d conversion of the Hilbert curve
+def hilbert_keys(latitudes, longitudes):
+    x, y = _curve_grid(latitudes, longitudes)
+    n = 2**CURVE_BITS
+    keys = np.zeros(len(x), dtype=np.int64)
+    s = n // 2
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        keys += s * s * ((3 * rx) ^ ry)
+        # Rotate the quadrant
+        flip = ~ry & rx
+        x[flip] = n - 1 - x[flip]
+        y[flip] = n - 1 - y[flip]
+        swap = ~ry
+        x[swap], y[swap] = y[swap], x[swap]
+        s //= 2
+    return keys
+
+
+# Returns the new id of every location (given in their current order) for the requested order
+def location_ids(latitudes, longitudes, order):
+    if not order in location_orders:
+        raise Exception(f"Unsupported location order ({order})")
+    if order == 'latlon':
+        keys = np.zeros(len(latitudes), dtype=np.int64)
+    elif order == 'hilbert':
+        keys = hilbert_keys(latitudes, longitudes)
+    else:
+        keys = morton_keys(latitudes, longitudes)
+    # Locations inside the same grid cell keep the latitude/longitude order
+    order = np.lexsort((longitudes, latitudes, keys))
+    ids = np.empty(len(order), dtype=np.uint32)
+    ids[order] = np.arange(len(order))
+    return ids
+
+
+# Builds a balanced kd-tree (median split) over the locations. Returns the nodes in pre-order (KDTREE_NODE_DTYPE)
+def build_kdtree(latitudes, longitudes):
+    points = np.stack([np.asarray(longitudes, dtype=np.float32), np.asarray(latitudes, dtype=np.float32)], axis=1)
+    nodes = np.empty(len(points), dtype=KDTREE_NODE_DTYPE)
+    stack = [(np.arange(len(points)), 0, 0)] if len(points) else []
+    while stack:
+        ids, depth, position = stack.pop()
+        median = len(ids) // 2
+        ids = ids[np.argpartition(points[ids, depth % 2], median)]
+        left_ids, right_ids = ids[:median], ids[median + 1:]
+        left = position + 1 if len(left_ids) else -1
+        right = position + 1 + len(left_ids) if len(right_ids) else -1
+        nodes[position] = (points[ids[median], 0], points[ids[median], 1], left, right, ids[median])
+        if len(left_ids):
+            stack.append((left_ids, depth + 1, left))
+        if len(right_ids):
+            stack.append((right_ids, depth + 1, right))
+    return nodes
+
+
+# Ids of all locations inside the box (bounds inclusive) by traversing the kd-tree
+def kdtree_box_query(nodes, lat_min, lat_max, lon_min, lon_max):
+    bounds = ((lon_min, lon_max), (lat_min, lat_max))
+    result = []
+    stack = [(0, 0)] if len(nodes) else []
+    while stack:
+        position, depth = stack.pop()
+        node = nodes[position]
+        x, y = node['x'].item(), node['y'].item()
+        if lon_min <= x <= lon_max and lat_min <= y <= lat_max:
+            result.append(node['id'].item())
+        value = x if depth % 2 == 0 else y
+        low, high = bounds[depth % 2]
+        # The left subtree only contains values <= value, the right one only values >= value
+        if node['left'] >= 0 and value >= low:
+            stack.append((node['left'].item(), depth + 1))
+        if node['right'] >= 0 and value <= high:
+            stack.append((node['right'].item(), depth + 1))
+    return np.sort(np.array(result, dtype=np.int64))
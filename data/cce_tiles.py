@@ -0,0 +1,300 @@
+import argparse
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import compress
+from compress_variants import prepare_rows
+from cce_format import CTILB_DTYPE, LOCATION_DTYPE, DEFAULT_BLOCK_SIZE, compression_methods, pack_header, unpack_header, temperature_dtype, undiscretize_temperatures
+from cce_codecs import compress_payload, decompress_payload, get_codec
+from cce_report import CompressReport
+
+# Sharded output: the locations are split into tiles of a lat/lon grid (tile_size degrees) and every tile is written as
+# a complete, independently compressed .cce file (fileversion 4, readable by db_read_worker.js). All tiles are
+# concatenated into one data file ("<name>.tiles") and a small uncompressed manifest ("<name>.tiles.json") lists the
+# byte offset, size, bounds and counts of every tile. A client only fetches the manifest and then the visible tiles
+# with HTTP range requests (offset, offset + size - 1) and decodes them in parallel.
+# All tiles share the datebounds (first_month of the CTILBs is relative to the same month) and the temperaturebounds of
+# the whole dataset, so the tiles can be combined without rescaling. The locations are ordered by tile: the global id
+# of a location is first_location of its tile + its id inside the tile.
+#
+# TiledReader is the local-file counterpart of such a client: it reads and decodes only the tiles intersecting a
+# bounding box and keeps track of the bytes it has read.
+#
+# Usage:
+#   manifest_path = compress_tiled("data/sources/combined", "src/assets/db", tile_size=10.0, compression="lzma")
+#   with TiledReader(manifest_path) as db:
+#       df = db.to_dataframe(db.load_box(35, 60, -10, 30))
+#   python data/cce_tiles.py build data/sources/combined src/assets/db --tile-size 10
+#   python data/cce_tiles.py read src/assets/db/t15M_c498k_l40k_2b_lzma.tiles.json --bbox 35 60 -10 30
+
+MANIFEST_FORMAT = "cce-tiles"
+MANIFEST_VERSION = 1
+
+
+# Tile (column x, row y) of every location
+def tile_cells(latitudes, longitudes, tile_size):
+    columns, rows = int(np.ceil(360 / tile_size)), int(np.ceil(180 / tile_size))
+    x = np.clip(np.floor((longitudes.astype(np.float64) + 180) / tile_size), 0, columns - 1).astype(np.int64)
+    y = np.clip(np.floor((latitudes.astype(np.float64) + 90) / tile_size), 0, rows - 1).astype(np.int64)
+    return x, y
+
+# Indices of the ranges [starts, starts + counts) one after another
+def _ranges(starts, counts):
+    counts = counts.astype(np.int64)
+    return np.repeat(starts.astype(np.int64) - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+
+# Packs one tile as a complete .cce file
+def _pack_tile(tile, datebounds, temperaturebounds, bc_temperature, compression, lzma_preset, block_size, workers):
+    temperatures, ctilbs, locations = tile
+    bd_header = pack_header(len(temperatures), len(locations), len(ctilbs), datebounds, temperaturebounds, bc_temperature, compression_methods[compression])
+    bd_payload = temperatures.tobytes() + ctilbs.tobytes() + locations.tobytes()
+    size = len(bd_payload)
+    if compression != "none":
+        bd_payload = compress_payload(bd_payload, compression, lzma_preset, block_size, workers, progress=False)
+    return bd_header + bd_payload, size
+
+
+def compress_tiled(
+        df_data,        # The pandas frame containing the data or the path to a parquet store (see compress_dataset)
+        output_path,    # Directory on where to save the data file and the manifest
+        filename = "auto",  # Filename of the data file (the manifest gets ".json" appended). Auto for generated name
+        tile_size = 10.0,   # width and height of a tile in degrees
+        discretizeresolution = 2,   # byte-count for discretized temperature values. (1, 2 or 4)
+        compression = "lzma",   # compression of every tile (see compress_dataset)
+        lzma_preset = 0,        # preset for the compressor
+        block_size = DEFAULT_BLOCK_SIZE,  # uncompressed bytes per block for the block-wise compressions
+        workers = None,         # amount of threads compressing the tiles (None = cpu count)
+        years = None,           # only use the records of this year range (first, last), inclusive
+        bbox = None,            # only use the locations inside this box (lat_min, lat_max, lon_min, lon_max), inclusive
+        quiet = False
+):
+    if not os.path.exists(output_path):
+        raise Exception(f"Directory  '{output_path}' does not exist")
+    if not discretizeresolution in (1, 2, 4):
+        raise Exception(f"Only Discretize-Resolutions allowed are 1,2 or 4 byte")
+    if compression == "":
+        compression = "none"
+    if not compression in compression_methods:
+        raise Exception(f"Unsupported compression type ({compression})")
+    if not 0 < tile_size <= 180:
+        raise Exception(f"Unsupported tile size ({tile_size})")
+    report = CompressReport(quiet)
+    log = report.log
+
+    ### STEP 1-7: like compress_dataset (low memory mode, global quantization)
+    rows = prepare_rows(df_data, "latlon", years, bbox, report)
+    df_data = None
+    columns = compress.discretize_columns(rows, "global", discretizeresolution, None, False, report)
+    bc_temperature = columns['bc_temperature']
+    datebounds, temperaturebounds = columns['datebounds'], columns['temperaturebounds']
+    location_starts, ctilb_starts = columns['location_starts'], columns['ctilb_starts']
+    count_temperatures, count_locations, count_ctilb = len(columns['locids']), len(location_starts), len(ctilb_starts)
+
+    ### STEP 8: Split the locations into tiles
+    report.begin("STEP 8: Split into tiles", count_temperatures)
+    latitudes, longitudes = columns['latitudes'], columns['longitudes']
+    x, y = tile_cells(latitudes, longitudes, tile_size)
+    cells = y * int(np.ceil(360 / tile_size)) + x
+    location_order = np.argsort(cells, kind='stable') # inside a tile the locations stay in lat/lon order
+    cells = cells[location_order]
+    tile_starts = np.flatnonzero(np.r_[True, cells[1:] != cells[:-1]])
+    temperature_counts = np.diff(np.r_[location_starts, count_temperatures])[location_order]
+    location_ctilbs = columns['ctilbids'][location_starts]
+    ctilb_counts = np.diff(np.r_[location_ctilbs, count_ctilb])[location_order]
+    # Position of every temperature/CTILB after the reordering
+    temperature_order = _ranges(location_starts[location_order], temperature_counts)
+    ctilb_order = _ranges(location_ctilbs[location_order], ctilb_counts)
+    positions = np.empty(count_temperatures, dtype=np.int64)
+    positions[temperature_order] = np.arange(count_temperatures)
+    distemps = columns['distemps'].astype(temperature_dtype(bc_temperature))[temperature_order]
+    bd_ctilbs = np.empty(count_ctilb, dtype=CTILB_DTYPE)
+    bd_ctilbs['first_month'] = columns['dms'][ctilb_starts[ctilb_order]]
+    ctilb_positions = positions[ctilb_starts[ctilb_order]]
+    del positions, temperature_order, ctilb_order
+    bd_locations = np.empty(count_locations, dtype=LOCATION_DTYPE)
+    bd_locations['latitude'] = latitudes[location_order]
+    bd_locations['longitude'] = longitudes[location_order]
+    location_first_ctilb = np.r_[0, np.cumsum(ctilb_counts)[:-1]].astype(np.int64)
+    location_first_temperature = np.r_[0, np.cumsum(temperature_counts)[:-1]].astype(np.int64)
+
+    tiles, entries = [], []
+    for i, first_location in enumerate(tile_starts):
+        last_location = tile_starts[i + 1] if i + 1 < len(tile_starts) else count_locations
+        first_ctilb = location_first_ctilb[first_location]
+        last_ctilb = location_first_ctilb[last_location] if last_location < count_locations else count_ctilb
+        first_temperature = location_first_temperature[first_location]
+        last_temperature = location_first_temperature[last_location] if last_location < count_locations else count_temperatures
+        tile_ctilbs = bd_ctilbs[first_ctilb:last_ctilb].copy()
+        tile_ctilbs['id_temp_min'] = ctilb_positions[first_ctilb:last_ctilb] - first_temperature
+        tile_locations = bd_locations[first_location:last_location].copy()
+        tile_locations['id_ctilb_min'] = location_first_ctilb[first_location:last_location] - first_ctilb
+        tiles.append((distemps[first_temperature:last_temperature], tile_ctilbs, tile_locations))
+        entries.append({
+            'x': int(cells[first_location] % int(np.ceil(360 / tile_size))),
+            'y': int(cells[first_location] // int(np.ceil(360 / tile_size))),
+            'bounds': {
+                'lat_min': float(tile_locations['latitude'].min()),
+                'lat_max': float(tile_locations['latitude'].max()),
+                'lon_min': float(tile_locations['longitude'].min()),
+                'lon_max': float(tile_locations['longitude'].max())
+            },
+            'first_location': int(first_location),
+            'count_temperatures': int(last_temperature - first_temperature),
+            'count_locations': int(last_location - first_location),
+            'count_ctilb': int(last_ctilb - first_ctilb)
+        })
+    log(f"{len(tiles)} tiles of {tile_size} degrees")
+    report.end(count_temperatures)
+
+    ### STEP 9: Compress the tiles (in parallel)
+    report.begin("STEP 9: Compress tiles")
+    log(f"Compressing {len(tiles)} tiles ({compression})...", end="")
+    codec = get_codec(compression)
+    with ThreadPoolExecutor(max_workers=1 if codec.blockwise else workers) as executor:
+        packed = list(executor.map(lambda tile: _pack_tile(tile, datebounds, temperaturebounds, bc_temperature, compression, lzma_preset, block_size, workers), tiles))
+    log(f" -> {sum(len(data) for data, _ in packed)} Bytes")
+
+    ### STEP 10: Output data file and manifest
+    report.begin("STEP 10: Write files")
+    filepath = compress.get_output_filepath(output_path, filename, count_temperatures, count_ctilb, count_locations, bc_temperature, compression)
+    if filename == "auto":
+        filepath = os.path.splitext(filepath)[0] + ".tiles"
+    offset = 0
+    with open(filepath, "wb") as file:
+        for entry, (data, size) in zip(entries, packed):
+            file.write(data)
+            entry.update({'offset': offset, 'size': len(data), 'size_uncompressed': size})
+            offset += len(data)
+            report.section(f"TILE {entry['x']},{entry['y']}", len(data))
+    manifest = {
+        'format': MANIFEST_FORMAT,
+        'version': MANIFEST_VERSION,
+        'data': os.path.basename(filepath),
+        'tile_size': tile_size,
+        'count_temperatures': count_temperatures,
+        'count_locations': count_locations,
+        'count_ctilb': count_ctilb,
+        'datebounds': datebounds,
+        'temperaturebounds': temperaturebounds,
+        'bc_temperature': bc_temperature,
+        'compression': compression,
+        'tiles': entries
+    }
+    with open(filepath + ".json", "w") as file:
+        json.dump(manifest, file, separators=(",", ":"))
+    report.info.update({'file': filepath, 'file size': offset, 'count_tiles': len(entries)})
+    report.close()
+    log(f"Wrote {offset} Bytes to {filepath} and the manifest to {filepath}.json")
+    return filepath + ".json"
+
+
+# Decodes one tile (a complete .cce file) into its header and tables
+def decode_tile(buffer):
+    header = unpack_header(buffer)
+    payload = memoryview(decompress_payload(memoryview(buffer)[header['header_size']:], header['file_compression']))
+    size_temperatures = temperature_dtype(header['bc_temperature']).itemsize * header['count_temperatures']
+    size_ctilbs = CTILB_DTYPE.itemsize * header['count_ctilb']
+    return {
+        'header': header,
+        'temperatures': np.frombuffer(payload[:size_temperatures], dtype=temperature_dtype(header['bc_temperature'])),
+        'ctilbs': np.frombuffer(payload[size_temperatures:size_temperatures + size_ctilbs], dtype=CTILB_DTYPE),
+        'locations': np.frombuffer(payload[size_temperatures + size_ctilbs:], dtype=LOCATION_DTYPE, count=header['count_locations'])
+    }
+
+
+# Reads the tiles of a manifest (see compress_tiled) out of the local data file. Only the byte range of the requested
+# tiles gets read (bytes_read), decoded tiles are cached.
+class TiledReader:
+    def __init__(self, manifest_path, workers = None):
+        with open(manifest_path) as file:
+            self.manifest = json.load(file)
+        if self.manifest.get('format') != MANIFEST_FORMAT or self.manifest.get('version') != MANIFEST_VERSION:
+            raise Exception(f"Unsupported manifest ({self.manifest.get('format')} {self.manifest.get('version')})")
+        self.tiles = self.manifest['tiles']
+        self.workers = workers
+        self.bytes_read = 0
+        self._cache = {}
+        self._file = open(os.path.join(os.path.dirname(manifest_path), self.manifest['data']), "rb")
+
+    def close(self):
+        self._cache = {}
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # Same as an HTTP range request
+    def _read_range(self, offset, size):
+        self._file.seek(offset)
+        self.bytes_read += size
+        return self._file.read(size)
+
+    # Indices of the tiles with locations inside the box
+    def tiles_in_box(self, lat_min, lat_max, lon_min, lon_max):
+        return [i for i, tile in enumerate(self.tiles) if tile['bounds']['lat_min'] <= lat_max and tile['bounds']['lat_max'] >= lat_min and tile['bounds']['lon_min'] <= lon_max and tile['bounds']['lon_max'] >= lon_min]
+
+    # Reads and decodes the tiles (in parallel, lzma and zstd release the GIL). Returns {tile index: decoded tile}
+    def load_tiles(self, indices):
+        missing = [i for i in indices if i not in self._cache]
+        buffers = [self._read_range(self.tiles[i]['offset'], self.tiles[i]['size']) for i in missing]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            self._cache.update(zip(missing, executor.map(decode_tile, buffers)))
+        return {i: self._cache[i] for i in indices}
+
+    def load_box(self, lat_min, lat_max, lon_min, lon_max):
+        return self.load_tiles(self.tiles_in_box(lat_min, lat_max, lon_min, lon_max))
+
+    # All temperatures of the decoded tiles as a frame (same columns as CCEReader.to_dataframe, locid = global id)
+    def to_dataframe(self, tiles):
+        m = self.manifest
+        frames = []
+        for i, tile in tiles.items():
+            ctilbs, locations = tile['ctilbs'], tile['locations']
+            counts = np.diff(np.r_[ctilbs['id_temp_min'].astype(np.int64), len(tile['temperatures'])])
+            ctilb_locations = np.searchsorted(locations['id_ctilb_min'], np.arange(len(ctilbs)), side='right') - 1
+            locids = np.repeat(ctilb_locations, counts)
+            dms = np.repeat(ctilbs['first_month'].astype(np.int64) - ctilbs['id_temp_min'].astype(np.int64), counts) + np.arange(len(locids))
+            ym = m['datebounds']['db_first_year'] * 12 + m['datebounds']['db_first_month'] - 1 + dms
+            frames.append(pd.DataFrame({
+                'locid': (locids + self.tiles[i]['first_location']).astype(np.uint32),
+                'Latitude': locations['latitude'][locids].astype(np.float32),
+                'Longitude': locations['longitude'][locids].astype(np.float32),
+                'Year': (ym // 12).astype(np.uint32),
+                'Month': (ym % 12 + 1).astype(np.uint32),
+                'AverageTemperature': undiscretize_temperatures(tile['temperatures'], m['temperaturebounds'], m['bc_temperature'])
+            }))
+        if not frames:
+            return pd.DataFrame(columns=['locid', 'Latitude', 'Longitude', 'Year', 'Month', 'AverageTemperature'])
+        return pd.concat(frames, ignore_index=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Writes a dataset as lat/lon tiles with a manifest, or reads the tiles of a box")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="Write the tiles and the manifest")
+    build.add_argument("input", help="Parquet store (see parquet_store.py)")
+    build.add_argument("output", help="Output directory")
+    build.add_argument("--filename", default="auto")
+    build.add_argument("--tile-size", type=float, default=10.0, help="Size of a tile in degrees")
+    build.add_argument("--discretizeresolution", type=int, default=2, choices=[1, 2, 4])
+    build.add_argument("--compression", default="lzma", choices=list(compression_methods))
+    build.add_argument("--preset", type=int, default=0)
+    read = commands.add_parser("read", help="Load the tiles of a box (partial load)")
+    read.add_argument("manifest", help="Manifest (.tiles.json)")
+    read.add_argument("--bbox", type=float, nargs=4, metavar=("LAT_MIN", "LAT_MAX", "LON_MIN", "LON_MAX"), default=(-90, 90, -180, 180))
+    args = parser.parse_args()
+
+    if args.command == "build":
+        compress_tiled(args.input, args.output, args.filename, args.tile_size, args.discretizeresolution, args.compression, args.preset)
+    else:
+        with TiledReader(args.manifest) as db:
+            tiles = db.load_box(*args.bbox)
+            df = db.to_dataframe(tiles)
+            total = sum(tile['size'] for tile in db.tiles)
+            print(f"{len(tiles)} of {len(db.tiles)} tiles, read {db.bytes_read} of {total} Bytes ({100 * db.bytes_read / max(total, 1):.1f}%)")
+            print(f"{df['locid'].nunique()} locations, {len(df)} temperatures")
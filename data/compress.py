@@ -1,25 +1,423 @@
-
 import pandas as pd
 import os
 import numpy as np
 import util as ut
 import math
-import struct
-import lzma
-import threading
 from tqdm import tqdm
 import time
+from cce_format import FILEVERSION, CTILB_DTYPE, LOCATION_DTYPE, DEFAULT_BLOCK_SIZE, compression_methods, file_flags, pack_header, pack_section, temperature_dtype, discretize_temperatures, undiscretize_temperatures, quantization_bounds, group_temperaturebounds
+from cce_codecs import compress_payload
+from cce_filters import FILTER_FLAGS_MASK, temperature_filters, filter_flags, encode_temperatures
+from cce_aggregates import aggregate_types, aggregate_flags, build_aggregate_sections
+from cce_spatial import location_orders, location_ids, location_key, location_from_key, build_kdtree
+from cce_layout import layouts, layout_density, choose_layout, build_time_major
+from cce_report import CompressReport, memory_modes
+
+quantization_modes = ['global', 'location', 'ctilb']
+
+input_columns = ['Year', 'Month', 'AverageTemperature', 'AverageTemperatureUncertainty', 'Latitude', 'Longitude', 'Interpolated']
+
+# Returns the path of the output file (generates a name out of the counts if filename is 'auto')
+def get_output_filepath(output_path, filename, count_temperatures, count_ctilb, count_locations, discretizeresolution, compression):
+    if filename == "auto":
+        return f"{output_path}/t{ut.formatUIntNumber(count_temperatures)}_c{ut.formatUIntNumber(count_ctilb)}_l{ut.formatUIntNumber(count_locations)}_{discretizeresolution}b_{compression}.cce"
+    return f"{output_path}/{filename}"
+
+# Rows of the frame inside the year range and the bounding box (same filters as the ones pushed into a store scan)
+def filter_dataset(df_data, years = None, bbox = None):
+    mask = np.ones(len(df_data), dtype=bool)
+    if years is not None:
+        mask &= (df_data['Year'] >= years[0]).to_numpy() & (df_data['Year'] <= years[1]).to_numpy()
+    if bbox is not None:
+        lat_min, lat_max, lon_min, lon_max = bbox
+        mask &= df_data['Latitude'].between(lat_min, lat_max).to_numpy() & df_data['Longitude'].between(lon_min, lon_max).to_numpy()
+    return df_data[mask]
+
+# === ROW INDEX ===
+# Integer kernel of STEP 3-5 (used by prepare_frame and prepare_columns):
+#  - location_index: the locid of a row is the rank of its packed (Latitude, Longitude) key (see cce_spatial.location_key),
+#    the same ids groupby(["Latitude", "Longitude"]).ngroup() creates
+#  - row_index: sorts the rows once by the uint64 key (locid << 32 | dm). On the sorted keys equal neighbours are
+#    duplicates and a new CTILB starts wherever the key doesn't grow by exactly 1 (new location or gap between months).
+
+# Returns the locid of every row and the latitude/longitude of every location (in the order of the ids)
+def location_index(latitudes, longitudes, location_order = "latlon"):
+    # Hashing the keys is faster than sorting all of them, only the distinct keys get sorted
+    codes, keys = pd.factorize(location_key(latitudes, longitudes))
+    order = np.argsort(keys)
+    ranks = np.empty(len(keys), dtype=np.uint32)
+    ranks[order] = np.arange(len(keys))
+    locids = ranks[codes]
+    del codes
+    latitudes, longitudes = location_from_key(keys[order])
+    if location_order != "latlon":
+        # Reorder the ids along a space filling curve, so that neighbouring locations get close ids
+        ids = location_ids(latitudes, longitudes, location_order)
+        locids = ids[locids]
+        latitudes[ids], longitudes[ids] = latitudes.copy(), longitudes.copy()
+    return locids, latitudes, longitudes
+
+def get_datebounds(years, months):
+    datebounds = {
+        "db_first_year": years.min().item(),
+        "db_last_year": years.max().item()
+    }
+    datebounds['db_first_month'] = months[years == datebounds["db_first_year"]].min().item()
+    datebounds['db_last_month'] = months[years == datebounds["db_last_year"]].max().item()
+    return datebounds
+
+# Months since the first month of the datebounds (dm)
+def month_differences(years, months, datebounds):
+    return (years.astype(np.uint32) - datebounds['db_first_year']) * 12 + months - datebounds['db_first_month']
+
+# Returns
+#  - order: the rows sorted by (locid, dm) (stable, so duplicates keep the order of the input)
+#  - row_starts: start of every distinct (locid, dm) inside order
+#  - ctilbids: CTILB of every distinct row
+#  - ctilb_starts, location_starts: first distinct row of every CTILB/location
+def row_index(locids, dms):
+    keys = (locids.astype(np.uint64) << np.uint64(32)) | dms.astype(np.uint64)
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    row_starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    if len(row_starts) < len(keys):
+        keys = keys[row_starts]
+    new_ctilb = np.r_[True, np.diff(keys) != 1]
+    ctilb_starts = np.flatnonzero(new_ctilb)
+    ctilbids = np.cumsum(new_ctilb, dtype=np.uint32) - 1
+    del new_ctilb
+    # Every location starts with a CTILB
+    ctilb_locids = keys[ctilb_starts] >> np.uint64(32)
+    location_starts = ctilb_starts[np.r_[True, ctilb_locids[1:] != ctilb_locids[:-1]]]
+    return order, row_starts, ctilbids, ctilb_starts, location_starts
+
+# Mean of every group (contiguous, starting at group_starts) of float32 values. Like pandas' groupby mean the sum is
+# built in float32 with Kahan summation.
+def group_mean_float32(values, group_starts):
+    if len(group_starts) == len(values):
+        return values.astype(np.float32)
+    counts = np.diff(np.r_[group_starts, len(values)])
+    sums = values[group_starts].astype(np.float32)
+    compensations = np.zeros(len(group_starts), dtype=np.float32)
+    for i in range(1, counts.max(initial=1)):
+        groups = np.flatnonzero(counts > i)
+        y = values[group_starts[groups] + i] - compensations[groups]
+        t = sums[groups] + y
+        compensations[groups] = (t - sums[groups]) - y
+        sums[groups] = t
+    return (sums / counts).astype(np.float32)
+
+
+def log_header(report, count_temperatures, count_locations, count_ctilb, datebounds, temperaturebounds, bc_temperature):
+    report.log("== HEADER ==")
+    report.log(f" -> Counts: Temperatures={count_temperatures}; Locations={count_locations}; CTILBs={count_ctilb}")
+    report.log(" -> Datebounds: ", datebounds)
+    report.log(" -> Temperaturebounds: ", temperaturebounds)
+    report.log(f" -> Byte-Counts: bc_temperature={bc_temperature}")
+    report.info.update({'count_temperatures': count_temperatures, 'count_locations': count_locations, 'count_ctilb': count_ctilb, 'datebounds': datebounds, 'temperaturebounds': temperaturebounds})
+
+# STEP 1-7 on a pandas frame. All intermediate columns (dm, id, disTemp, disError, disErrorUnc, ...) stay inside
+# the returned frame for inspection. Returns the frame and the columns needed for the binary data (see compress_dataset).
+def prepare_frame(df_data, location_order, quantization, discretizeresolution, max_error, max_error_relative_to_uncertainty, report):
+    log = report.log
+
+    ### STEP 1: Delete all NaN values
+    report.begin("STEP 1: Delete NaN values", len(df_data))
+    log("Dropping NaNs...", end="")
+    df = df_data.dropna().reset_index(drop=True)
+    log(f" -> removed {len(df_data) - len(df)} rows")
+    report.end(len(df))
+
+    ### STEP 2: Convert data to correct representation
+    report.begin("STEP 2: Convert data types", len(df))
+    log("Converting data types...")
+    if not 'AverageTemperatureUncertainty' in df_data.columns: 
+        df['AverageTemperatureUncertainty'] = np.nan
+    if not 'Interpolated' in df_data.columns:
+        df['Interpolated'] = False
+    df = df.astype({
+        'Latitude': np.float32, 
+        'Longitude': np.float32,
+        'Year': np.uint32,
+        'Month': np.uint32,
+        'AverageTemperature': np.float32,
+        'AverageTemperatureUncertainty': np.float32,
+        'Interpolated': bool
+    })
 
-FILEVERSION = 4
+    report.end(len(df))
+
+    ### STEP 3: Create ID column for Location
+    report.begin("STEP 3: Create location ID", len(df))
+    log("Creating location ID...", end="")
+    locids, latitudes, longitudes = location_index(df['Latitude'].to_numpy(), df['Longitude'].to_numpy(), location_order)
+    df['locid'] = locids
+    log(f" -> Found {len(latitudes)} distinct locations")
+    report.end(len(df))
+
+    ### STEP 4: Sort by locid, Year and Month and average rows with same Year, Month and locid
+    report.begin("STEP 4: Merge rows with same year, month and locid", len(df))
+    log("Merging rows with same year, month and locid...", end="")
+    datebounds = get_datebounds(df['Year'].to_numpy(), df['Month'].to_numpy())
+    dms = month_differences(df['Year'].to_numpy(), df['Month'].to_numpy(), datebounds)
+    order, row_starts, ctilbids, ctilb_starts, location_starts = row_index(locids, dms)
+    rows = order[row_starts] # first row of every (locid, Year, Month)
+    df_tmp = pd.DataFrame({
+        'locid': locids[rows],
+        'Year': df['Year'].to_numpy()[rows],
+        'Month': df['Month'].to_numpy()[rows],
+        'AverageTemperature': group_mean_float32(df['AverageTemperature'].to_numpy()[order], row_starts),
+        'AverageTemperatureUncertainty': group_mean_float32(df['AverageTemperatureUncertainty'].to_numpy()[order], row_starts),
+        'Latitude': df['Latitude'].to_numpy()[rows],
+        'Longitude': df['Longitude'].to_numpy()[rows],
+        'Interpolated': np.logical_or.reduceat(df['Interpolated'].to_numpy()[order], row_starts)
+    })
+    dms = dms[rows]
+    log(f" -> merged {len(df) - len(df_tmp)} rows")
+    df = df_tmp
+    report.end(len(df))
+
+    ### STEP 5: Create CTILB IDs
+    report.begin("STEP 5: Create CTILB ID", len(df))
+    log("Creating CTILB ID...", end="")
+    df['ctilbid'] = ctilbids
+    log(f" -> Found {len(ctilb_starts)} distinct continous temperature index blocks")
+
+    ### STEP 5b: Create ID-Column
+    df['id'] = df.index
+    report.end(len(df))
+
+    ### STEP 6: Get Header-Data and create dm column
+    #df['date'] = pd.to_datetime(dict(year=df.Year, month=df.Month, day=1)) Create Date-Column (kinda slow)
+    report.begin("STEP 6: Get header data", len(df))
+    log("Get Header-Data...")
+    count_temperatures = len(df)
+    count_locations = len(location_starts)
+    count_ctilb = len(ctilb_starts)
+    temperaturebounds = {
+        "db_min_temp": df['AverageTemperature'].min().item(),
+        "db_max_temp": df['AverageTemperature'].max().item()
+    }
+    log("Create DM-Column...")
+    df['dm'] = dms
+    getByteCountForIndex = lambda size: math.ceil(math.log2(size) / 8.0)
+    getByteCountForMonthDifference = lambda db:  getByteCountForIndex((db["db_last_month"] - db["db_first_month"] + (db["db_last_year"] - db["db_first_year"]) * 12) + 1)
+    bc_temperature = discretizeresolution
+    log_header(report, count_temperatures, count_locations, count_ctilb, datebounds, temperaturebounds, bc_temperature)
+    report.end(len(df))
+
+    ### STEP 7: Discretize Temperature using Min/Max Normalization
+    # The bounds are either the global ones of the header or the ones of every location/CTILB (QRNG section).
+    # With max_error the byte-counts are tried in ascending order, the first one meeting the error is used.
+    report.begin("STEP 7: Discretize temperatures", len(df))
+    log("Discretize Temperature...")
+    locids = df['locid'].to_numpy()
+    temperatures = df['AverageTemperature'].to_numpy()
+    bd_quantization = None
+    distempbounds = temperaturebounds
+    if quantization != "global":
+        bd_quantization = quantization_bounds(temperatures, location_starts if quantization == "location" else ctilb_starts)
+        distempbounds = group_temperaturebounds(bd_quantization, locids if quantization == "location" else ctilbids)
+    df.loc[np.isnan(df['AverageTemperatureUncertainty']), "AverageTemperatureUncertainty"] = 0.0
+    for bc_temperature in ([discretizeresolution] if max_error is None else [1, 2, 4]):
+        df['disTemp'] = discretize_temperatures(temperatures, distempbounds, bc_temperature)
+        temperatures_undiscretized = undiscretize_temperatures(df['disTemp'].to_numpy(), distempbounds, bc_temperature)
+        df['disError'] = np.abs(temperatures - temperatures_undiscretized)
+        df['disErrorUnc'] = df['disError'] - df['AverageTemperatureUncertainty']
+        df.loc[df['disErrorUnc'] < 0.0, 'disErrorUnc'] = 0.0
+        if max_error is None:
+            break
+        error = df['disErrorUnc' if max_error_relative_to_uncertainty else 'disError'].max()
+        log(f" -> bc_temperature={bc_temperature} ({quantization}): max. error {error:.4f} (target {max_error})")
+        if error <= max_error:
+            break
+    else:
+        raise Exception(f"The discretization error can't meet max_error={max_error} (max. error with 4 byte: {error})")
+    stats = df[['disError', 'disErrorUnc']].rename(columns={'disError': 'Discretization error', 'disErrorUnc': 'Discretization error with Uncertainty'}).describe()
+    log(stats)
+    report.info.update({'bc_temperature': bc_temperature, 'discretization error': stats.to_dict()})
+    report.end(len(df))
+
+    return df, {
+        'datebounds': datebounds,
+        'temperaturebounds': temperaturebounds,
+        'bc_temperature': bc_temperature,
+        'locids': locids,
+        'ctilbids': ctilbids,
+        'location_starts': location_starts,
+        'ctilb_starts': ctilb_starts,
+        'years': df['Year'].to_numpy(),
+        'months': df['Month'].to_numpy(),
+        'dms': df['dm'].to_numpy(),
+        'latitudes': df['Latitude'].to_numpy()[location_starts],
+        'longitudes': df['Longitude'].to_numpy()[location_starts],
+        'distemps': df['disTemp'].to_numpy(dtype=temperature_dtype(bc_temperature)),
+        'distempbounds': distempbounds,
+        'bd_quantization': bd_quantization
+    }
+
+# === LOW MEMORY MODE ===
+# prepare_columns does the same as prepare_frame (same output file) on narrow numpy arrays instead of a frame:
+#  - float32 values, uint16 years, uint8 months, uint32 ids, uint16 dm (uint32 for more than 65536 months)
+#  - Latitude/Longitude are only kept per location, Interpolated isn't read at all
+#  - every intermediate array gets released as soon as it isn't needed anymore
+#  - the discretization happens in chunks of LOW_MEMORY_CHUNKSIZE values and the discretization error is only
+#    collected as running statistics (ut.RunningStats: count, mean, std, min, max) instead of two extra columns
+# The peak stays around twice the size of the input columns.
+
+LOW_MEMORY_CHUNKSIZE = 2**20
+
+# STEP 1+2: The rows without NaN values (like df_data.dropna()) as narrow arrays
+def narrow_columns(df_data, report):
+    report.begin("STEP 1: Delete NaN values and narrow data types", len(df_data))
+    report.log("Dropping NaNs and narrowing data types...", end="")
+    mask = np.ones(len(df_data), dtype=bool)
+    for column in df_data.columns:
+        mask &= df_data[column].notna().to_numpy()
+    columns = {
+        'latitudes': df_data['Latitude'].to_numpy()[mask].astype(np.float32),
+        'longitudes': df_data['Longitude'].to_numpy()[mask].astype(np.float32),
+        'years': df_data['Year'].to_numpy()[mask].astype(np.uint16),
+        'months': df_data['Month'].to_numpy()[mask].astype(np.uint8),
+        'temperatures': df_data['AverageTemperature'].to_numpy()[mask].astype(np.float32)
+    }
+    if 'AverageTemperatureUncertainty' in df_data.columns:
+        columns['uncertainties'] = df_data['AverageTemperatureUncertainty'].to_numpy()[mask].astype(np.float32)
+    else:
+        columns['uncertainties'] = np.zeros(len(columns['temperatures']), dtype=np.float32)
+    report.log(f" -> removed {len(df_data) - len(columns['temperatures'])} rows")
+    report.end(len(columns['temperatures']))
+    return columns
+
+# discretize_temperatures in chunks. Returns the discretized temperatures (already in temperature_dtype) and the
+# running statistics of the discretization error with and without the uncertainty.
+def discretize_chunked(temperatures, uncertainties, temperaturebounds, bc_temperature):
+    distemps = np.empty(len(temperatures), dtype=temperature_dtype(bc_temperature))
+    stats_error = ut.RunningStats()
+    stats_error_unc = ut.RunningStats()
+    for start in range(0, len(temperatures), LOW_MEMORY_CHUNKSIZE):
+        part = slice(start, start + LOW_MEMORY_CHUNKSIZE)
+        bounds = {key: value if np.isscalar(value) else value[part] for key, value in temperaturebounds.items()}
+        distemps[part] = discretize_temperatures(temperatures[part], bounds, bc_temperature)
+        errors = np.abs(temperatures[part] - undiscretize_temperatures(distemps[part], bounds, bc_temperature))
+        stats_error.update(errors)
+        stats_error_unc.update(np.maximum(errors - uncertainties[part], 0.0))
+    return distemps, stats_error, stats_error_unc
+
+# STEP 3-5 on the arrays of narrow_columns (the arrays inside columns get replaced). Returns the sorted and merged rows
+# (temperatures, uncertainties, years, months, dms, locids, ctilbids), the CTILBs/locations and the datebounds.
+# They don't depend on the discretization, so several files can be built out of them (see compress_variants.py).
+def prepare_columns(columns, location_order, report):
+    log = report.log
+    count = len(columns['temperatures'])
+
+    ### STEP 3: Create ID column for Location
+    report.begin("STEP 3: Create location ID", count)
+    log("Creating location ID...", end="")
+    locids, latitudes, longitudes = location_index(columns.pop('latitudes'), columns.pop('longitudes'), location_order)
+    log(f" -> Found {len(latitudes)} distinct locations")
+    report.end(count)
 
-compression_methods = {
-    'none': 0,
-    'lzma': 1
-}
+    ### STEP 4: Sort by locid, Year and Month and average rows with same Year, Month and locid
+    report.begin("STEP 4: Merge rows with same year, month and locid", count)
+    log("Merging rows with same year, month and locid...", end="")
+    years, months = columns.pop('years'), columns.pop('months')
+    datebounds = get_datebounds(years, months)
+    dms = month_differences(years, months, datebounds)
+    order, row_starts, ctilbids, ctilb_starts, location_starts = row_index(locids, dms)
+    temperatures = group_mean_float32(columns.pop('temperatures')[order], row_starts)
+    uncertainties = group_mean_float32(columns.pop('uncertainties')[order], row_starts)
+    rows = order[row_starts]
+    del order, row_starts
+    locids, years, months, dms = locids[rows], years[rows], months[rows], dms[rows]
+    del rows
+    if dms.max() < 2**16:
+        dms = dms.astype(np.uint16)
+    log(f" -> merged {count - len(temperatures)} rows")
+    count = len(temperatures)
+    report.end(count)
+
+    ### STEP 5: Create CTILB IDs (done by row_index)
+    log(f"Found {len(ctilb_starts)} distinct continous temperature index blocks")
+
+    return {
+        'datebounds': datebounds,
+        'locids': locids,
+        'ctilbids': ctilbids,
+        'location_starts': location_starts,
+        'ctilb_starts': ctilb_starts,
+        'years': years,
+        'months': months,
+        'dms': dms,
+        'latitudes': latitudes,
+        'longitudes': longitudes,
+        'temperatures': temperatures,
+        'uncertainties': uncertainties
+    }
+
+# STEP 6+7 on the rows of prepare_columns (which stay unchanged). Returns the same columns as prepare_frame.
+def discretize_columns(rows, quantization, discretizeresolution, max_error, max_error_relative_to_uncertainty, report):
+    log = report.log
+    temperatures, uncertainties = rows['temperatures'], rows['uncertainties']
+    locids, ctilbids = rows['locids'], rows['ctilbids']
+    location_starts, ctilb_starts = rows['location_starts'], rows['ctilb_starts']
+    count = len(temperatures)
+
+    ### STEP 6: Get Header-Data
+    report.begin("STEP 6: Get header data", count)
+    log("Get Header-Data...")
+    temperaturebounds = {
+        "db_min_temp": temperatures.min().item(),
+        "db_max_temp": temperatures.max().item()
+    }
+    log_header(report, count, len(location_starts), len(ctilb_starts), rows['datebounds'], temperaturebounds, discretizeresolution)
+    report.end(count)
+
+    ### STEP 7: Discretize Temperature using Min/Max Normalization (see prepare_frame)
+    report.begin("STEP 7: Discretize temperatures", count)
+    log("Discretize Temperature...")
+    bd_quantization = None
+    distempbounds = temperaturebounds
+    if quantization != "global":
+        bd_quantization = quantization_bounds(temperatures, location_starts if quantization == "location" else ctilb_starts)
+        distempbounds = group_temperaturebounds(bd_quantization, locids if quantization == "location" else ctilbids)
+    for bc_temperature in ([discretizeresolution] if max_error is None else [1, 2, 4]):
+        distemps, stats_error, stats_error_unc = discretize_chunked(temperatures, uncertainties, distempbounds, bc_temperature)
+        if max_error is None:
+            break
+        error = (stats_error_unc if max_error_relative_to_uncertainty else stats_error).max
+        log(f" -> bc_temperature={bc_temperature} ({quantization}): max. error {error:.4f} (target {max_error})")
+        if error <= max_error:
+            break
+    else:
+        raise Exception(f"The discretization error can't meet max_error={max_error} (max. error with 4 byte: {error})")
+    stats = pd.DataFrame({'Discretization error': stats_error.describe(), 'Discretization error with Uncertainty': stats_error_unc.describe()})
+    log(stats)
+    report.info.update({'bc_temperature': bc_temperature, 'discretization error': stats.to_dict()})
+    report.end(count)
+
+    return {
+        'datebounds': rows['datebounds'],
+        'temperaturebounds': temperaturebounds,
+        'bc_temperature': bc_temperature,
+        'locids': locids,
+        'ctilbids': ctilbids,
+        'location_starts': location_starts,
+        'ctilb_starts': ctilb_starts,
+        'years': rows['years'],
+        'months': rows['months'],
+        'dms': rows['dms'],
+        'latitudes': rows['latitudes'],
+        'longitudes': rows['longitudes'],
+        'distemps': distemps,
+        'distempbounds': distempbounds,
+        'bd_quantization': bd_quantization
+    }
 
-bd_buffer_compressed = None
 
 # === INPUT LAYOUT ===
+# Either a pandas frame or the path to a parquet store (see parquet_store.py). Of a store only the columns below
+# are read and the years/bbox filters are pushed down into the scan.
 # The pandas frame has to contain at least the following columns:
 #  - Latitude, Longitude: Latitude und Longitude in degree floats format
 #  - AverageTemperature: The average temperature of this record
@@ -27,6 +425,7 @@ bd_buffer_compressed = None
 # Additionally the following can be provided
 #  - AverageTemperatureUncertainty: The uncertainty for this record.
 #  - Interpolated: A boolean value indicating wether this value is actually calculated
+# Instead of the data the rows of prepare_columns can be passed (STEP 1-5 are skipped, see compress_variants.py).
 
 ##### === OUTPUT BINARY FILE LAYOUT (VERSION 3) ===
 ##### Some indices-representations are dependend on the amount of entries in
@@ -37,7 +436,8 @@ bd_buffer_compressed = None
 #
 ### FILE IDENTIFICATION [4 byte]
 # 3 byte, str(ASCII), fileidentification = 'CCE' = x434345 = 4408133
-# 1 byte, u8, fileversion = FILEVERSION
+# 1 byte, u8, fileversion = FILEVERSION (4), or FILEVERSION_EXTENDED (5) if any file_flags are set
+#   (FILEVERSION_SEGMENTED (6) is the appendable layout of cce_segments.py)
 #
 ### HEADER [28 byte]
 # 4 byte, u32, count_temperatures, (max. ~2.1 billion)
@@ -52,10 +452,32 @@ bd_buffer_compressed = None
 #   - f32, db_min_temp, minimum temperature value in database
 #   - f32, db_max_temp, maximum temperature value in database
 # 1 byte, u8, bc_temperature [A], Discretize-Resolution
-# 1 byte, u8, file_compression, How are the TEMPERATURES, CTILBS, LOCATIONS compressed? [0=No compression, 1=LZMA]
+# 1 byte, u8, file_compression, How are the TEMPERATURES, CTILBS, LOCATIONS compressed? [0=No compression, 1=LZMA, 2=LZMA blocks, 3=LZ4 frame, 4=ZSTD, 5=ZSTD blocks]
+#
+### HEADER EXTENSION [4 byte] (only fileversion 5)
+# 4 byte, u32, file_flags, Bitfield of optional features (see file_flags in cce_format.py)
+#   - bit 0-2: Filters applied onto the TEMPERATURES (delta_year, delta_month, shuffle; see cce_filters.py)
+#   - bit 3-4: Quantization of the TEMPERATURES per location (bit 3) or per CTILB (bit 4), bounds inside the QRNG section
+#   - bit 5-7: Precomputed aggregates (prefix, yearly, monthly; see cce_aggregates.py)
+#   - bit 8: kd-tree over the locations (KDTR section; see cce_spatial.py)
+#   - bit 9: time-major layout of the TEMPERATURES (see cce_layout.py)
+#
+### DICTIONARY [(4+dictionary_size) byte] (only for file_compression = 5)
+# 4 byte, u32, dictionary_size, Size of the trained zstd dictionary which is used for every block (0 = no dictionary)
+# dictionary_size byte, dictionary
+#
+### BLOCK INDEX [(8+8*(count_blocks+1)) byte] (only for file_compression = 2, 5)
+# 4 byte, u32, block_size, Uncompressed byte size of every block (the last one may be smaller)
+# 4 byte, u32, count_blocks
+# 8*(count_blocks+1) byte, u64, block_offsets, Start of every compressed block relative to the end of the block index (last entry = end of last block)
+# The TEMPERATURES, CTILBS and LOCATIONS are split into blocks of block_size bytes which are compressed
+# independently (LZMA1 like file_compression = 1 or ZSTD frames). A reader can decompress them in parallel
+# or only the blocks covering the byte-range it needs.
 #
 ### TEMPERATURES [(A*count_temperatures) byte]
-# A byte, u8|u16|u32, Discretized temperature value
+# A byte, u8|u16|u32, Discretized temperature value (encoded by the filters in file_flags)
+# With the time-major layout (file_flags bit 9) the section is a dense matrix of count_months*count_locations
+# values instead (row = month, column = location; missing values are 0, see the VALD section).
 # 
 ### CTILBS [8*count_ctilb]
 # 4 byte, u32, first_month, The first month of this chunk (in month difference to datebounds.first)
@@ -67,17 +489,87 @@ bd_buffer_compressed = None
 #   - f32, longitude
 # 4 byte, u32, id_ctilb_min, First index in ctilb-list belonging to this location (inklusive)
 # 
+### SECTIONS (only fileversion 5, optional, until the end of the payload)
+# 4 byte, str(ASCII), tag
+# 4 byte, u32, size
+# size byte, data
+#
+### QRNG section [8*count_locations or 8*count_ctilb byte] (only file_flags bit 3 or 4)
+# 8 byte, temperaturebounds of the location/CTILB, used instead of the ones of the header for (un)discretization
+#   - f32, min_temp
+#   - f32, max_temp (> min_temp)
+#
+### APFX section [8*(count_temperatures+1) byte] (only file_flags bit 5)
+# 8 byte, f64, Sum of all (undiscretized) temperatures before this index (first entry = 0)
+#
+### AYIX section [8*count_locations byte] (only file_flags bit 6 or 7)
+# 4 byte, u32, first_year, First year of this location
+# 4 byte, u32, id_row_min, First row in AYRS/AMON belonging to this location (one row per year until its last year)
+#
+### AYRS section [12*(count_rows+1) byte] (only file_flags bit 6), AMON section [12*12*(count_rows+1) byte] (only file_flags bit 7)
+# Cumulative over all rows before this row (first row = 0), AMON has one entry per calendar month in every row
+# 8 byte, f64, sum, Sum of the (undiscretized) temperatures
+# 4 byte, u32, count, Amount of temperatures
+#
+### VALD section [ceil(count_months*count_locations/8) byte] (only file_flags bit 9)
+# Validity bitmap of the time-major matrix (same order, 1 = value exists, most significant bit first)
+#
+### KDTR section [20*count_locations byte] (only file_flags bit 8)
+# Balanced kd-tree over the locations in pre-order (root = first node), split alternately by x and y (x first)
+# 8 byte, position
+#   - f32, x, longitude
+#   - f32, y, latitude
+# 4 byte, i32, left, Index of the left child node (-1 = none)
+# 4 byte, i32, right, Index of the right child node (-1 = none)
+# 4 byte, u32, id, Location id
+#
 def compress_dataset(
-        df_data,       # The pandas frame containing the data
+        df_data,       # The pandas frame containing the data, the path to a parquet store or the rows of prepare_columns
         output_path,        # Directory on where to save the output data
         filename = "auto",   # Filename for the compressed data-file. Auto for generated name
         discretizeresolution = 2,   # byte-count for discretized temperature values. (1-4)
-        compression = "none",   # compression? (possible values: ""=="none", "lzma")
-        lzma_preset = 0       # preset for lzma compressor
+        compression = "none",   # compression? (possible values: ""=="none", "lzma", "lzma_blocks", "lz4", "zstd", "zstd_blocks")
+        lzma_preset = 0,       # preset for the compressor (lzma: 0-9, lz4: 0-16, zstd: 1-22, 0 = zstd default)
+        block_size = DEFAULT_BLOCK_SIZE,  # uncompressed bytes per block for the block-wise compressions
+        workers = None,         # amount of worker processes for the block-wise compressions (None = cpu count)
+        dictionary_size = 0,     # size of the trained dictionary for "zstd_blocks" (0 = no dictionary)
+        filters = (),           # reversible pre-filters for the temperatures (possible values: "delta_year", "delta_month", "shuffle")
+        quantization = "global",    # bounds for the discretization (possible values: "global", "location", "ctilb")
+        max_error = None,       # maximum absolute discretization error. If set, the smallest byte-count (1, 2, 4) meeting it is used instead of discretizeresolution
+        max_error_relative_to_uncertainty = False,  # measure max_error against the error exceeding AverageTemperatureUncertainty (disErrorUnc)
+        aggregates = (),        # precomputed temporal aggregates (possible values: "prefix", "yearly", "monthly")
+        location_order = "latlon",  # order of the location ids (possible values: "latlon", "hilbert", "morton")
+        kdtree = False,         # store a balanced kd-tree over the locations (KDTR section)
+        layout = "location",    # layout of the TEMPERATURES (possible values: "location", "time", "auto" = by density, see cce_layout.py)
+        years = None,           # only use the records of this year range (first, last), inclusive
+        bbox = None,            # only use the locations inside this box (lat_min, lat_max, lon_min, lon_max), inclusive
+        quiet = False,          # no progress output (print/tqdm), e.g. for batch jobs
+        report_memory = "rss",  # how the peak memory of every stage is measured (possible values: "rss", "tracemalloc", None; see cce_report.py)
+        report_path = None,     # optional path of a json file for the report
+        return_report = False,  # return (df, report) instead of df
+        low_memory = False      # process narrow numpy arrays instead of a frame with all intermediate columns (no frame is returned, see prepare_columns)
 ):
-    if not isinstance(df_data, pd.DataFrame):
-        raise Exception("df_data has to be a dataframe")
-    if not {'Latitude', 'Longitude', 'AverageTemperature', 'Year', 'Month'}.issubset(df_data.columns):
+    if not report_memory in memory_modes:
+        raise Exception(f"Unsupported memory mode ({report_memory})")
+    report = CompressReport(quiet, report_memory)
+    log = report.log
+    prepared = isinstance(df_data, dict)
+    if prepared and (years is not None or bbox is not None):
+        raise Exception("years/bbox can't be applied to prepared rows")
+    if isinstance(df_data, (str, os.PathLike)):
+        from parquet_store import read_store
+        report.begin("STEP 0: Read parquet store")
+        log("Reading parquet store...", end="")
+        df_data = read_store(df_data, columns=input_columns, years=years, bbox=bbox)
+        log(f" -> {len(df_data)} rows")
+        report.end(len(df_data))
+    elif years is not None or bbox is not None:
+        report.begin("STEP 0: Filter rows", len(df_data))
+        df_data = filter_dataset(df_data, years, bbox)
+        report.end(len(df_data))
+    if not prepared and not isinstance(df_data, pd.DataFrame):
+        raise Exception("df_data has to be a dataframe, the path to a parquet store or the rows of prepare_columns")
+    if not prepared and not {'Latitude', 'Longitude', 'AverageTemperature', 'Year', 'Month'}.issubset(df_data.columns):
         raise Exception("A necessary column is missing inside the dataframe")
     if not os.path.exists(output_path):
         raise Exception(f"Directory  '{output_path}' does not exist")
@@ -87,172 +579,162 @@ def compress_dataset(
         compression = "none"
     if not compression in compression_methods:
         raise Exception(f"Unsupported compression type ({compression})")
+    if not set(filters).issubset(temperature_filters):
+        raise Exception(f"Unsupported temperature filters ({', '.join(set(filters) - set(temperature_filters))})")
+    if not quantization in quantization_modes:
+        raise Exception(f"Unsupported quantization ({quantization})")
+    if not set(aggregates).issubset(aggregate_types):
+        raise Exception(f"Unsupported aggregates ({', '.join(set(aggregates) - set(aggregate_types))})")
+    if not location_order in location_orders:
+        raise Exception(f"Unsupported location order ({location_order})")
+    if not layout in layouts:
+        raise Exception(f"Unsupported layout ({layout})")
+    if layout == "time" and filters:
+        raise Exception("The temperature filters are only supported by the location layout")
+    if max_error is not None and max_error <= 0.0:
+        raise Exception("max_error has to be positive")
+    if "shuffle" in filters and discretizeresolution == 1 and max_error is None:
+        log("Note: The shuffle filter has no effect on 1 byte temperatures and will be ignored")
+        filters = [name for name in filters if name != "shuffle"]
 
-    ### STEP 1: Delete all NaN values
-    print("Dropping NaNs...", end="")
-    df = df_data.dropna().reset_index(drop=True)
-    print(f" -> removed {len(df_data) - len(df)} rows")
+    ### STEP 1-7: Prepare the data (see prepare_frame and prepare_columns/discretize_columns)
+    if prepared:
+        # STEP 1-5 are already done (location_order and low_memory have no effect anymore)
+        df = None
+        columns = discretize_columns(df_data, quantization, discretizeresolution, max_error, max_error_relative_to_uncertainty, report)
+    elif low_memory:
+        columns = narrow_columns(df_data, report)
+        df = df_data = None # Frees the frame read from a parquet store
+        columns = prepare_columns(columns, location_order, report)
+        columns = discretize_columns(columns, quantization, discretizeresolution, max_error, max_error_relative_to_uncertainty, report)
+    else:
+        df, columns = prepare_frame(df_data, location_order, quantization, discretizeresolution, max_error, max_error_relative_to_uncertainty, report)
+    datebounds, temperaturebounds, bc_temperature = columns['datebounds'], columns['temperaturebounds'], columns['bc_temperature']
+    locids, ctilbids = columns['locids'], columns['ctilbids']
+    location_starts, ctilb_starts = columns['location_starts'], columns['ctilb_starts']
+    count_temperatures, count_locations, count_ctilb = len(locids), len(location_starts), len(ctilb_starts)
+    bd_quantization = columns['bd_quantization']
+    if max_error is not None and "shuffle" in filters and bc_temperature == 1:
+        filters = [name for name in filters if name != "shuffle"]
 
-    ### STEP 2: Convert data to correct representation
-    print("Converting data types...")
-    if not 'AverageTemperatureUncertainty' in df_data.columns: 
-        df['AverageTemperatureUncertainty'] = np.nan
-    if not 'Interpolated' in df_data.columns:
-        df['Interpolated'] = False
-    df = df.astype({
-        'Latitude': np.float32, 
-        'Longitude': np.float32,
-        'Year': np.uint32,
-        'Month': np.uint32,
-        'AverageTemperature': np.float32,
-        'AverageTemperatureUncertainty': np.float32,
-        'Interpolated': bool
-    })
+    ### STEP 8: Get Binary data
+    report.begin("STEP 8: Build binary sections", count_temperatures)
+    # FILE IDENTIFICATION + HEADER [32 byte]
+    flags = filter_flags(filters)
+    if bd_quantization is not None:
+        flags |= file_flags['quantization_' + quantization]
+    flags |= aggregate_flags(aggregates)
+    if kdtree:
+        flags |= file_flags['spatial_kdtree']
+    count_months = columns['dms'].max().item() + 1
+    if layout == "auto":
+        layout = "location" if filters else choose_layout(layout, count_temperatures, count_locations, count_months)
+        log(f"Layout: {layout} (density {layout_density(count_temperatures, count_locations, count_months):.3f})")
+    if layout == "time":
+        flags |= file_flags['layout_time_major']
+    bd_header = pack_header(count_temperatures, count_locations, count_ctilb, datebounds, temperaturebounds, bc_temperature, compression_methods[compression], flags)
 
-    ### STEP 3: Create ID column for Location
-    print("Creating location ID...", end="")
-    df['locid'] = df.groupby(["Latitude", "Longitude"]).ngroup().astype(np.uint32)
-    print(f" -> Found {df['locid'].max() + 1} distinct locations")
-
-    ### STEP 4: Average Rows with same Year, Month and locid
-    print("Merging rows with same year, month and locid...", end="")
-    df_tmp = df.groupby(['locid', 'Year', 'Month']) \
-        .agg(AverageTemperature=('AverageTemperature', 'mean'),AverageTemperatureUncertainty=('AverageTemperatureUncertainty', 'mean'), Latitude=('Latitude', 'first'), Longitude=('Longitude', 'first'), Interpolated=('Interpolated', 'any') ) \
-       .reset_index()
-    print(f" -> merged {len(df) - len(df_tmp)} rows")
-    df = df_tmp
+    # Every section is built as one (structured) big endian array.
 
-    ### STEP 5: Create CTILB IDs
-    print("Creating CTILB ID...", end="")
-    df.sort_values(by=["locid","Year","Month"], inplace=True)
-    df['ctilbid'] = ((df['Year'] - df['Year'].shift(1)) * 12 + (df['Month'] - df['Month'].shift(1)) + (df['locid'] - df['locid'].shift(1)) * 100000) - 1
-    df.loc[df['ctilbid'] != 0.0, "ctilbid"] = 1.0
-    df.loc[df['ctilbid'] == 0.0, "ctilbid"] = np.nan
-    df_part = df.loc[df['ctilbid'] > 0.0, "ctilbid"] 
-    df.loc[df['ctilbid'] > 0.0, "ctilbid"] = pd.Series(np.arange(df_part.size), df_part.index) 
-    df['ctilbid'] = df['ctilbid'].fillna(method="ffill").astype(np.uint32)
-    print(f" -> Found {df['ctilbid'].max() + 1} distinct continous temperature index blocks")
+    # TEMPERATURES [(A*count_temperatures) byte] or [(A*count_months*count_locations) byte] (time-major)
+    bd_temperatures = columns['distemps']
+    if layout == "time":
+        bd_temperatures, bd_validity = build_time_major(bd_temperatures, columns['dms'], locids, count_months, count_locations, bc_temperature)
+        bd_temperatures = bd_temperatures.ravel()
+    if flags & FILTER_FLAGS_MASK:
+        bd_temperatures = np.frombuffer(encode_temperatures(bd_temperatures, ctilb_starts, bc_temperature, flags), dtype=np.uint8)
+    log(f"== TEMPERATURES ==\n -> Wrote {bd_temperatures.nbytes} Bytes of data" + (f" (filters: {', '.join(filters)})" if flags & FILTER_FLAGS_MASK else ""))
 
-    ### STEP 5b: Create ID-Column
-    df['id'] = df.index
+    # CTILBS [(8)*count_ctilb]
+    bd_ctilbs = np.empty(len(ctilb_starts), dtype=CTILB_DTYPE)
+    bd_ctilbs['first_month'] = columns['dms'][ctilb_starts]
+    bd_ctilbs['id_temp_min'] = ctilb_starts # The id of a temperature is its row
+    log(f"== CTILBS ==\n -> Wrote {bd_ctilbs.nbytes} Bytes of data")
 
-    ### STEP 6: Get Header-Data and create dm column
-    #df['date'] = pd.to_datetime(dict(year=df.Year, month=df.Month, day=1)) Create Date-Column (kinda slow)
-    print("Get Header-Data...")
-    count_temperatures = len(df)
-    count_locations = df['locid'].max().item() + 1
-    count_ctilb = df['ctilbid'].max().item() + 1
-    datebounds = {
-        "db_first_year": df['Year'].min().item(),
-        "db_last_year": df['Year'].max().item()
-    }
-    datebounds['db_first_month'] = df.loc[df['Year']==datebounds["db_first_year"], 'Month'].min().item()
-    datebounds['db_last_month'] =  df.loc[df['Year']==datebounds["db_last_year"],'Month'].max().item()
-    temperaturebounds = {
-        "db_min_temp": df['AverageTemperature'].min().item(),
-        "db_max_temp": df['AverageTemperature'].max().item()
-    }
-    print("Create DM-Column...")
-    df['dm'] = (df['Year'] - datebounds['db_first_year']) * 12 + df['Month'] - datebounds['db_first_month']
-    getByteCountForIndex = lambda size: math.ceil(math.log2(size) / 8.0)
-    getByteCountForMonthDifference = lambda db:  getByteCountForIndex((db["db_last_month"] - db["db_first_month"] + (db["db_last_year"] - db["db_first_year"]) * 12) + 1)
-    bc_temperature = discretizeresolution
-    print("== HEADER ==")
-    print(f" -> Counts: Temperatures={count_temperatures}; Locations={count_locations}; CTILBs={count_ctilb}")
-    print(" -> Datebounds: ", datebounds)
-    print(" -> Temperaturebounds: ", temperaturebounds)
-    print(f" -> Byte-Counts: bc_temperature={bc_temperature}")
+    # LOCATIONS [(12)*count_locations) byte]
+    bd_locations = np.empty(len(location_starts), dtype=LOCATION_DTYPE)
+    bd_locations['latitude'] = columns['latitudes']
+    bd_locations['longitude'] = columns['longitudes']
+    bd_locations['id_ctilb_min'] = ctilbids[location_starts]
+    log(f"== LOCATIONS ==\n -> Wrote {bd_locations.nbytes} Bytes of data")
 
-    ### STEP 7: Discretize Temperature using Min/Max Normalization
-    print("Discretize Temperature...")
-    max_temperature_dis = 2**(bc_temperature*8)-1
-    df['disTemp'] = (((df['AverageTemperature'] - temperaturebounds['db_min_temp'])/(temperaturebounds['db_max_temp']-temperaturebounds['db_min_temp'])) * max_temperature_dis).astype(np.uint32)
-    df['disError'] = (df['AverageTemperature'] - ((df['disTemp'].astype(np.float32) / max_temperature_dis) * (temperaturebounds['db_max_temp']-temperaturebounds['db_min_temp']) + temperaturebounds['db_min_temp'])).abs()
-    df.loc[np.isnan(df['AverageTemperatureUncertainty']), "AverageTemperatureUncertainty"] = 0.0
-    df['disErrorUnc'] = df['disError'] - df['AverageTemperatureUncertainty']
-    df.loc[df['disErrorUnc'] < 0.0, 'disErrorUnc'] = 0.0
-    stats = df[['disError', 'disErrorUnc']].rename(columns={'disError': 'Discretization error', 'disErrorUnc': 'Discretization error with Uncertainty'}).describe()
-    print(stats)
+    bd_sections = [bd_temperatures, bd_ctilbs, bd_locations]
 
-    ### STEP 8: Get Binary data
-    bd_header = bytearray()
-
-    # FILE IDENTIFICATION [4 byte]
-    bd_header.extend(bytes("CCE", "ascii"))
-    bd_header.extend(FILEVERSION.to_bytes(1, "big", signed=False))
-
-    # HEADER [30 byte]
-    bd_header.extend(count_temperatures.to_bytes(4, "big", signed=False))
-    bd_header.extend(count_locations.to_bytes(4, "big", signed=False))
-    bd_header.extend(count_ctilb.to_bytes(4, "big", signed=False))
-    bd_header.extend(datebounds['db_first_year'].to_bytes(2, "big", signed=False))
-    bd_header.extend(datebounds['db_first_month'].to_bytes(1, "big", signed=False))
-    bd_header.extend(datebounds['db_last_year'].to_bytes(2, "big", signed=False))
-    bd_header.extend(datebounds['db_last_month'].to_bytes(1, "big", signed=False))
-    bd_header.extend(struct.pack(">f", temperaturebounds['db_min_temp']))
-    bd_header.extend(struct.pack(">f", temperaturebounds['db_max_temp']))
-    bd_header.extend(bc_temperature.to_bytes(1, "big", signed=False))
-    bd_header.extend(compression_methods[compression].to_bytes(1, "big", signed=False))
-
-    bd_buffer = bytearray()
-
-    # TEMPERATURES [(A*count_temperatures) byte]
-    oldByteLength = len(bd_buffer)
-    bd_buffer.extend(df['disTemp'].to_numpy(dtype=f'>u{bc_temperature}').tobytes())
-    print(f"== TEMPERATURES ==\n -> Wrote {len(bd_buffer) - oldByteLength} Bytes of data")
+    # QRNG [8+8*count_locations or 8+8*count_ctilb] (only quantization "location"/"ctilb")
+    if bd_quantization is not None:
+        bd_sections.append(np.frombuffer(pack_section('QRNG', bd_quantization.tobytes()), dtype=np.uint8))
+        log(f"== QRNG ==\n -> Wrote {bd_sections[-1].nbytes} Bytes of data")
 
-    # CTILBS [(8)*count_ctilb]
-    oldByteLength = len(bd_buffer)
-    df_ctilb = df.groupby(['ctilbid']).agg(first_month=('dm', 'first'), id_temp_min=('id', 'first'))
-    for row in tqdm(df_ctilb.itertuples(index=False, name=None), desc="Writing CTILB-Table"):
-        bd_buffer.extend(row[0].to_bytes(4, "big", signed=False))
-        bd_buffer.extend(row[1].to_bytes(4, "big", signed=False))
-    print(f"== CTILBS ==\n -> Wrote {len(bd_buffer) - oldByteLength} Bytes of data")
-    
-    # LOCATIONS [(12)*count_locations) byte]
-    oldByteLength = len(bd_buffer)
-    df_locations = df.groupby(['locid']).agg(latitude=('Latitude', 'first'), longitude=('Longitude', 'first'), id_ctilb_min=('ctilbid', 'first'))
-    for row in tqdm(df_locations.itertuples(index=False, name=None), desc="Writing Position-Table"):
-        bd_buffer.extend(struct.pack(">f", row[0]))
-        bd_buffer.extend(struct.pack(">f", row[1]))
-        bd_buffer.extend(row[2].to_bytes(4, "big", signed=False))
-    print(f"== LOCATIONS ==\n -> Wrote {len(bd_buffer) - oldByteLength} Bytes of data")
+    # APFX, AYIX, AYRS, AMON (only aggregates)
+    bd_aggregates = []
+    if aggregates:
+        temperatures_undiscretized = undiscretize_temperatures(columns['distemps'], columns['distempbounds'], bc_temperature)
+        bd_aggregates = [np.frombuffer(section, dtype=np.uint8) for section in build_aggregate_sections(temperatures_undiscretized, columns['years'], columns['months'], location_starts, aggregates)]
+    if bd_aggregates:
+        bd_sections += bd_aggregates
+        log(f"== AGGREGATES ==\n -> Wrote {sum(section.nbytes for section in bd_aggregates)} Bytes of data ({', '.join(aggregates)})")
+    # KDTR [8+20*count_locations] (only kdtree)
+    if kdtree:
+        bd_kdtree = build_kdtree(bd_locations['latitude'], bd_locations['longitude'])
+        bd_sections.append(np.frombuffer(pack_section('KDTR', bd_kdtree.tobytes()), dtype=np.uint8))
+        log(f"== KDTR ==\n -> Wrote {bd_sections[-1].nbytes} Bytes of data")
+
+    # VALD [8+ceil(count_months*count_locations/8)] (only time-major)
+    if layout == "time":
+        bd_sections.append(np.frombuffer(pack_section('VALD', bd_validity.tobytes()), dtype=np.uint8))
+        log(f"== VALD ==\n -> Wrote {bd_sections[-1].nbytes} Bytes of data")
+
+    bd_buffer_size = sum(section.nbytes for section in bd_sections)
+    report.end(count_temperatures)
 
     ### STEP 9: Check file size for plausibility
+    report.begin("STEP 9: Check file size")
     def calculateTheoreticalFileSize(count_temperatures, count_locations, count_ctilb, A):
-        return 32 + A*count_temperatures + (8)*count_ctilb + (12)*count_locations
+        size_quantization = 0 if bd_quantization is None else 8 + 8*len(bd_quantization)
+        size_aggregates = sum(section.nbytes for section in bd_aggregates)
+        size_kdtree = 8 + 20*count_locations if kdtree else 0
+        if layout == "time":
+            return len(bd_header) + A*count_months*count_locations + (8)*count_ctilb + (12)*count_locations + size_quantization + size_aggregates + size_kdtree + 8 + math.ceil(count_months*count_locations/8)
+        return len(bd_header) + A*count_temperatures + (8)*count_ctilb + (12)*count_locations + size_quantization + size_aggregates + size_kdtree
     expectedSize = calculateTheoreticalFileSize(count_temperatures,count_locations,count_ctilb,bc_temperature)
-    if ((len(bd_buffer) + len(bd_header)) != expectedSize):
-        raise Exception(f"Binary Data Size is incosistent. Expected: {expectedSize} Bytes, Actual: {len(bd_buffer) + len(bd_header)}")
-
-    ### STEP 10: Compress binary data using LZMA (if required):
-    def compress_file_async_lzma(data, preset):
-        global bd_buffer_compressed
-        # NOTE: LZMA2 and XZ not supported by JS Implementation. Also different dict_size than standard (64MByte) not supported.
-        # NOTE: The new version actually might support it
-        my_filters = [{"id": lzma.FILTER_LZMA1, "preset": preset }]
-        bd_buffer_compressed = lzma.compress(data, format=lzma.FORMAT_ALONE, filters=my_filters)
-
-    if compression == "lzma":
-        thread = threading.Thread(target=compress_file_async_lzma, args=[bd_buffer, lzma_preset])
-        thread.start()
-        progressbar = tqdm(unit=" seconds", unit_scale=True, desc="Compressing binary data...", bar_format=r'{desc} [{elapsed}]')
-        while thread.is_alive():
-            progressbar.update(0.03)
-            time.sleep(0.03)
-        progressbar.close()
+    if ((bd_buffer_size + len(bd_header)) != expectedSize):
+        raise Exception(f"Binary Data Size is incosistent. Expected: {expectedSize} Bytes, Actual: {bd_buffer_size + len(bd_header)}")
+
+    ### STEP 10: Compress binary data (if required):
+    if compression != "none":
+        report.begin("STEP 10: Compress binary data")
+        log(f"Compressing binary data ({compression})...", end="")
+        start = time.perf_counter()
+        bd_payload = compress_payload(b"".join(section.tobytes() for section in bd_sections), compression, lzma_preset, block_size, workers, dictionary_size, progress=not quiet)
+        log(f" -> {len(bd_payload)} Bytes [{time.perf_counter() - start:.2f}s]")
 
     ### STEP 11: Output file
-    filepath = f"{output_path}/{filename}"
-    if filename == "auto":
-        filepath = f"{output_path}/t{ut.formatUIntNumber(count_temperatures)}_c{ut.formatUIntNumber(count_ctilb)}_l{ut.formatUIntNumber(count_locations)}_{discretizeresolution}b_{compression}.cce"
-    
+    report.begin("STEP 11: Write file")
+    filepath = get_output_filepath(output_path, filename, count_temperatures, count_ctilb, count_locations, bc_temperature, compression)
+
     with open(filepath, "wb") as file:
         file.write(bd_header)
         if compression == "none":
-            file.write(bd_buffer)
+            for section in bd_sections:
+                section.tofile(file)
         else:
-            file.write(bd_buffer_compressed)
+            file.write(bd_payload)
+
+    # Bytes written per section (uncompressed, the compressed payload is listed separately)
+    report.section("HEADER", len(bd_header))
+    for name, section in zip(['TEMPERATURES', 'CTILBS', 'LOCATIONS'], bd_sections[:3]):
+        report.section(name, section.nbytes)
+    for section in bd_sections[3:]:
+        report.section(section[:4].tobytes().decode("ascii"), section.nbytes)
+    if compression != "none":
+        report.section(f"PAYLOAD ({compression})", len(bd_payload))
+    report.info.update({'file': filepath, 'file size': os.path.getsize(filepath), 'layout': layout, 'compression': compression})
+    report.close()
+    if report_path is not None:
+        report.to_json(report_path)
 
     #ut.df_print_rows(df.loc[df['disTemp'] == df['disTemp'].min()], 400)
+    # df is None in the low memory mode and for prepared rows
+    if return_report:
+        return df, report
     return df
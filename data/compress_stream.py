@@ -0,0 +1,296 @@
+import pandas as pd
+import os
+import numpy as np
+import lzma
+import tempfile
+from tqdm import tqdm
+import util as ut
+from compress import get_output_filepath, group_mean_float32, log_header
+from cce_report import CompressReport, memory_modes
+from cce_spatial import location_key, location_from_key
+from cce_format import HEADER_SIZE, CTILB_DTYPE, LOCATION_DTYPE, compression_methods, pack_header, temperature_dtype, discretize_temperatures, undiscretize_temperatures
+
+# Out-of-core variant of compress.compress_dataset. Instead of a DataFrame it accepts a path
+# (csv, parquet or parquet store) or an iterator of DataFrame chunks and never holds more than a couple of
+# chunks in memory. The output is the same FILEVERSION 4 layout as compress_dataset creates.
+#
+# === PROCESS ===
+# 1. Every chunk is cleaned (dropna, typing) and spilled into a temporary file. Meanwhile the
+#    distinct locations, the datebounds and the amount of rows get collected.
+# 2. The sorted location list defines the locid (same order as groupby(["Latitude","Longitude"]).ngroup()).
+#    Every spill file is sorted by (locid, Year, Month) and saved as a sorted run.
+# 3. The runs get merged block by block (k-way merge). Duplicates of (locid, Year, Month) get averaged
+#    and CTILBs/locations get detected on the fly. The merged temperatures and CTILBs go into temporary files.
+# 4. Header, TEMPERATURES (discretized), CTILBS and LOCATIONS get streamed into the output file.
+
+DEFAULT_CHUNKSIZE = 1000000
+
+SPILL_DTYPE = np.dtype([('lockey', '<u8'), ('ym', '<u4'), ('temp', '<f4'), ('unc', '<f4')])
+RUN_DTYPE = np.dtype([('key', '<u8'), ('temp', '<f4'), ('unc', '<f4')])
+MERGED_DTYPE = np.dtype([('temp', '<f4'), ('unc', '<f4')])
+
+necessary_columns = ['Latitude', 'Longitude', 'AverageTemperature', 'Year', 'Month']
+
+
+# Returns an iterator of DataFrames for a path to a csv/parquet file or parquet store or passes through an iterator of chunks
+def read_chunks(source, chunksize = DEFAULT_CHUNKSIZE):
+    if isinstance(source, pd.DataFrame):
+        return iter([source])
+    if not isinstance(source, (str, os.PathLike)):
+        return iter(source)
+    path = os.fspath(source)
+    if os.path.isdir(path):
+        from parquet_store import iter_store
+        return iter_store(path, columns=necessary_columns + ['AverageTemperatureUncertainty'], batch_size=chunksize)
+    if not os.path.isfile(path):
+        raise Exception(f"File '{path}' does not exist")
+    if ".parquet" in os.path.basename(path):
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(path)
+        columns = [c for c in necessary_columns + ['AverageTemperatureUncertainty'] if c in parquet_file.schema_arrow.names]
+        return (batch.to_pandas() for batch in parquet_file.iter_batches(batch_size=chunksize, columns=columns))
+    available = pd.read_csv(path, nrows=0).columns
+    columns = [c for c in necessary_columns + ['AverageTemperatureUncertainty'] if c in available]
+    return pd.read_csv(path, usecols=columns, chunksize=chunksize)
+
+
+# Merges sorted runs (memory mapped structured arrays with a 'key' field) block by block. Every
+# returned block is sorted and all entries of one key are guaranteed to be inside the same block.
+def merge_sorted_runs(runs, blocksize):
+    buffers = [np.array(run[:blocksize]) for run in runs]
+    cursors = [len(buffer) for buffer in buffers]
+
+    def read_block(i):
+        block = np.array(runs[i][cursors[i]:cursors[i] + blocksize])
+        cursors[i] += len(block)
+        return block
+
+    while any(len(buffer) > 0 for buffer in buffers):
+        # Everything smaller than the smallest last loaded key of a not exhausted run is safe to emit
+        pending = [i for i in range(len(runs)) if cursors[i] < len(runs[i])]
+        bound_run = min(pending, key=lambda i: buffers[i]['key'][-1]) if pending else -1
+        parts = []
+        for i, buffer in enumerate(buffers):
+            n = len(buffer) if bound_run < 0 else np.searchsorted(buffer['key'], buffers[bound_run]['key'][-1], side='left')
+            if n > 0:
+                parts.append(buffer[:n])
+                buffers[i] = buffer[n:]
+        if len(parts) == 0:
+            # The whole buffer of bound_run consists of one key => load more of it
+            buffers[bound_run] = np.concatenate([buffers[bound_run], read_block(bound_run)])
+            continue
+        block = np.concatenate(parts)
+        yield block[np.argsort(block['key'], kind='stable')]
+        for i in pending:
+            if len(buffers[i]) == 0:
+                buffers[i] = read_block(i)
+
+
+# Writes raw bytes either directly or through a streaming LZMA compressor into the file
+class SectionWriter:
+    def __init__(self, file, compression, lzma_preset):
+        self.file = file
+        self.bytes_written = 0
+        self.compressor = None
+        if compression == "lzma":
+            self.compressor = lzma.LZMACompressor(format=lzma.FORMAT_ALONE, filters=[{"id": lzma.FILTER_LZMA1, "preset": lzma_preset}])
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        if self.compressor is None:
+            self.file.write(data)
+        else:
+            self.file.write(self.compressor.compress(data))
+
+    def close(self):
+        if self.compressor is not None:
+            self.file.write(self.compressor.flush())
+
+
+def compress_dataset_streaming(
+        source,       # Path to a csv/parquet file or an iterator of pandas frames (see INPUT LAYOUT in compress.py)
+        output_path,        # Directory on where to save the output data
+        filename = "auto",   # Filename for the compressed data-file. Auto for generated name
+        discretizeresolution = 2,   # byte-count for discretized temperature values. (1-4)
+        compression = "none",   # compression? (possible values: ""=="none", "lzma")
+        lzma_preset = 0,       # preset for lzma compressor
+        chunksize = DEFAULT_CHUNKSIZE,  # rows per chunk when reading from a file and per sorted run
+        temp_dir = None,       # Directory for the temporary files (None for the system default)
+        quiet = False,          # no progress output (print/tqdm), e.g. for batch jobs
+        report_memory = "rss",  # how the peak memory of every stage is measured (see compress_dataset)
+        report_path = None,     # optional path of a json file for the report
+        return_report = False   # return (filepath, report) instead of filepath
+):
+    if not os.path.exists(output_path):
+        raise Exception(f"Directory  '{output_path}' does not exist")
+    if not ( discretizeresolution == 1 or discretizeresolution == 2 or discretizeresolution == 4 ):
+        raise Exception(f"Only Discretize-Resolutions allowed are 1,2 or 4 byte")
+    if compression == "":
+        compression = "none"
+    if not compression in ("none", "lzma"):
+        raise Exception(f"Unsupported compression type ({compression})")
+    if not report_memory in memory_modes:
+        raise Exception(f"Unsupported memory mode ({report_memory})")
+    report = CompressReport(quiet, report_memory)
+    log = report.log
+
+    with tempfile.TemporaryDirectory(prefix="cce_", dir=temp_dir) as tmp:
+        ### STEP 1: Clean chunks and spill them to disk
+        report.begin("STEP 1: Clean and spill chunks")
+        spill_files = []
+        location_keys = np.empty(0, dtype=np.uint64)
+        ym_min, ym_max = np.iinfo(np.uint32).max, 0
+        rows_read = 0
+        for chunk in tqdm(read_chunks(source, chunksize), desc="Spilling chunks", unit=" chunks", disable=quiet):
+            if not set(necessary_columns).issubset(chunk.columns):
+                raise Exception("A necessary column is missing inside the dataframe")
+            rows_read += len(chunk)
+            chunk = chunk.dropna()
+            if len(chunk) == 0:
+                continue
+            spill = np.empty(len(chunk), dtype=SPILL_DTYPE)
+            spill['lockey'] = location_key(chunk['Latitude'].to_numpy(np.float32), chunk['Longitude'].to_numpy(np.float32))
+            spill['ym'] = chunk['Year'].to_numpy(np.uint32) * 12 + chunk['Month'].to_numpy(np.uint32) - 1
+            spill['temp'] = chunk['AverageTemperature'].to_numpy(np.float32)
+            spill['unc'] = chunk['AverageTemperatureUncertainty'].to_numpy(np.float32) if 'AverageTemperatureUncertainty' in chunk.columns else 0.0
+            location_keys = np.union1d(location_keys, np.unique(spill['lockey']))
+            ym_min, ym_max = min(ym_min, spill['ym'].min().item()), max(ym_max, spill['ym'].max().item())
+            spill_files.append(os.path.join(tmp, f"spill_{len(spill_files)}.npy"))
+            np.save(spill_files[-1], spill)
+        if len(spill_files) == 0:
+            raise Exception("The dataset doesn't contain any valid rows")
+        count_locations = len(location_keys)
+        log(f"Read {rows_read} rows -> Found {count_locations} distinct locations")
+        report.end(rows_read)
+
+        ### STEP 2: Create sorted runs by (locid, Year, Month)
+        report.begin("STEP 2: Sort runs")
+        run_files = []
+        for spill_file in tqdm(spill_files, desc="Sorting runs", disable=quiet):
+            spill = np.load(spill_file)
+            run = np.empty(len(spill), dtype=RUN_DTYPE)
+            run['key'] = (np.searchsorted(location_keys, spill['lockey']).astype(np.uint64) << np.uint64(32)) | spill['ym'].astype(np.uint64)
+            run['temp'] = spill['temp']
+            run['unc'] = spill['unc']
+            del spill
+            os.remove(spill_file)
+            run = run[np.argsort(run['key'], kind='stable')]
+            run_files.append(spill_file.replace("spill_", "run_"))
+            np.save(run_files[-1], run)
+        del run
+
+        ### STEP 3: Merge runs, average duplicates and detect CTILBs
+        runs = [np.load(run_file, mmap_mode='r') for run_file in run_files]
+        rows_clean = sum(len(run) for run in runs)
+        report.end(rows_clean)
+        report.begin("STEP 3: Merge runs", rows_clean)
+        merged_path = os.path.join(tmp, "merged.bin")
+        ctilb_path = os.path.join(tmp, "ctilbs.bin")
+        location_ctilb_min = np.zeros(count_locations, dtype=np.uint32)
+        count_temperatures, count_ctilb = 0, 0
+        prev_locid, prev_ym = -1, -1
+        temp_min, temp_max = np.inf, -np.inf
+        pbar = tqdm(total=rows_clean, desc="Merging runs", disable=quiet)
+        with open(merged_path, "wb") as merged_file, open(ctilb_path, "wb") as ctilb_file:
+            for block in merge_sorted_runs(runs, max(chunksize // len(runs), 1024)):
+                pbar.update(len(block))
+                keys = block['key']
+                starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+                merged = np.empty(len(starts), dtype=MERGED_DTYPE)
+                # float32 like STEP 4 of compress_dataset (the duplicates keep their input order)
+                merged['temp'] = group_mean_float32(block['temp'], starts)
+                merged['unc'] = group_mean_float32(block['unc'], starts)
+                keys = keys[starts]
+                locids = (keys >> np.uint64(32)).astype(np.int64)
+                yms = (keys & np.uint64(0xFFFFFFFF)).astype(np.int64)
+
+                new_location = locids != np.r_[prev_locid, locids[:-1]]
+                new_ctilb = new_location | (yms != np.r_[prev_ym, yms[:-1]] + 1)
+                ctilb_ids = count_ctilb + np.cumsum(new_ctilb) - 1
+                location_ctilb_min[locids[new_location]] = ctilb_ids[new_location]
+
+                ctilbs = np.empty(np.count_nonzero(new_ctilb), dtype=CTILB_DTYPE)
+                ctilbs['first_month'] = yms[new_ctilb] - ym_min
+                ctilbs['id_temp_min'] = count_temperatures + np.flatnonzero(new_ctilb)
+                ctilb_file.write(ctilbs.tobytes())
+                merged_file.write(merged.tobytes())
+
+                temp_min = min(temp_min, merged['temp'].min().item())
+                temp_max = max(temp_max, merged['temp'].max().item())
+                count_temperatures += len(merged)
+                count_ctilb += len(ctilbs)
+                prev_locid, prev_ym = locids[-1], yms[-1]
+        pbar.close()
+        runs = None
+        for run_file in run_files:
+            os.remove(run_file)
+        log(f"Merged {rows_clean - count_temperatures} rows -> Found {count_ctilb} distinct continous temperature index blocks")
+        report.end(count_temperatures)
+
+        ### STEP 4: Get Header-Data
+        datebounds = {
+            "db_first_year": ym_min // 12,
+            "db_first_month": ym_min % 12 + 1,
+            "db_last_year": ym_max // 12,
+            "db_last_month": ym_max % 12 + 1
+        }
+        temperaturebounds = {
+            "db_min_temp": temp_min,
+            "db_max_temp": temp_max
+        }
+        bc_temperature = discretizeresolution
+        log_header(report, count_temperatures, count_locations, count_ctilb, datebounds, temperaturebounds, bc_temperature)
+
+        ### STEP 5: Stream sections into the output file
+        report.begin("STEP 5: Write file", count_temperatures)
+        filepath = get_output_filepath(output_path, filename, count_temperatures, count_ctilb, count_locations, discretizeresolution, compression)
+        stats_error = ut.RunningStats()
+        stats_error_unc = ut.RunningStats()
+        with open(filepath, "wb") as file:
+            file.write(pack_header(count_temperatures, count_locations, count_ctilb, datebounds, temperaturebounds, bc_temperature, compression_methods[compression]))
+            writer = SectionWriter(file, compression, lzma_preset)
+
+            # TEMPERATURES [(A*count_temperatures) byte]
+            merged = np.memmap(merged_path, dtype=MERGED_DTYPE, mode='r')
+            for start in tqdm(range(0, count_temperatures, chunksize), desc="Writing temperatures", disable=quiet):
+                part = np.array(merged[start:start + chunksize])
+                distemps = discretize_temperatures(part['temp'], temperaturebounds, bc_temperature)
+                errors = np.abs(part['temp'] - undiscretize_temperatures(distemps, temperaturebounds, bc_temperature))
+                stats_error.update(errors)
+                stats_error_unc.update(np.maximum(errors - part['unc'], 0.0))
+                writer.write(distemps.astype(temperature_dtype(bc_temperature)).tobytes())
+            del merged
+
+            # CTILBS [(8)*count_ctilb]
+            with open(ctilb_path, "rb") as ctilb_file:
+                while True:
+                    data = ctilb_file.read(chunksize * CTILB_DTYPE.itemsize)
+                    if not data:
+                        break
+                    writer.write(data)
+
+            # LOCATIONS [(12)*count_locations) byte]
+            locations = np.empty(count_locations, dtype=LOCATION_DTYPE)
+            locations['latitude'], locations['longitude'] = location_from_key(location_keys)
+            locations['id_ctilb_min'] = location_ctilb_min
+            writer.write(locations.tobytes())
+            writer.close()
+
+    stats = pd.DataFrame({'Discretization error': stats_error.describe(), 'Discretization error with Uncertainty': stats_error_unc.describe()})
+    log(stats)
+
+    expectedSize = HEADER_SIZE + bc_temperature*count_temperatures + (8)*count_ctilb + (12)*count_locations
+    if writer.bytes_written + HEADER_SIZE != expectedSize:
+        raise Exception(f"Binary Data Size is incosistent. Expected: {expectedSize} Bytes, Actual: {writer.bytes_written + HEADER_SIZE}")
+
+    report.section("HEADER", HEADER_SIZE)
+    report.section("TEMPERATURES", bc_temperature*count_temperatures)
+    report.section("CTILBS", CTILB_DTYPE.itemsize*count_ctilb)
+    report.section("LOCATIONS", LOCATION_DTYPE.itemsize*count_locations)
+    report.info.update({'bc_temperature': bc_temperature, 'discretization error': stats.to_dict(), 'file': filepath, 'file size': os.path.getsize(filepath), 'layout': "location", 'compression': compression})
+    report.close()
+    if report_path is not None:
+        report.to_json(report_path)
+    if return_report:
+        return filepath, report
+    return filepath
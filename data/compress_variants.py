@@ -0,0 +1,221 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import compress
+from cce_report import CompressReport
+
+# Builds several variants of the same dataset (e.g. the files listed in DB_files of src/db.ts) in one run.
+# The preprocessing (STEP 1-5 of compress_dataset: dropna, typing, location ids, merging, sorting, CTILBs) doesn't depend
+# on the discretization or compression, so it runs only once (see compress.prepare_columns). The prepared rows are
+# cached as "<hash>.npz" inside cache_dir, keyed by a hash of the input (content of a frame or size/mtime of the files
+# of a parquet store) and the preprocessing options, so a rebuild with other variants starts directly at STEP 6.
+# The variants are built in parallel, every worker reads the cached rows itself.
+#
+# A variant is a dictionary with
+#  - name: name of the variant inside DB_files
+#  - thinning: optional size of a lat/lon grid cell in degrees, only the location with the most temperatures of every
+#    cell is kept (low detail previews)
+#  - any other option of compress_dataset (discretizeresolution, compression, lzma_preset, filename, quantization, ...)
+#    except the preprocessing options years, bbox and location_order, which apply to all variants.
+#    filename "auto" (default) becomes "<name>.cce" (see variant_filename), all filenames have to be unique
+# The result is the list of DB_files entries (sizes and counts of every file), also written into "db_files.json".
+#
+# Usage:
+#   variants = [
+#       {'name': "Original", 'discretizeresolution': 2, 'compression': "lzma", 'lzma_preset': 9},
+#       {'name': "Original (1 byte)", 'discretizeresolution': 1, 'compression': "lzma"},
+#       {'name': "Preview", 'discretizeresolution': 1, 'compression': "lzma", 'thinning': 2.0}
+#   ]
+#   db_files = build_variants("data/sources/combined", "src/assets/db", variants)
+#   python data/compress_variants.py data/sources/combined src/assets/db variants.json
+
+CACHE_VERSION = "1"     # change it when the preprocessing changes, all cached rows get prepared again
+DEFAULT_CACHE_DIR = "sources/cache_prepared"
+DB_FILES_NAME = "db_files.json"
+
+shared_options = ['years', 'bbox', 'location_order', 'low_memory']
+
+
+# Hash of the input and the preprocessing options
+def input_hash(df_data, location_order = "latlon", years = None, bbox = None):
+    h = hashlib.blake2b(digest_size=16)
+    h.update(json.dumps({'version': CACHE_VERSION, 'location_order': location_order, 'years': years, 'bbox': bbox}).encode("utf-8"))
+    if isinstance(df_data, (str, os.PathLike)):
+        path = os.path.abspath(df_data)
+        paths = [os.path.join(root, name) for root, _, names in os.walk(path) for name in names] if os.path.isdir(path) else [path]
+        for path in sorted(paths):
+            stat = os.stat(path)
+            h.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns}\n".encode("utf-8"))
+    else:
+        h.update(pd.util.hash_pandas_object(df_data, index=False).to_numpy().tobytes())
+    return h.hexdigest()
+
+def save_rows(rows, path):
+    arrays = {key: value for key, value in rows.items() if key != 'datebounds'}
+    np.savez(path + ".tmp.npz", datebounds=np.array(json.dumps(rows['datebounds'])), **arrays)
+    os.replace(path + ".tmp.npz", path)
+
+def load_rows(path):
+    with np.load(path) as data:
+        rows = {key: data[key] for key in data.files if key != 'datebounds'}
+        rows['datebounds'] = json.loads(str(data['datebounds']))
+    return rows
+
+# STEP 0-5 of compress_dataset (low memory mode). Returns the rows of compress.prepare_columns
+def prepare_rows(df_data, location_order = "latlon", years = None, bbox = None, report = None):
+    report = CompressReport() if report is None else report
+    if isinstance(df_data, (str, os.PathLike)):
+        from parquet_store import read_store
+        report.begin("STEP 0: Read parquet store")
+        report.log("Reading parquet store...", end="")
+        df_data = read_store(df_data, columns=compress.input_columns, years=years, bbox=bbox)
+        report.log(f" -> {len(df_data)} rows")
+        report.end(len(df_data))
+    elif years is not None or bbox is not None:
+        df_data = compress.filter_dataset(df_data, years, bbox)
+    columns = compress.narrow_columns(df_data, report)
+    df_data = None
+    return compress.prepare_columns(columns, location_order, report)
+
+# Returns the prepared rows out of the cache (or prepares and caches them)
+def load_prepared(df_data, cache_dir = DEFAULT_CACHE_DIR, location_order = "latlon", years = None, bbox = None, report = None):
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_path = os.path.join(cache_dir, input_hash(df_data, location_order, years, bbox) + ".npz")
+    if os.path.isfile(cache_path):
+        return load_rows(cache_path), cache_path
+    rows = prepare_rows(df_data, location_order, years, bbox, report)
+    save_rows(rows, cache_path)
+    return rows, cache_path
+
+
+# Keeps only one location per cell (cell_size degrees) of a lat/lon grid, the one with the most temperatures.
+# Returns new rows (same layout as the rows of compress.prepare_columns).
+def thin_rows(rows, cell_size):
+    latitudes, longitudes = rows['latitudes'], rows['longitudes']
+    counts = np.diff(np.r_[rows['location_starts'], len(rows['locids'])])
+    columns = int(np.ceil(360 / cell_size)) + 1
+    cells = np.floor((latitudes.astype(np.float64) + 90) / cell_size).astype(np.int64) * columns + np.floor((longitudes.astype(np.float64) + 180) / cell_size).astype(np.int64)
+    order = np.lexsort((-counts, cells))
+    keep = np.zeros(len(latitudes), dtype=bool)
+    keep[order[np.r_[True, cells[order][1:] != cells[order][:-1]]]] = True
+
+    locids = (np.cumsum(keep, dtype=np.uint32) - 1)[rows['locids']]
+    mask = keep[rows['locids']]
+    locids, years, months = locids[mask], rows['years'][mask], rows['months'][mask]
+    datebounds = compress.get_datebounds(years, months)
+    dms = compress.month_differences(years, months, datebounds)
+    if dms.max() < 2**16:
+        dms = dms.astype(np.uint16)
+    _, _, ctilbids, ctilb_starts, location_starts = compress.row_index(locids, dms)
+    return {
+        'datebounds': datebounds,
+        'locids': locids,
+        'ctilbids': ctilbids,
+        'location_starts': location_starts,
+        'ctilb_starts': ctilb_starts,
+        'years': years,
+        'months': months,
+        'dms': dms,
+        'latitudes': latitudes[keep],
+        'longitudes': longitudes[keep],
+        'temperatures': rows['temperatures'][mask],
+        'uncertainties': rows['uncertainties'][mask]
+    }
+
+
+def format_size(size):
+    return f"{size / 2**20:.2f} MB"
+
+# Entry of DB_files (src/db.ts) for the report of compress_dataset
+def db_files_entry(name, report):
+    info = report.info
+    size = sum(section['bytes'] for section in report.sections if not section['section'].startswith("PAYLOAD"))
+    return {
+        'name': name,
+        'discretization': f"{info['bc_temperature']}-bit",
+        'compressedsize': format_size(info['file size']),
+        'size': format_size(size),
+        'filename': os.path.basename(info['file']),
+        'temperatures': info['count_temperatures'],
+        'locations': info['count_locations']
+    }
+
+# Filename of a variant. Instead of the generated name of compress_dataset (which only contains the counts, the
+# byte-count and the compression, so variants differing in other options would collide) "auto" uses the variant name.
+def variant_filename(variant):
+    filename = variant.get('filename', 'auto')
+    if filename == "auto":
+        return re.sub(r"[^\w.-]+", "_", variant['name']).strip("_") + ".cce"
+    return filename
+
+# Builds one variant out of the cached rows (process pool worker)
+def build_variant(cache_path, output_path, variant):
+    rows = load_rows(cache_path)
+    if variant.get('thinning'):
+        rows = thin_rows(rows, variant['thinning'])
+    options = {key: value for key, value in variant.items() if key not in ('name', 'thinning')}
+    options.setdefault('workers', 1) # the variants already run in parallel
+    _, report = compress.compress_dataset(rows, output_path, quiet=True, return_report=True, **options)
+    return db_files_entry(variant['name'], report)
+
+
+def build_variants(
+        df_data,        # The pandas frame containing the data or the path to a parquet store (see compress_dataset)
+        output_path,    # Directory on where to save the output files (and db_files.json)
+        variants,       # List of variants (see above)
+        cache_dir = DEFAULT_CACHE_DIR,  # Directory of the cached prepared rows
+        workers = None,     # amount of worker processes (None = one per variant up to the cpu count, 0 = inside this process)
+        location_order = "latlon",  # preprocessing options, see compress_dataset
+        years = None,
+        bbox = None,
+        quiet = False
+):
+    if not os.path.exists(output_path):
+        raise Exception(f"Directory  '{output_path}' does not exist")
+    for variant in variants:
+        if not 'name' in variant:
+            raise Exception("Every variant needs a name")
+        if set(shared_options) & set(variant):
+            raise Exception(f"The options {', '.join(set(shared_options) & set(variant))} apply to all variants")
+    variants = [{**variant, 'filename': variant_filename(variant)} for variant in variants]
+    filenames = [variant['filename'] for variant in variants]
+    if len(set(filenames)) < len(filenames):
+        raise Exception(f"The filenames of the variants have to be unique ({', '.join(sorted(set(name for name in filenames if filenames.count(name) > 1)))})")
+
+    report = CompressReport(quiet)
+    _, cache_path = load_prepared(df_data, cache_dir, location_order, years, bbox, report)
+    df_data = None
+    report.begin(f"Build {len(variants)} variants")
+    if workers == 0:
+        db_files = [build_variant(cache_path, output_path, variant) for variant in variants]
+    else:
+        with ProcessPoolExecutor(max_workers=workers or min(len(variants), os.cpu_count() or 1)) as executor:
+            db_files = list(executor.map(build_variant, [cache_path] * len(variants), [output_path] * len(variants), variants))
+    report.end()
+    report.close()
+    for entry in db_files:
+        report.log(f"{entry['filename']}: {entry['compressedsize']} ({entry['size']} uncompressed), {entry['temperatures']} temperatures, {entry['locations']} locations")
+
+    with open(os.path.join(output_path, DB_FILES_NAME), "w") as file:
+        json.dump(db_files, file, indent=4)
+    return db_files
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Builds several variants (discretization, compression, thinning) of a dataset with one preprocessing")
+    parser.add_argument("input", help="Parquet store (see parquet_store.py)")
+    parser.add_argument("output", help="Output directory")
+    parser.add_argument("variants", help="json file with the list of variants")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR, help="Directory of the cached prepared rows")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (0 = no pool)")
+    parser.add_argument("--location-order", choices=compress.location_orders, default="latlon")
+    args = parser.parse_args()
+
+    with open(args.variants) as file:
+        variants = json.load(file)
+    build_variants(args.input, args.output, variants, args.cache_dir, args.workers, args.location_order)
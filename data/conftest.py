@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+# Synthetic input frame for the tests (same columns as the berkeley frames):
+#  - locations start at different months and have random gaps (several CTILBs per location)
+#  - some (location, year, month) rows are duplicated (merged by STEP 4)
+#  - a few temperatures are NaN (dropped by STEP 1)
+# The rows are shuffled, so the compression has to sort them.
+def synthetic_frame(count_locations = 40, first_year = 1950, last_year = 1979, gaps = 0.05, duplicates = 0.02, seed = 0):
+    rng = np.random.default_rng(seed)
+    latitudes = np.round(rng.uniform(-60, 70, count_locations), 2)
+    longitudes = np.round(rng.uniform(-180, 180, count_locations), 2)
+    count_months = (last_year - first_year + 1) * 12
+    locids = np.repeat(np.arange(count_locations), count_months)
+    dms = np.tile(np.arange(count_months), count_locations)
+    mask = rng.random(len(locids)) > gaps
+    mask &= dms >= rng.integers(0, count_months // 2, count_locations)[locids]
+    locids, dms = locids[mask], dms[mask]
+    duplicated = rng.random(len(locids)) < duplicates
+    locids = np.concatenate([locids, locids[duplicated]])
+    dms = np.concatenate([dms, dms[duplicated]])
+    temperatures = 15 - np.abs(latitudes[locids]) * 0.3 + 10 * np.sin(2 * np.pi * (dms % 12) / 12) + rng.normal(0, 1, len(locids))
+    df = pd.DataFrame({
+        'Latitude': latitudes[locids],
+        'Longitude': longitudes[locids],
+        'Year': first_year + dms // 12,
+        'Month': dms % 12 + 1,
+        'AverageTemperature': temperatures,
+        'AverageTemperatureUncertainty': rng.uniform(0.05, 1.5, len(locids))
+    })
+    df.loc[rng.random(len(df)) < 0.002, 'AverageTemperature'] = np.nan
+    return df.sample(frac=1, random_state=seed).reset_index(drop=True)
+
+# The merged input rows (STEP 1-4 of compress_dataset) sorted by location and month
+def merged_frame(df_data):
+    df = df_data.dropna().astype({'Latitude': np.float32, 'Longitude': np.float32, 'AverageTemperature': np.float32, 'AverageTemperatureUncertainty': np.float32})
+    return df.groupby(['Latitude', 'Longitude', 'Year', 'Month'], as_index=False) \
+        .agg(AverageTemperature=('AverageTemperature', 'mean'), AverageTemperatureUncertainty=('AverageTemperatureUncertainty', 'mean'))
+
+
+@pytest.fixture(scope="session")
+def df_synthetic():
+    return synthetic_frame()
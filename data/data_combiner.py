@@ -1,16 +1,25 @@
 import pandas as pd
+import numpy as np
 import os
 import re
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
+from parse_cache import ParseCache
+from parquet_store import write_store
 
 LOCAL_FILE_PATH = "data/sources/berkley_local_summaries"
-OUTPUT_FILE = "data/sources/combined.csv"
+OUTPUT_STORE = "data/sources/combined" # parquet store (see parquet_store.py), input of interpolate_data.py and compress.py
+OUTPUT_FILE = None # additionally write a csv file, e.g. "data/sources/combined.csv" (None = no csv)
+CACHE_DIR = "data/sources/cache_localsummaries" # parsed positions, only new or changed files get parsed again (None = no cache)
+PARSER_VERSION = "1" # increase if getDataForOnePosition changes, so that the cached positions get parsed again
 
 
 #name = 0.80N-8.84E
-def getDataForOnePosition(name):
-    count_file = f"{LOCAL_FILE_PATH}/{name}-TAVG-Counts.txt"
-    trends_file = f"{LOCAL_FILE_PATH}/{name}-TAVG-Trend.txt"
+def getDataForOnePosition(name, local_file_path = None):
+    local_file_path = local_file_path or LOCAL_FILE_PATH
+    count_file = f"{local_file_path}/{name}-TAVG-Counts.txt"
+    trends_file = f"{local_file_path}/{name}-TAVG-Trend.txt"
 
     # Extract Data from comment at begin of trend file:
     chunk = ""
@@ -24,7 +33,7 @@ def getDataForOnePosition(name):
     citys = citys[0] if len(citys) > 0 else ""
     temperatureList = re.findall(r"Jan[\s]+Feb[\s]+Mar[\s]+Apr[\s]+May[\s]+Jun[\s]+Jul[\s]+Aug[\s]+Sep[\s]+Oct[\s]+Nov[\s]+Dec\s+%%([\w\s\S]+)%%", chunk)[0].strip().split(" ")
     temperatureList = list(filter(None, temperatureList))
-    temperatureList = [eval(i) for i in temperatureList]
+    temperatureList = [float(i) for i in temperatureList]
 
     latlon = name.split("-")
 
@@ -44,12 +53,12 @@ def getDataForOnePosition(name):
     df_joined = pd.merge(df_counts, df_trends, how='left', left_on=['Year', 'Month'], right_on=['Year', 'Month'])
     #print(df_joined)
     #df_joined['temp'] = df_joined['Monthly Anomaly'] + temperatureList[df_joined['Month']]
-    df_joined['AverageTemperature'] = df_joined.apply(lambda x: x['Monthly Anomaly'] + temperatureList[x['Month'].astype(int) - 1], axis=1)
+    df_joined['AverageTemperature'] = df_joined['Monthly Anomaly'] + np.asarray(temperatureList)[df_joined['Month'].to_numpy(dtype=int) - 1]
     df_joined["Latitude"] = latlon[0]
     df_joined["Longitude"] = latlon[1]
     df_joined["Country"] = country
     df_joined["City"] = citys
-    df_joined["dt"] = df_joined.apply(lambda x: str(x['Year']) + "-" + '{0:0>2}'.format(x['Month']) + "-01", axis=1)
+    df_joined["dt"] = df_joined['Year'].astype(str) + "-" + df_joined['Month'].astype(str).str.zfill(2) + "-01"
     df_joined.rename(columns={"Monthly Unc.": "AverageTemperatureUncertainty"}, inplace=True)
 
     #df_joined.drop(['Within 10 km','Within 50 km','Within 100 km','Within 250 km','Within 500 km','Within 1000 km','Monthly Anomaly'], axis=1, inplace=True)
@@ -67,34 +76,36 @@ def getPositionsFromDirectory(dir):
         positions.add(path.replace("-TAVG-Trend.txt", ""))
     return positions
 
-allPositions = getPositionsFromDirectory(LOCAL_FILE_PATH)
-print(f"{len(allPositions)} different Location-Files will be combined")
-df_merged = pd.DataFrame({'A' : []})
-pbar = tqdm(total=len(allPositions), desc="Merging files")
-for ind, positionName in enumerate(allPositions):
-    pbar.update(1)
-    pbar.set_description(f"Merging files ({len(df_merged)} temp entries)")
-    #pbar.write(f"Working on {positionName}...")
-    df = getDataForOnePosition(positionName)
-
-    if df is None:
-        continue
-    if len(df) < 0:
-        #pbar.write(f" -> Returned empty dataframe")
-        continue
-
-    #pbar.write(f" -> Read {len(df)} entries")
-    if len(df_merged) > 0:
-        df_merged = pd.concat([df_merged, df], ignore_index=True)
-    else:
-        df_merged = df
-    
-pbar.close()
-
-#df_merged['src'] = 0
 
-size_before = len(df_merged)
-df_merged = df_merged.dropna()
-print(f"Dropped {size_before - len(df_merged)} NaN-entries.")
-df_merged.to_csv(OUTPUT_FILE, index=False, sep=",", encoding="utf-8", header=True)
-print(f"Output-File created successfully")
\ No newline at end of file
+# Parses all positions on a process pool (workers=None: cpu count) and concatenates them once at the end
+# (local_file_path=None: LOCAL_FILE_PATH)
+def combinePositions(positions, workers = None, cache_dir = None, local_file_path = None):
+    positions = sorted(positions)
+    local_file_path = local_file_path or LOCAL_FILE_PATH
+    parse = partial(getDataForOnePosition, local_file_path=local_file_path)
+    if cache_dir is not None:
+        cache = ParseCache(cache_dir, version=PARSER_VERSION)
+        sources = {name: [f"{local_file_path}/{name}-TAVG-Counts.txt", f"{local_file_path}/{name}-TAVG-Trend.txt"] for name in positions}
+        return cache.load(sources, parse, workers)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        dfs = list(tqdm(executor.map(parse, positions, chunksize=64), total=len(positions), desc="Merging files"))
+    dfs = [df for df in dfs if df is not None and len(df) > 0]
+    if len(dfs) == 0:
+        return pd.DataFrame(columns=["dt", "AverageTemperature", "AverageTemperatureUncertainty", "City", "Country", "Latitude", "Longitude"])
+    return pd.concat(dfs, ignore_index=True)
+
+
+if __name__ == '__main__':
+    allPositions = getPositionsFromDirectory(LOCAL_FILE_PATH)
+    print(f"{len(allPositions)} different Location-Files will be combined")
+    df_merged = combinePositions(allPositions, cache_dir=CACHE_DIR)
+
+    #df_merged['src'] = 0
+
+    size_before = len(df_merged)
+    df_merged = df_merged.dropna()
+    print(f"Dropped {size_before - len(df_merged)} NaN-entries.")
+    write_store(df_merged, OUTPUT_STORE)
+    if OUTPUT_FILE is not None:
+        df_merged.to_csv(OUTPUT_FILE, index=False, sep=",", encoding="utf-8", header=True)
+    print(f"Output-File created successfully")
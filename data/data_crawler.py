@@ -2,10 +2,13 @@ import requests
 import sys
 from lxml import etree
 import os
-from tqdm import tqdm
+from async_crawler import fetch_pages, download_files
 
 LOCAL_FILE_PATH = "data/sources/berkley_local_summaries"
+BASE_URL = "http://berkeleyearth.lbl.gov" # can be pointed at a local mirror
 SKIP_DOWNLOAD = True # download step is unnecessary (look at note in step 1)
+CONCURRENCY = 20 # parallel requests
+REFRESH = False # True: check already downloaded files for changes (conditional requests), False: skip them
 
 def exitWithError(msg):
     print(msg, file=sys.stderr)
@@ -19,7 +22,7 @@ def getSiteDom(url):
     return etree.HTML(resp.text)
 
 def getCityLinkList():
-    url_citylist = "http://berkeleyearth.lbl.gov/city-list/"
+    url_citylist = f"{BASE_URL}/city-list/"
     ret = []
     dom = getSiteDom(url_citylist)
     elements = dom.xpath("//div[@class='pagination']//a[@class='pagination-fixed-width']")
@@ -31,8 +34,11 @@ def getCityLinkList():
 # Note: berkleyearth doesnt really support individual cities but combines several testing stations around certain geographical coordinates. (here is one for example: http://berkeleyearth.lbl.gov/auto/Local/TAVG/Text/5.63N-8.07E-TAVG-Trend.txt)
 def getAllLocalPositions(citylinks):
     ret = set()
-    for url in tqdm(citylinks, desc="Fetching local positions"):
-        dom = getSiteDom(url)
+    pages = fetch_pages(citylinks, concurrency=CONCURRENCY, desc="Fetching local positions")
+    for url, page in zip(citylinks, pages):
+        if page is None:
+            exitWithError(f"Couldn't download url {url}")
+        dom = etree.HTML(page)
         elements = dom.xpath("//div[contains(concat(' ', @class, ' '), ' main-content ')]//table//tr/td[1]/a")
         for e in elements:
             u = e.get("href")
@@ -52,12 +58,11 @@ if not SKIP_DOWNLOAD:
 
     print(f"About to download {len(localPositions)} data-files into {LOCAL_FILE_PATH}.")
 
-    os.makedirs(LOCAL_FILE_PATH, exist_ok=True)
-    for pos in tqdm(localPositions, desc="Downloading TAVG-files"):
-        url = f"http://berkeleyearth.lbl.gov/auto/Local/TAVG/Text/{pos}-TAVG-Trend.txt"
-        localName = f"{LOCAL_FILE_PATH}/{pos}-TAVG-Trend.txt"
-        resp = requests.get(url)
-        if resp.status_code != 200:
-            exitWithError(f"Couldn't download file {url}")
-        open(localName, "wb").write(resp.content)
+    localPositions = sorted(localPositions)
+    urls = [f"{BASE_URL}/auto/Local/TAVG/Text/{pos}-TAVG-Trend.txt" for pos in localPositions]
+    localNames = [f"{LOCAL_FILE_PATH}/{pos}-TAVG-Trend.txt" for pos in localPositions]
+    stats, failed = download_files(urls, localNames, concurrency=CONCURRENCY, refresh=REFRESH)
+    print(f" -> {stats}")
+    if len(failed) > 0:
+        exitWithError(f"Couldn't download {len(failed)} files, e.g. {failed[0]}")
 
@@ -1,11 +1,19 @@
+import argparse
+import io
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from time import perf_counter
 
 import numpy as np
 import pandas as pd
 from sklearn import linear_model
+from parquet_store import is_store, read_store, store_files, to_pipeline_frame, create_store, write_store
 
-input_filepath = r'data/sources/GlobalLandTemperaturesByCity.csv'
+input_filepath = r'data/sources/GlobalLandTemperaturesByCity.csv' # csv file or parquet store (see parquet_store.py)
+output_formats = ['parquet', 'csv']
 #row_sample = 1.0 # keeps x% of rows in output (for faster debugging)
 
 
@@ -38,33 +46,98 @@ def fill_nans(group):
     return group
 
 
-def main():
+# Vectorized version of groupby(...).apply(fill_nans): The slope and intercept of every group are computed at
+# once out of segmented sums over the group ids (least squares on the centered values, like LinearRegression).
+# Same semantics: groups without NaNs stay untouched, filled values get src = 1, all-NaN groups are dropped.
+# The rows are returned in the same order as the groupby-apply (groups in order of appearance).
+def fill_nans_grouped(df):
+    group_ids = df.groupby([df['dt'].dt.month, 'Latitude', 'Longitude'], sort=False).ngroup()
+    df = df[group_ids.notna()]  # groupby drops rows with NaN keys
+    group_ids = group_ids[group_ids.notna()].to_numpy(dtype=np.int64)
+    count_groups = group_ids.max() + 1 if len(group_ids) > 0 else 0
+
+    x = df['dt'].dt.year.to_numpy(dtype=np.float64)
+    y = df['AverageTemperature'].to_numpy(dtype=np.float64)
+    known = ~np.isnan(y)
+    ids_known = group_ids[known]
+    n = np.bincount(ids_known, minlength=count_groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_x = np.bincount(ids_known, weights=x[known], minlength=count_groups) / n
+        mean_y = np.bincount(ids_known, weights=y[known], minlength=count_groups) / n
+        dx = x[known] - mean_x[ids_known]
+        dy = y[known] - mean_y[ids_known]
+        sxx = np.bincount(ids_known, weights=dx * dx, minlength=count_groups)
+        sxy = np.bincount(ids_known, weights=dx * dy, minlength=count_groups)
+        slope = np.where(sxx > 0, sxy / sxx, 0.0)
+    intercept = mean_y - slope * mean_x
+
+    count_empty = np.count_nonzero(n == 0)
+    if count_empty > 0:
+        print(f" ({count_empty} groups only consist of NaNs)", end='')
+    missing = ~known & (n[group_ids] > 0)
+    predicted = intercept[group_ids] + slope[group_ids] * x
+    df = df.assign(
+        src=np.where(missing, 1, df['src'].to_numpy()),
+        AverageTemperature=np.where(missing, predicted, y)
+    )
+    keep = n[group_ids] > 0
+    order = np.argsort(group_ids[keep], kind='stable')
+    return df[keep].iloc[order].reset_index(drop=True)
+
+
+# Runs both engines and checks that the vectorized one returns the same frame as the sklearn one
+def compare_engines(df, atol = 1e-9):
+    df_sklearn = df.groupby([df['dt'].dt.month, 'Latitude', 'Longitude'], sort=False, group_keys=True).apply(fill_nans).reset_index(drop=True)
+    df_grouped = fill_nans_grouped(df)
+    pd.testing.assert_frame_equal(df_sklearn, df_grouped, check_exact=False, atol=atol, rtol=0)
+    print(f" -> Engines are equal ({len(df_grouped)} rows)")
+
+
+# The output is a parquet store "<input>_interpolated" or a csv file "<input>_interpolated.csv"
+def get_dest_path(source_path, output_format):
+    if not output_format in output_formats:
+        raise Exception(f"Unsupported output format ({output_format})")
+    return source_path.parent / (source_path.stem + ('_interpolated' if output_format == "parquet" else '_interpolated.csv'))
+
+
+def main(engine = "grouped", check = False, output_format = "parquet"):
     #if row_sample < 1.0:
     #    input(f"Just an information: I will delete {(1.0-row_sample)*100}% of rows by random. Press enter if you want to continue...")
 
     source_path = Path(input_filepath)
-    dest_path = source_path.parent / (source_path.stem + '_interpolated.csv')
+    dest_path = get_dest_path(source_path, output_format)
 
     overall_start = perf_counter()
 
     print('Loading data...', end='')
     start = perf_counter()
-    df = pd.read_csv(source_path)
+    from_store = is_store(source_path)
+    if from_store:
+        # typed Year/Month and src (Interpolated) are already stored, no timestamps to parse
+        df = to_pipeline_frame(read_store(source_path))
+    else:
+        df = pd.read_csv(source_path)
     print(f' {perf_counter() - start:.2f}s')
 
-    # convert timestamps for easier grouping by year and month
-    print('Converting timestamps...', end='')
-    start = perf_counter()
-    df['dt'] = pd.to_datetime(df['dt'])
-    print(f' {perf_counter() - start:.2f}s')
+    if not from_store:
+        # convert timestamps for easier grouping by year and month
+        print('Converting timestamps...', end='')
+        start = perf_counter()
+        df['dt'] = pd.to_datetime(df['dt'])
+        print(f' {perf_counter() - start:.2f}s')
 
-    # add extra column so we know which values are interpolated:
-    df['src'] = 0
+        # add extra column so we know which values are interpolated:
+        df['src'] = 0
 
     # group cities by month and apply linear regression interpolation to fill NaNs
     print('Filling NaNs...', end='')
     start = perf_counter()
-    df = df.groupby([df['dt'].dt.month, 'Latitude', 'Longitude'], sort=False, group_keys=True).apply(fill_nans).reset_index(drop=True)
+    if check:
+        compare_engines(df)
+    if engine == "sklearn":
+        df = df.groupby([df['dt'].dt.month, 'Latitude', 'Longitude'], sort=False, group_keys=True).apply(fill_nans).reset_index(drop=True)
+    else:
+        df = fill_nans_grouped(df)
     print(f' {perf_counter() - start:.2f}s')
 
     #if row_sample < 1.0:
@@ -75,11 +148,142 @@ def main():
     # save to file
     print('Saving data...', end='')
     start = perf_counter()
-    df.to_csv(dest_path, index=False)
+    if output_format == "parquet":
+        write_store(df, dest_path)
+    else:
+        df.to_csv(dest_path, index=False)
     print(f' {perf_counter() - start:.2f}s')
 
     print(f'Overall time: {perf_counter() - overall_start:.2f}s')
 
 
+### Sharded execution: every stage runs on a process pool, the intermediate data is stored as parquet inside a temp dir
+#  1. Read:  Every worker parses one byte range of the csv (or reads a share of the files of a parquet store) and
+#            partitions its rows by the hash of the location
+#  2. Fill:  Every worker interpolates one location shard (all rows of a location are inside the same shard) and
+#            splits its output into ranges of cities (chosen out of the city counts, so that the ranges have similar sizes)
+#  3. Sort:  Every worker sorts one city range by City and dt and writes it as csv part or as part of the output store
+#  4. Merge: The csv parts get concatenated in the order of the city ranges (parts of the store need no merge)
+# The output is ordered by City and dt like main (a store is read decade by decade, see parquet_store.py). Rows with the same City and dt (different locations with the
+# same city name) are in shard order instead of the (unstable) order of sort_values.
+
+# Byte ranges [start, end) of the csv (after the header line), the ranges are aligned to the start of lines
+def csv_byte_ranges(path, count):
+    size = os.path.getsize(path)
+    with open(path, 'rb') as file:
+        header = file.readline()
+        offsets = [file.tell()]
+        for i in range(1, count):
+            file.seek(max(offsets[0] + (size - offsets[0]) * i // count, offsets[-1]))
+            file.readline()
+            offsets.append(min(file.tell(), size))
+    offsets.append(size)
+    return header, [(start, end) for start, end in zip(offsets[:-1], offsets[1:]) if end > start]
+
+# source: (header, start, end) of a csv or the list of files of a store
+def _read_shard_parts(path, source, shards, part, temp_dir):
+    if is_store(path):
+        df = to_pipeline_frame(read_store(path, files=source))
+    else:
+        header, start, end = source
+        with open(path, 'rb') as file:
+            file.seek(start)
+            data = file.read(end - start)
+        df = pd.read_csv(io.BytesIO(header + data))
+        df['src'] = 0
+    shard_ids = pd.util.hash_pandas_object(df[['Latitude', 'Longitude']], index=False).to_numpy() % shards
+    for shard in range(shards):
+        df[shard_ids == shard].to_parquet(f"{temp_dir}/read_{shard}_{part}.parquet", index=False)
+    return len(df), df['City'].value_counts(dropna=False)
+
+def _city_ranges(df, boundaries):
+    # NaN cities are sorted last by sort_values, therefore they belong to the last range
+    city = df['City'].to_numpy(dtype=object)
+    ranges = np.full(len(df), len(boundaries), dtype=np.int64)
+    known = pd.notna(city)
+    ranges[known] = np.searchsorted(boundaries, city[known].astype(str), side='right')
+    return ranges
+
+def _fill_shard(shard, parts, boundaries, engine, temp_dir):
+    df = pd.concat([pd.read_parquet(f"{temp_dir}/read_{shard}_{part}.parquet") for part in range(parts)], ignore_index=True)
+    df['dt'] = pd.to_datetime(df['dt'])
+    if engine == "sklearn":
+        df = df.groupby([df['dt'].dt.month, 'Latitude', 'Longitude'], sort=False, group_keys=True).apply(fill_nans).reset_index(drop=True)
+    else:
+        df = fill_nans_grouped(df)
+    ranges = _city_ranges(df, boundaries)
+    for r in range(len(boundaries) + 1):
+        df[ranges == r].to_parquet(f"{temp_dir}/fill_{r}_{shard}.parquet", index=False)
+    return len(df)
+
+def _sort_range(r, shards, temp_dir, dest_path, output_format):
+    df = pd.concat([pd.read_parquet(f"{temp_dir}/fill_{r}_{shard}.parquet") for shard in range(shards)], ignore_index=True)
+    df.sort_values(by=['City', 'dt'], inplace=True, kind='stable')
+    if output_format == "parquet":
+        write_store(df, dest_path, part=r)
+    else:
+        df.to_csv(f"{temp_dir}/part_{r}.csv", index=False, header=(r == 0))
+    return len(df)
+
+
+def main_sharded(engine = "grouped", workers = None, shards = None, output_format = "parquet"):
+    source_path = Path(input_filepath)
+    dest_path = get_dest_path(source_path, output_format)
+    workers = workers or os.cpu_count()
+    shards = shards or workers
+
+    overall_start = perf_counter()
+    with tempfile.TemporaryDirectory(dir=source_path.parent) as temp_dir, ProcessPoolExecutor(max_workers=workers) as executor:
+        print(f'Loading and partitioning data ({shards} shards)...', end='')
+        start = perf_counter()
+        if is_store(source_path):
+            files = store_files(source_path)
+            sources = [list(part_files) for part_files in np.array_split(np.array(files, dtype=object), min(workers, len(files))) if len(part_files) > 0]
+        else:
+            header, byte_ranges = csv_byte_ranges(source_path, workers)
+            sources = [(header, a, b) for a, b in byte_ranges]
+        results = list(executor.map(_read_shard_parts, *zip(*[(source_path, source, shards, part, temp_dir) for part, source in enumerate(sources)])))
+        print(f' {perf_counter() - start:.2f}s')
+
+        # Boundaries of the city ranges, so that every range contains about the same amount of rows
+        city_counts = pd.concat([counts for _, counts in results]).groupby(level=0, dropna=True).sum()
+        city_counts.index = city_counts.index.astype(str)
+        city_counts = city_counts.sort_index()
+        cumulative = np.cumsum(city_counts.to_numpy())
+        count_ranges = max(min(shards, len(city_counts)), 1)
+        boundaries = city_counts.index.to_numpy()[np.searchsorted(cumulative, np.arange(1, count_ranges) * cumulative[-1] / count_ranges)] if len(cumulative) else np.empty(0, dtype=object)
+        boundaries = np.unique(boundaries).astype(str)
+
+        print('Converting timestamps and filling NaNs...', end='')
+        start = perf_counter()
+        list(executor.map(_fill_shard, range(shards), [len(sources)] * shards, [boundaries] * shards, [engine] * shards, [temp_dir] * shards))
+        print(f' {perf_counter() - start:.2f}s')
+
+        print('Sorting and saving data...', end='')
+        start = perf_counter()
+        count_parts = len(boundaries) + 1
+        if output_format == "parquet":
+            create_store(dest_path)
+        list(executor.map(_sort_range, range(count_parts), [shards] * count_parts, [temp_dir] * count_parts, [dest_path] * count_parts, [output_format] * count_parts))
+        if output_format == "csv":
+            with open(dest_path, 'wb') as output:
+                for r in range(count_parts):
+                    with open(f"{temp_dir}/part_{r}.csv", 'rb') as part:
+                        shutil.copyfileobj(part, output)
+        print(f' {perf_counter() - start:.2f}s')
+
+    print(f'Overall time: {perf_counter() - overall_start:.2f}s')
+
+
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description="Fills the NaN temperatures by a linear regression per month and location")
+    parser.add_argument("--engine", choices=["grouped", "sklearn"], default="grouped", help="grouped: vectorized regression of all groups at once, sklearn: one LinearRegression per group")
+    parser.add_argument("--check", action="store_true", help="Check that both engines return the same data")
+    parser.add_argument("--workers", type=int, default=None, help="Run sharded on this amount of worker processes (0 = cpu count)")
+    parser.add_argument("--shards", type=int, default=None, help="Amount of location shards for the sharded execution (default: workers)")
+    parser.add_argument("--output-format", choices=output_formats, default="parquet", help="parquet: parquet store (see parquet_store.py), csv: csv file")
+    args = parser.parse_args()
+    if args.workers is not None:
+        main_sharded(args.engine, args.workers, args.shards, args.output_format)
+    else:
+        main(args.engine, args.check, args.output_format)
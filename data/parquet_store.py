@@ -0,0 +1,180 @@
+import argparse
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# Columnar intermediate store between the pipeline stages (data_combiner.py -> interpolate_data.py -> compress.py).
+# A store is a directory with a hive partitioned Parquet dataset ("Decade=1990/part-00000-0.parquet") and the fixed
+# SCHEMA inside "_common_metadata". Compared to the csv files no stage has to parse text, dates or floats again:
+#  - Year/Month are typed ints instead of "1990-01-01" strings (no pd.to_datetime)
+#  - Latitude/Longitude are degree floats instead of "57.05N" strings
+#  - the values are float32 and City/Country are dictionary encoded
+#  - src (0 = measured, 1 = interpolated) is stored as bool column Interpolated
+# read_store only reads the requested columns (projection) and pushes the year range and bounding box down into
+# the scan: partitions outside the year range are skipped and row groups are pruned by their statistics.
+#
+# Usage:
+#   write_store(df, "data/sources/combined")
+#   df = read_store("data/sources/combined", columns=["Year", "Month", "AverageTemperature"], years=(1900, 1999))
+#   python data/parquet_store.py data/sources/GlobalLandTemperaturesByCity.csv data/sources/GlobalLandTemperaturesByCity
+
+SCHEMA = pa.schema([
+    ('Year', pa.int16()),
+    ('Month', pa.int8()),
+    ('AverageTemperature', pa.float32()),
+    ('AverageTemperatureUncertainty', pa.float32()),
+    ('City', pa.dictionary(pa.int32(), pa.string())),
+    ('Country', pa.dictionary(pa.int32(), pa.string())),
+    ('Latitude', pa.float32()),
+    ('Longitude', pa.float32()),
+    ('Interpolated', pa.bool_())
+])
+
+PARTITION_COLUMN = "Decade"
+PARTITION_YEARS = 10
+METADATA_FILE = "_common_metadata"
+ROW_GROUP_SIZE = 2**20
+
+PARTITIONING = ds.partitioning(pa.schema([(PARTITION_COLUMN, pa.int16())]), flavor="hive")
+
+
+def is_store(path):
+    return os.path.isdir(path) and os.path.isfile(os.path.join(path, METADATA_FILE))
+
+# Converts "57.05N"/"12.3W" strings into degree floats (vectorized version of util.tolatlongfloat)
+def latlong_to_float(values):
+    values = pd.Series(values)
+    if pd.api.types.is_numeric_dtype(values):
+        return values.to_numpy(dtype=np.float32)
+    values = values.astype(str).str.strip()
+    sign = np.where(values.str[-1].isin(['S', 'W']).to_numpy(), -1.0, 1.0)
+    return (values.str.rstrip('NSEW').astype(np.float64).to_numpy() * sign).astype(np.float32)
+
+# Converts a frame of a pipeline stage (dt or Year/Month, string or float positions, src or Interpolated) into SCHEMA.
+# A missing uncertainty is stored as 0.0 (like compress_dataset treats it), a NaN would drop the rows on compression.
+def to_store_frame(df):
+    if 'Year' in df.columns and 'Month' in df.columns:
+        years, months = df['Year'].to_numpy(), df['Month'].to_numpy()
+    else:
+        dates = df['dt'] if pd.api.types.is_datetime64_any_dtype(df['dt']) else pd.to_datetime(df['dt'], format="%Y-%m-%d")
+        years, months = dates.dt.year.to_numpy(), dates.dt.month.to_numpy()
+    if 'Interpolated' in df.columns:
+        interpolated = df['Interpolated'].to_numpy(dtype=bool)
+    elif 'src' in df.columns:
+        interpolated = df['src'].to_numpy() != 0
+    else:
+        interpolated = np.zeros(len(df), dtype=bool)
+    return pd.DataFrame({
+        'Year': years.astype(np.int16),
+        'Month': months.astype(np.int8),
+        'AverageTemperature': df['AverageTemperature'].to_numpy(dtype=np.float32),
+        'AverageTemperatureUncertainty': df['AverageTemperatureUncertainty'].to_numpy(dtype=np.float32) if 'AverageTemperatureUncertainty' in df.columns else np.zeros(len(df), dtype=np.float32),
+        'City': pd.Categorical(df['City'].to_numpy() if 'City' in df.columns else np.full(len(df), "", dtype=object)),
+        'Country': pd.Categorical(df['Country'].to_numpy() if 'Country' in df.columns else np.full(len(df), "", dtype=object)),
+        'Latitude': latlong_to_float(df['Latitude']),
+        'Longitude': latlong_to_float(df['Longitude']),
+        'Interpolated': interpolated
+    })
+
+# Converts a frame of the store into the layout of the csv files (dt as datetime instead of Year/Month, src)
+def to_pipeline_frame(df):
+    return pd.DataFrame({
+        'dt': pd.to_datetime(pd.DataFrame({'year': df['Year'], 'month': df['Month'], 'day': 1})),
+        'AverageTemperature': df['AverageTemperature'],
+        'AverageTemperatureUncertainty': df['AverageTemperatureUncertainty'],
+        'City': df['City'],
+        'Country': df['Country'],
+        'Latitude': df['Latitude'],
+        'Longitude': df['Longitude'],
+        'src': df['Interpolated'].astype(np.int64)
+    })
+
+
+# Creates an empty store (an existing store at path gets replaced)
+def create_store(path):
+    if os.path.exists(path):
+        if not is_store(path):
+            raise Exception(f"'{path}' exists and is not a parquet store")
+        shutil.rmtree(path)
+    os.makedirs(path)
+    pq.write_metadata(SCHEMA, os.path.join(path, METADATA_FILE))
+
+# Writes the frame into the store. With part = None the store gets replaced, otherwise the frame is added as
+# files "part-<part>-*.parquet", so parts can be written in parallel. The store is read decade by decade and inside
+# a decade in ascending order of the parts (and in the order the rows were written).
+def write_store(df, path, part = None):
+    if part is None:
+        create_store(path)
+    elif not is_store(path):
+        raise Exception(f"'{path}' is not a parquet store")
+    table = pa.Table.from_pandas(to_store_frame(df), schema=SCHEMA, preserve_index=False)
+    decades = pa.array((table['Year'].to_numpy() // PARTITION_YEARS * PARTITION_YEARS).astype(np.int16))
+    ds.write_dataset(
+        table.append_column(PARTITION_COLUMN, decades), path, format="parquet", partitioning=PARTITIONING,
+        basename_template=f"part-{0 if part is None else part:05d}-{{i}}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+        max_rows_per_group=ROW_GROUP_SIZE, preserve_order=True
+    )
+
+
+# Filter expression for the year range (inclusive) and bounding box (lat_min, lat_max, lon_min, lon_max, inclusive)
+def store_filter(years = None, bbox = None):
+    expression = None
+    def combine(e):
+        return e if expression is None else expression & e
+    if years is not None:
+        first, last = years
+        # The condition on the partition column lets the scan skip whole directories
+        expression = combine((ds.field(PARTITION_COLUMN) >= first // PARTITION_YEARS * PARTITION_YEARS) & (ds.field(PARTITION_COLUMN) <= last))
+        expression = combine((ds.field('Year') >= first) & (ds.field('Year') <= last))
+    if bbox is not None:
+        lat_min, lat_max, lon_min, lon_max = bbox
+        expression = combine((ds.field('Latitude') >= lat_min) & (ds.field('Latitude') <= lat_max) & (ds.field('Longitude') >= lon_min) & (ds.field('Longitude') <= lon_max))
+    return expression
+
+def open_store(path, files = None):
+    if not is_store(path):
+        raise Exception(f"'{path}' is not a parquet store")
+    path = os.fspath(path)
+    return ds.dataset(path if files is None else files, schema=SCHEMA.append(pa.field(PARTITION_COLUMN, pa.int16())), format="parquet", partitioning=PARTITIONING, partition_base_dir=path)
+
+# Data files of the store in reading order
+def store_files(path):
+    return sorted(open_store(path).files)
+
+# Reads the store (or only the given files of it) into a frame. The categorical City/Country columns are returned
+# as strings unless categorical = True.
+def read_store(path, columns = None, years = None, bbox = None, files = None, categorical = False):
+    columns = list(SCHEMA.names) if columns is None else list(columns)
+    if not set(columns).issubset(SCHEMA.names):
+        raise Exception(f"Unknown columns ({', '.join(set(columns) - set(SCHEMA.names))})")
+    dataset = open_store(path, files if files is not None else store_files(path))
+    df = dataset.to_table(columns=columns, filter=store_filter(years, bbox)).to_pandas()
+    if not categorical:
+        for column in {'City', 'Country'}.intersection(columns):
+            df[column] = df[column].astype(object)
+    return df
+
+# Iterates over the store in frames of at most batch_size rows
+def iter_store(path, columns = None, years = None, bbox = None, batch_size = ROW_GROUP_SIZE):
+    dataset = open_store(path, store_files(path))
+    for batch in dataset.to_batches(columns=columns, filter=store_filter(years, bbox), batch_size=batch_size):
+        if batch.num_rows > 0:
+            yield batch.to_pandas()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Converts a csv file of the pipeline (e.g. GlobalLandTemperaturesByCity.csv) into a parquet store")
+    parser.add_argument("source", help="Path to the csv file")
+    parser.add_argument("store", help="Directory of the store (gets replaced)")
+    parser.add_argument("--chunksize", type=int, default=5000000, help="Rows per chunk")
+    args = parser.parse_args()
+
+    create_store(args.store)
+    for part, df in enumerate(pd.read_csv(args.source, chunksize=args.chunksize)):
+        write_store(df, args.store, part=part)
+        print(f"Part {part}: {len(df)} rows")
@@ -0,0 +1,118 @@
+import os
+import json
+import hashlib
+import itertools
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from tqdm import tqdm
+
+# Persistent cache for parsing a directory of text files into one frame (data_combiner.py, berkley_data_combiner.ipynb).
+# Every key (e.g. a position or station id) is parsed out of one or more source files into a frame, which is stored
+# as parquet fragment inside the cache directory. The manifest (manifest.json) stores the fingerprint of the source
+# files of every key (path, size, mtime and content hash). On the next run only keys with added or changed files get
+# parsed again, all others are read from their fragments. The content hash is only computed if size or mtime changed,
+# so a file which just got touched (e.g. by a new download) is recognized as unchanged without parsing it again.
+#
+# Usage:
+#   cache = ParseCache("sources/cache_localsummaries", version="1")
+#   df = cache.load({name: [count_file, trend_file] for name in positions}, getDataForOnePosition)
+
+MANIFEST_FILE = "manifest.json"
+
+
+def _content_hash(path):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(2**20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+# Reused as process pool worker: returns the frame of the key (or None)
+def _parse(parse_function, key):
+    return parse_function(key)
+
+
+class ParseCache:
+    def __init__(self, cache_dir, version = ""):
+        self.cache_dir = cache_dir
+        self.version = version      # change it when the parse function changes, all keys get parsed again
+        os.makedirs(cache_dir, exist_ok=True)
+        self.manifest = {'version': version, 'entries': {}}
+        manifest_path = os.path.join(cache_dir, MANIFEST_FILE)
+        if os.path.isfile(manifest_path):
+            with open(manifest_path) as file:
+                manifest = json.load(file)
+            if manifest.get('version') == version:
+                self.manifest = manifest
+
+    def _fragment_path(self, key):
+        return os.path.join(self.cache_dir, hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest() + ".parquet")
+
+    # Returns the fingerprint of the files and whether they are unchanged compared to the cached fingerprint
+    def _fingerprint(self, paths, cached):
+        cached_files = {entry['path']: entry for entry in cached['files']} if cached else {}
+        files = []
+        unchanged = cached is not None and len(cached_files) == len(paths)
+        for path in paths:
+            stat = os.stat(path)
+            entry = {'path': path, 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+            old = cached_files.get(path)
+            if old is not None and old['size'] == entry['size'] and old['mtime'] == entry['mtime']:
+                entry['hash'] = old['hash']
+            else:
+                entry['hash'] = _content_hash(path)
+                unchanged = unchanged and old is not None and old['hash'] == entry['hash']
+            files.append(entry)
+        return files, unchanged
+
+    def save(self):
+        manifest_path = os.path.join(self.cache_dir, MANIFEST_FILE)
+        with open(manifest_path + ".tmp", "w") as file:
+            json.dump(self.manifest, file)
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+    # sources: dictionary key -> list of source files. parse_function(key) returns the frame of the key or None
+    # (has to be a module level function if workers != 0). workers = 0 parses inside this process.
+    # Returns the concatenated frames of all keys (ordered by key).
+    def load(self, sources, parse_function, workers = None):
+        entries = self.manifest['entries']
+        changed = []
+        fingerprints = {}
+        for key, paths in tqdm(sorted(sources.items()), desc="Checking files"):
+            fingerprints[key], unchanged = self._fingerprint(paths, entries.get(key))
+            if unchanged:
+                entries[key]['files'] = fingerprints[key]
+            else:
+                changed.append(key)
+        removed = set(entries.keys()) - set(sources.keys())
+        print(f" -> {len(changed)} new or changed, {len(sources) - len(changed)} cached, {len(removed)} removed")
+
+        for key in removed:
+            if entries[key]['rows'] > 0 and os.path.isfile(self._fragment_path(key)):
+                os.remove(self._fragment_path(key))
+            del entries[key]
+
+        if workers == 0:
+            results = (parse_function(key) for key in changed)
+        else:
+            executor = ProcessPoolExecutor(max_workers=workers)
+            results = executor.map(_parse, itertools.repeat(parse_function), changed, chunksize=16)
+        try:
+            for key, df in tqdm(zip(changed, results), total=len(changed), desc="Parsing files"):
+                rows = 0 if df is None else len(df)
+                if rows > 0:
+                    df.to_parquet(self._fragment_path(key), index=False)
+                elif os.path.isfile(self._fragment_path(key)):
+                    os.remove(self._fragment_path(key))
+                entries[key] = {'files': fingerprints[key], 'rows': rows}
+        finally:
+            if workers != 0:
+                executor.shutdown()
+            self.save()
+
+        keys = [key for key in sorted(sources.keys()) if entries[key]['rows'] > 0]
+        with ThreadPoolExecutor() as executor:
+            dfs = list(tqdm(executor.map(lambda key: pd.read_parquet(self._fragment_path(key)), keys), total=len(keys), desc="Reading fragments"))
+        if len(dfs) == 0:
+            return pd.DataFrame()
+        return pd.concat(dfs, ignore_index=True)
@@ -1,10 +1,28 @@
-import csv
+import argparse
+import os
+from pathlib import Path
 
 import cartopy.crs as ccrs
 import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+from matplotlib.colors import LogNorm
+
+# Plots the locations of a dataset (csv with Latitude/Longitude like "57.05N" or a parquet store) onto a world map.
+#  - scatter: one marker per location, the size grows with the amount of cities at the location (small datasets)
+#  - grid:    amount of locations per lat/lon cell (resolution in degrees), rendered as one image
+#  - hex:     amount of locations per hexagon (resolution = width of a hexagon in degrees), rendered as one image
+# The raster modes bin the locations with NumPy, so they stay fast for 100k+ stations.
+# The location table (distinct locations with their amount of cities) is cached next to the input file
+# ("<input>.locations.npz") and reused as long as size and modification time of the input don't change.
+#
+# Usage:
+#   python data/plot_map_locations.py --input data/sources/combined --mode hex --resolution 2 --output coverage.png
 
 input_filepath = 'source/GlobalLandTemperaturesByCity.csv'
 
+plot_modes = ['scatter', 'grid', 'hex']
+
 lat_long_map = {
     'N': 1,
     'S': -1,
@@ -13,41 +31,119 @@ lat_long_map = {
 }
 
 
+# Vectorized over arrays of strings like "57.05N" and "12.30W"
 def map_lat_long(lat, long):
-    return float(lat[:-1]) * lat_long_map[lat[-1]], float(long[:-1]) * lat_long_map[long[-1]]
+    def to_float(values):
+        values = pd.Series(values, dtype=str).str.strip()
+        return values.str[:-1].astype(np.float64).to_numpy() * values.str[-1].map(lat_long_map).to_numpy(dtype=np.float64)
+    return to_float(lat), to_float(long)
+
+
+# Returns the distinct locations (lat, long) and the amount of different cities at every location
+def read_locations(path):
+    if os.path.isdir(path):
+        from parquet_store import read_store
+        df = read_store(path, columns=['City', 'Latitude', 'Longitude'])
+    else:
+        df = pd.read_csv(path, usecols=['City', 'Latitude', 'Longitude'], dtype=str)
+        df['Latitude'], df['Longitude'] = map_lat_long(df['Latitude'], df['Longitude'])
+    cities = df.drop_duplicates().groupby(['Latitude', 'Longitude'], dropna=False).size()
+    lat = cities.index.get_level_values('Latitude').to_numpy(dtype=np.float64)
+    long = cities.index.get_level_values('Longitude').to_numpy(dtype=np.float64)
+    return lat, long, cities.to_numpy(dtype=np.int64)
+
+def _fingerprint(path):
+    if os.path.isdir(path):
+        stats = [os.stat(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names]
+    else:
+        stats = [os.stat(path)]
+    return np.array([sum(s.st_size for s in stats), max(s.st_mtime_ns for s in stats)], dtype=np.int64)
+
+# read_locations with the cached location table
+def load_locations(path, use_cache = True):
+    cache_path = str(path).rstrip('/\\') + '.locations.npz'
+    fingerprint = _fingerprint(path)
+    if use_cache and os.path.isfile(cache_path):
+        cache = np.load(cache_path)
+        if np.array_equal(cache['fingerprint'], fingerprint):
+            return cache['lat'], cache['long'], cache['cities']
+    lat, long, cities = read_locations(path)
+    if use_cache:
+        np.savez(cache_path, lat=lat, long=long, cities=cities, fingerprint=fingerprint)
+    return lat, long, cities
+
+
+# Amount of locations per lat/lon cell, rows = latitude (south to north)
+def grid_raster(lat, long, resolution):
+    counts, _, _ = np.histogram2d(lat, long, bins=[int(np.ceil(180 / resolution)), int(np.ceil(360 / resolution))], range=[[-90, 90], [-180, 180]])
+    return counts
 
+# Hexagon of every point (same tiling as matplotlib's hexbin): the centers lie on two rectangular lattices, the
+# second one is shifted by half a cell. Every point belongs to the nearer center of both lattices.
+# Returns the lattice (0/1) and the column/row of the center on it.
+def _hex_cells(lat, long, size):
+    sx = (np.asarray(long) + 180) / size
+    sy = (np.asarray(lat) + 90) / (size * np.sqrt(3))
+    i1, j1 = np.floor(sx + .5), np.floor(sy + .5)
+    i2, j2 = np.floor(sx), np.floor(sy)
+    d1 = (sx - i1)**2 + 3 * (sy - j1)**2
+    d2 = (sx - i2 - .5)**2 + 3 * (sy - j2 - .5)**2
+    second = d2 < d1
+    return second.astype(np.int64), np.where(second, i2, i1).astype(np.int64), np.where(second, j2, j1).astype(np.int64)
 
-def main():
-    # stores locations and their corresponding city names
-    points = {}
+# Amount of locations per hexagon (size = width of a hexagon in degrees), rasterized into an image of
+# pixels_per_degree (rows = latitude, south to north): every pixel gets the count of the hexagon of its center
+def hex_raster(lat, long, size, pixels_per_degree = 4):
+    shape = (2, int(np.ceil(360 / size)) + 2, int(np.ceil(180 / (size * np.sqrt(3)))) + 2)
+    lattice, column, row = _hex_cells(lat, long, size)
+    counts = np.bincount(np.ravel_multi_index((lattice, column, row), shape), minlength=np.prod(shape)).reshape(shape)
+    pixel_lat = -90 + (np.arange(180 * pixels_per_degree) + .5) / pixels_per_degree
+    pixel_long = -180 + (np.arange(360 * pixels_per_degree) + .5) / pixels_per_degree
+    grid_long, grid_lat = np.meshgrid(pixel_long, pixel_lat)
+    return counts[_hex_cells(grid_lat, grid_long, size)]
 
-    with open(input_filepath, 'r', encoding='utf-8') as f:
-        f.readline()  # skip header
-        csv_reader = csv.reader(f)
-        for row in csv_reader:
-            point = map_lat_long(row[5], row[6])
-            if point not in points:
-                points[point] = set()
-            points[point].add(row[3])  # add city name
+
+def plot_scatter(ax, lat, long, cities):
+    # ax.hexbin(x, y, gridsize=(100, 30), transform=ccrs.PlateCarree())
+    ax.scatter(long, lat, s=20 + cities * 5, c='r', edgecolors='k', linewidths=.5, transform=ccrs.PlateCarree())
+
+def plot_raster(ax, raster, label):
+    image = ax.imshow(np.ma.masked_equal(raster, 0), origin='lower', extent=[-180, 180, -90, 90], norm=LogNorm(), cmap='viridis', interpolation='nearest', transform=ccrs.PlateCarree())
+    plt.colorbar(image, ax=ax, shrink=.6, label=label)
+
+
+def main(path = input_filepath, mode = 'scatter', resolution = 1.0, output = None, use_cache = True):
+    if not mode in plot_modes:
+        raise Exception(f"Unsupported plot mode ({mode})")
+    lat, long, cities = load_locations(path, use_cache)
+    print(f"{len(lat)} locations")
 
     fig = plt.figure(figsize=(20, 10))
     ax = fig.add_subplot(1, 1, 1, projection=ccrs.PlateCarree())
     ax.set_global()
     ax.coastlines()
 
-    x, y, s = [], [], []
-    for (lat, long), cities in points.items():
-        x.append(long)
-        y.append(lat)
-        s.append(20 + len(cities) * 5)
-
-    # ax.hexbin(x, y, gridsize=(100, 30), transform=ccrs.PlateCarree())
-    ax.scatter(x, y, s=s, c='r', edgecolors='k', linewidths=.5, transform=ccrs.PlateCarree())
+    if mode == 'scatter':
+        plot_scatter(ax, lat, long, cities)
+    elif mode == 'grid':
+        plot_raster(ax, grid_raster(lat, long, resolution), f"locations per {resolution}° cell")
+    else:
+        plot_raster(ax, hex_raster(lat, long, resolution, max(4, int(np.ceil(4 / resolution)))), f"locations per {resolution}° hexagon")
 
     plt.tight_layout()
 
-    plt.show()
+    if output is None:
+        plt.show()
+    else:
+        plt.savefig(output, dpi=150)
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description="Plots the locations of a dataset onto a world map")
+    parser.add_argument("--input", default=input_filepath, help="csv file (Latitude/Longitude like 57.05N) or parquet store (see parquet_store.py)")
+    parser.add_argument("--mode", choices=plot_modes, default="scatter", help="scatter: one marker per location, grid/hex: density raster")
+    parser.add_argument("--resolution", type=float, default=1.0, help="Size of a grid cell/hexagon in degrees")
+    parser.add_argument("--output", default=None, help="Save the plot as image instead of showing it")
+    parser.add_argument("--no-cache", action="store_true", help="Don't read or write the cached location table")
+    args = parser.parse_args()
+    main(args.input, args.mode, args.resolution, args.output, not args.no_cache)
@@ -0,0 +1,191 @@
+import asyncio
+import contextlib
+import json
+import os
+import time
+from aiohttp import web
+from async_crawler import download_files_async, fetch_pages_async, PART_SUFFIX, STATE_FILE
+
+# download_files_async/fetch_pages_async against a local aiohttp server with the files of FILES:
+#  - /files/<name>      200 (or 304 for a matching If-None-Match/If-Modified-Since, 206 for a Range request with matching If-Range)
+#  - /flaky/<name>      503 for the first `failures` requests of a file, then like /files
+#  - /truncated/<name>  sends the full Content-Length but only the first half of the file and drops the connection
+#  - /pages/<name>      a html page (503 for the first `failures` requests, 404 for "missing")
+# Every request is logged as (path, headers, status, time).
+
+FILES = {f"file{i}.txt": bytes(range(256)) * (i * 40 + 1) for i in range(4)}
+LAST_MODIFIED = "Wed, 01 Jan 2025 00:00:00 GMT"
+
+def etag(name):
+    return f'"{name}-v1"'
+
+
+class FileServer:
+    def __init__(self, failures = 0):
+        self.failures = failures
+        self.requests = []
+
+    # A new application per event loop (asyncio.run), the request log is shared
+    def application(self):
+        app = web.Application()
+        app.router.add_get("/files/{name}", self.files)
+        app.router.add_get("/flaky/{name}", self.flaky)
+        app.router.add_get("/truncated/{name}", self.truncated)
+        app.router.add_get("/pages/{name}", self.pages)
+        return app
+
+    def log(self, request, status):
+        self.requests.append((request.path, dict(request.headers), status, time.monotonic()))
+
+    async def files(self, request):
+        name = request.match_info['name']
+        if name not in FILES:
+            self.log(request, 404)
+            raise web.HTTPNotFound()
+        headers = {'ETag': etag(name), 'Last-Modified': LAST_MODIFIED}
+        if request.headers.get('If-None-Match') == etag(name) or request.headers.get('If-Modified-Since') == LAST_MODIFIED:
+            self.log(request, 304)
+            return web.Response(status=304, headers=headers)
+        content = FILES[name]
+        if 'Range' in request.headers and request.headers.get('If-Range') in (etag(name), LAST_MODIFIED):
+            start = int(request.headers['Range'][len("bytes="):].rstrip("-"))
+            headers['Content-Range'] = f"bytes {start}-{len(content) - 1}/{len(content)}"
+            self.log(request, 206)
+            return web.Response(status=206, body=content[start:], headers=headers)
+        self.log(request, 200)
+        return web.Response(body=content, headers=headers)
+
+    async def flaky(self, request):
+        failed = sum(1 for path, _, status, _ in self.requests if path == request.path and status == 503)
+        if failed < self.failures:
+            self.log(request, 503)
+            return web.Response(status=503)
+        return await self.files(request)
+
+    async def truncated(self, request):
+        name = request.match_info['name']
+        content = FILES[name]
+        self.log(request, 200)
+        resp = web.StreamResponse(headers={'ETag': etag(name), 'Last-Modified': LAST_MODIFIED, 'Content-Length': str(len(content))})
+        await resp.prepare(request)
+        await resp.write(content[:len(content) // 2])
+        request.transport.close()
+        return resp
+
+    async def pages(self, request):
+        name = request.match_info['name']
+        failed = sum(1 for path, _, status, _ in self.requests if path == request.path and status == 503)
+        if name == "missing":
+            self.log(request, 404)
+            raise web.HTTPNotFound()
+        if failed < self.failures:
+            self.log(request, 503)
+            return web.Response(status=503)
+        self.log(request, 200)
+        return web.Response(text=f"<a href='{name}'>{name}</a>")
+
+@contextlib.asynccontextmanager
+async def serve(server):
+    runner = web.AppRunner(server.application())
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    try:
+        host, port = runner.addresses[0][:2]
+        yield f"http://{host}:{port}"
+    finally:
+        await runner.cleanup()
+
+# Runs download_files_async for the names (below /<route>/) into the directory
+def download(server, directory, names, route = "files", **kwargs):
+    async def run():
+        async with serve(server) as url:
+            return await download_files_async([f"{url}/{route}/{name}" for name in names], [os.path.join(directory, name) for name in names], **kwargs)
+    return asyncio.run(run())
+
+def assert_downloaded(directory, names):
+    for name in names:
+        with open(os.path.join(directory, name), "rb") as file:
+            assert file.read() == FILES[name]
+    assert not [name for name in os.listdir(directory) if name.endswith(PART_SUFFIX) or name.endswith(".tmp")]
+
+
+def test_download_and_skip_complete(tmp_path):
+    server = FileServer()
+    names = sorted(FILES)
+    stats, failed = download(server, tmp_path, names, retries=0)
+    assert stats == {'downloaded': 4, 'not_modified': 0, 'skipped': 0, 'failed': 0} and failed == []
+    assert_downloaded(tmp_path, names)
+    with open(tmp_path / STATE_FILE) as file:
+        state = json.load(file)
+    assert state[names[1]] == {'etag': etag(names[1]), 'last_modified': LAST_MODIFIED, 'size': len(FILES[names[1]]), 'partial': False}
+
+    # complete files are skipped without any request, a changed (other size) file is downloaded again
+    (tmp_path / names[2]).write_bytes(b"changed")
+    count_requests = len(server.requests)
+    stats, failed = download(server, tmp_path, names, retries=0)
+    assert stats == {'downloaded': 1, 'not_modified': 0, 'skipped': 3, 'failed': 0}
+    assert [path for path, *_ in server.requests[count_requests:]] == [f"/files/{names[2]}"]
+    assert_downloaded(tmp_path, names)
+
+
+def test_refresh_not_modified(tmp_path):
+    server = FileServer()
+    names = sorted(FILES)
+    download(server, tmp_path, names, retries=0)
+    modified = {name: os.path.getmtime(tmp_path / name) for name in names}
+    count_requests = len(server.requests)
+    stats, failed = download(server, tmp_path, names, refresh=True, retries=0)
+    assert stats == {'downloaded': 0, 'not_modified': 4, 'skipped': 0, 'failed': 0}
+    for _, headers, status, _ in server.requests[count_requests:]:
+        assert status == 304
+        assert headers['If-Modified-Since'] == LAST_MODIFIED and headers['If-None-Match'].startswith('"file')
+    assert {name: os.path.getmtime(tmp_path / name) for name in names} == modified
+    assert_downloaded(tmp_path, names)
+
+
+def test_retry_with_backoff(tmp_path):
+    server = FileServer(failures=2)
+    stats, failed = download(server, tmp_path, ["file1.txt"], route="flaky", retries=2, backoff=0.05)
+    assert stats['downloaded'] == 1 and failed == []
+    assert [status for _, _, status, _ in server.requests] == [503, 503, 200]
+    # backoff * 2**attempt * (1 + jitter) between the attempts
+    times = [request[3] for request in server.requests]
+    assert times[1] - times[0] >= 0.05 and times[2] - times[1] >= 0.1
+    assert_downloaded(tmp_path, ["file1.txt"])
+
+    # without enough retries the file fails and nothing is left at the path
+    server = FileServer(failures=2)
+    stats, failed = download(server, tmp_path, ["file2.txt"], route="flaky", retries=1, backoff=0.01)
+    assert stats['failed'] == 1 and failed[0].endswith("/flaky/file2.txt")
+    assert [status for _, _, status, _ in server.requests] == [503, 503]
+    assert not (tmp_path / "file2.txt").exists() and not (tmp_path / ("file2.txt" + PART_SUFFIX)).exists()
+
+
+def test_interrupted_download_resumes(tmp_path):
+    name = "file3.txt"
+    server = FileServer()
+    # the interrupted download stays inside the part file, the path doesn't exist
+    stats, failed = download(server, tmp_path, [name], route="truncated", retries=0)
+    assert stats['failed'] == 1
+    assert not (tmp_path / name).exists()
+    part = (tmp_path / (name + PART_SUFFIX)).read_bytes()
+    assert 0 < len(part) < len(FILES[name]) and FILES[name].startswith(part)
+
+    # the next run only requests the rest of the file
+    stats, failed = download(server, tmp_path, [name], retries=0)
+    assert stats['downloaded'] == 1
+    _, headers, status, _ = server.requests[-1]
+    assert status == 206
+    assert headers['Range'] == f"bytes={len(part)}-" and headers['If-Range'] == etag(name)
+    assert_downloaded(tmp_path, [name])
+
+
+def test_fetch_pages():
+    server = FileServer(failures=1)
+    async def run():
+        async with serve(server) as url:
+            return await fetch_pages_async([f"{url}/pages/a", f"{url}/pages/missing", f"{url}/pages/b"], retries=2, backoff=0.01)
+    texts = asyncio.run(run())
+    assert texts == ["<a href='a'>a</a>", None, "<a href='b'>b</a>"]
+    assert sorted(status for _, _, status, _ in server.requests) == [200, 200, 404, 503, 503]
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+from compress import compress_dataset
+from cce_reader import CCEReader
+
+# The precomputed aggregates (APFX, AYIX/AYRS, AMON) have to answer the same means and counts as the full scan
+
+
+@pytest.mark.parametrize("quantization", ["global", "location"])
+@pytest.mark.parametrize("aggregates", [("prefix",), ("yearly",), ("monthly",), ("prefix", "yearly", "monthly")], ids=lambda aggregates: "+".join(aggregates))
+def test_aggregate_matches_scan(df_synthetic, tmp_path, aggregates, quantization):
+    compress_dataset(df_synthetic, str(tmp_path), "test.cce", 2, aggregates=aggregates, quantization=quantization, quiet=True, report_memory=None)
+    with CCEReader(str(tmp_path / "test.cce")) as db:
+        for aggregate in aggregates:
+            assert {'prefix': 'APFX', 'yearly': 'AYRS', 'monthly': 'AMON'}[aggregate] in db.sections
+        if "yearly" in aggregates or "monthly" in aggregates:
+            assert 'AYIX' in db.sections
+        first_year = db.header['db_first_year']
+        ranges = [
+            (0, db.count_months - 1),
+            (db.month_index(first_year + 1, 1), db.month_index(first_year + 10, 12)), # whole years (AYRS)
+            (db.month_index(first_year + 3, 5), db.month_index(first_year + 20, 2)),  # partial years
+            (db.month_index(first_year + 7, 1), db.month_index(first_year + 7, 12)),
+            (db.month_index(first_year - 5, 1), db.month_index(first_year + 2, 12))   # starts before the file
+        ]
+        scan = db.aggregate_scan
+        for first_month, last_month in ranges:
+            for month in [None, 1, 5, 12]:
+                # The queries covered by the sections must not fall back to the scan
+                whole_years = db.month_date(first_month)[1] == 1 and db.month_date(last_month)[1] == 12
+                covered = ("prefix" in aggregates or ("yearly" in aggregates and whole_years)) if month is None else "monthly" in aggregates
+                scans = []
+                db.aggregate_scan = lambda *args: scans.append(args) or scan(*args)
+                means, counts = db.aggregate(first_month, last_month, month)
+                del db.aggregate_scan
+                assert len(scans) == (0 if covered else 1)
+                means_scan, counts_scan = db.aggregate_scan(first_month, last_month, month)
+                np.testing.assert_array_equal(counts, counts_scan)
+                np.testing.assert_allclose(means, means_scan, rtol=1e-9, atol=1e-9)
@@ -0,0 +1,12 @@
+import pytest
+from cce_codecs import benchmark_codecs
+
+pytest.importorskip("zstandard")
+
+
+# Dictionary training fails on a payload this small, only the runs with dictionary may be skipped
+def test_benchmark_keeps_presets_without_dictionary():
+    payload = bytes(range(256)) * 4
+    df = benchmark_codecs(payload, ["zstd_blocks"], block_size=256, workers=1, dictionary_size=4096)
+    assert sorted(df['preset']) == [1, 3, 6, 9, 12, 15, 19, 22]
+    assert (df['dictionary'] == 0).all()
@@ -0,0 +1,39 @@
+import itertools
+import numpy as np
+import pandas as pd
+import pytest
+from cce_format import temperature_dtype
+from cce_filters import temperature_filters, filter_flags, encode_temperatures, decode_temperatures
+from compress import compress_dataset
+from cce_reader import CCEReader
+
+# The temperature filters have to be reversible for every combination and byte-count
+
+filter_combinations = [list(filters) for count in range(len(temperature_filters) + 1) for filters in itertools.combinations(temperature_filters, count)]
+
+
+@pytest.mark.parametrize("filters", filter_combinations, ids=lambda filters: "+".join(filters) or "none")
+@pytest.mark.parametrize("bc_temperature", [1, 2, 4])
+def test_encode_decode(bc_temperature, filters):
+    rng = np.random.default_rng(bc_temperature)
+    # CTILBs of 1, 5, 11, 12, 13 and 300 values (shorter and longer than a year)
+    sizes = np.array([1, 5, 11, 12, 13, 300, 1, 40])
+    ctilb_starts = np.r_[0, np.cumsum(sizes)[:-1]]
+    distemps = rng.integers(0, 2**(bc_temperature*8), sizes.sum(), dtype=np.uint64).astype(temperature_dtype(bc_temperature))
+    flags = filter_flags(filters)
+    buffer = encode_temperatures(distemps, ctilb_starts, bc_temperature, flags)
+    assert len(buffer) == distemps.nbytes
+    np.testing.assert_array_equal(decode_temperatures(buffer, ctilb_starts, bc_temperature, flags), distemps)
+
+
+@pytest.mark.parametrize("filters", filter_combinations[1:], ids=lambda filters: "+".join(filters))
+@pytest.mark.parametrize("compression", ["none", "lzma"])
+def test_filtered_file(df_synthetic, tmp_path, compression, filters):
+    compress_dataset(df_synthetic, str(tmp_path), "plain.cce", 2, compression, quiet=True, report_memory=None)
+    compress_dataset(df_synthetic, str(tmp_path), "filtered.cce", 2, compression, filters=filters, quiet=True, report_memory=None)
+    with CCEReader(str(tmp_path / "plain.cce")) as db:
+        df_plain = db.to_dataframe()
+    with CCEReader(str(tmp_path / "filtered.cce")) as db:
+        assert db.header['file_flags'] == filter_flags(filters)
+        df_filtered = db.to_dataframe()
+    pd.testing.assert_frame_equal(df_filtered, df_plain)
@@ -0,0 +1,104 @@
+import lzma
+import struct
+import numpy as np
+import pandas as pd
+import pytest
+from compress import compress_dataset
+
+# Regression test for the FILEVERSION 4 layout: compress_dataset has to write the same bytes as the original
+# serializer (pandas groupby pipeline and one struct.pack/to_bytes call per CTILB and location).
+
+# The original STEP 1-11 of compress_dataset (without the progress output). Returns the file content.
+def reference_file(df_data, discretizeresolution, compression, lzma_preset = 0):
+    ### STEP 1+2: Delete all NaN values and convert data to correct representation
+    df = df_data.dropna().reset_index(drop=True)
+    df = df.astype({
+        'Latitude': np.float32,
+        'Longitude': np.float32,
+        'Year': np.uint32,
+        'Month': np.uint32,
+        'AverageTemperature': np.float32,
+        'AverageTemperatureUncertainty': np.float32
+    })
+
+    ### STEP 3: Create ID column for Location
+    df['locid'] = df.groupby(["Latitude", "Longitude"]).ngroup().astype(np.uint32)
+
+    ### STEP 4: Average Rows with same Year, Month and locid
+    df = df.groupby(['locid', 'Year', 'Month']) \
+        .agg(AverageTemperature=('AverageTemperature', 'mean'), Latitude=('Latitude', 'first'), Longitude=('Longitude', 'first')) \
+        .reset_index()
+
+    ### STEP 5: Create CTILB IDs
+    df.sort_values(by=["locid", "Year", "Month"], inplace=True)
+    df['ctilbid'] = ((df['Year'].astype(np.int64) - df['Year'].shift(1)) * 12 + (df['Month'].astype(np.int64) - df['Month'].shift(1)) + (df['locid'].astype(np.int64) - df['locid'].shift(1)) * 100000) - 1
+    df.loc[df['ctilbid'] != 0.0, "ctilbid"] = 1.0
+    df.loc[df['ctilbid'] == 0.0, "ctilbid"] = np.nan
+    df_part = df.loc[df['ctilbid'] > 0.0, "ctilbid"]
+    df.loc[df['ctilbid'] > 0.0, "ctilbid"] = pd.Series(np.arange(df_part.size), df_part.index)
+    df['ctilbid'] = df['ctilbid'].ffill().astype(np.uint32)
+    df['id'] = df.index
+
+    ### STEP 6: Get Header-Data and create dm column
+    count_temperatures = len(df)
+    count_locations = df['locid'].max().item() + 1
+    count_ctilb = df['ctilbid'].max().item() + 1
+    first_year, last_year = df['Year'].min().item(), df['Year'].max().item()
+    first_month = df.loc[df['Year'] == first_year, 'Month'].min().item()
+    last_month = df.loc[df['Year'] == last_year, 'Month'].max().item()
+    min_temp, max_temp = df['AverageTemperature'].min().item(), df['AverageTemperature'].max().item()
+    df['dm'] = (df['Year'] - first_year) * 12 + df['Month'] - first_month
+
+    ### STEP 7: Discretize Temperature using Min/Max Normalization
+    max_temperature_dis = 2**(discretizeresolution*8)-1
+    df['disTemp'] = (((df['AverageTemperature'] - min_temp)/(max_temp-min_temp)) * max_temperature_dis).astype(np.uint32)
+
+    ### STEP 8: Get Binary data
+    bd_header = bytearray()
+    bd_header.extend(bytes("CCE", "ascii"))
+    bd_header.extend((4).to_bytes(1, "big", signed=False))
+    bd_header.extend(count_temperatures.to_bytes(4, "big", signed=False))
+    bd_header.extend(count_locations.to_bytes(4, "big", signed=False))
+    bd_header.extend(count_ctilb.to_bytes(4, "big", signed=False))
+    bd_header.extend(first_year.to_bytes(2, "big", signed=False))
+    bd_header.extend(first_month.to_bytes(1, "big", signed=False))
+    bd_header.extend(last_year.to_bytes(2, "big", signed=False))
+    bd_header.extend(last_month.to_bytes(1, "big", signed=False))
+    bd_header.extend(struct.pack(">f", min_temp))
+    bd_header.extend(struct.pack(">f", max_temp))
+    bd_header.extend(discretizeresolution.to_bytes(1, "big", signed=False))
+    bd_header.extend({"none": 0, "lzma": 1}[compression].to_bytes(1, "big", signed=False))
+
+    bd_buffer = bytearray()
+    bd_buffer.extend(df['disTemp'].to_numpy(dtype=f'>u{discretizeresolution}').tobytes())
+    df_ctilb = df.groupby(['ctilbid']).agg(first_month=('dm', 'first'), id_temp_min=('id', 'first'))
+    for row in df_ctilb.itertuples(index=False, name=None):
+        bd_buffer.extend(row[0].to_bytes(4, "big", signed=False))
+        bd_buffer.extend(row[1].to_bytes(4, "big", signed=False))
+    df_locations = df.groupby(['locid']).agg(latitude=('Latitude', 'first'), longitude=('Longitude', 'first'), id_ctilb_min=('ctilbid', 'first'))
+    for row in df_locations.itertuples(index=False, name=None):
+        bd_buffer.extend(struct.pack(">f", row[0]))
+        bd_buffer.extend(struct.pack(">f", row[1]))
+        bd_buffer.extend(row[2].to_bytes(4, "big", signed=False))
+    assert len(bd_header) + len(bd_buffer) == 32 + discretizeresolution*count_temperatures + 8*count_ctilb + 12*count_locations
+
+    ### STEP 10: Compress binary data using LZMA (if required)
+    if compression == "lzma":
+        bd_buffer = lzma.compress(bytes(bd_buffer), format=lzma.FORMAT_ALONE, filters=[{"id": lzma.FILTER_LZMA1, "preset": lzma_preset}])
+    return bytes(bd_header) + bytes(bd_buffer)
+
+
+@pytest.mark.parametrize("compression", ["none", "lzma"])
+@pytest.mark.parametrize("discretizeresolution", [1, 2, 4])
+@pytest.mark.parametrize("low_memory", [False, True])
+def test_compress_dataset_matches_reference(df_synthetic, tmp_path, discretizeresolution, compression, low_memory):
+    compress_dataset(df_synthetic, str(tmp_path), "test.cce", discretizeresolution, compression, quiet=True, report_memory=None, low_memory=low_memory)
+    assert (tmp_path / "test.cce").read_bytes() == reference_file(df_synthetic, discretizeresolution, compression)
+
+
+def test_reference_contains_duplicates_and_gaps(df_synthetic):
+    df = df_synthetic.dropna()
+    assert df.duplicated(['Latitude', 'Longitude', 'Year', 'Month']).any()
+    payload = reference_file(df_synthetic, 2, "none")
+    count_locations, count_ctilb = struct.unpack(">II", payload[8:16])
+    assert count_ctilb > count_locations
@@ -0,0 +1,45 @@
+import numpy as np
+import pandas as pd
+import pytest
+from compress import compress_dataset
+from cce_reader import CCEReader
+from cce_layout import TIME_MAJOR_MIN_DENSITY, choose_layout, build_time_major
+
+# The time-major layout (month x location matrix + VALD bitmap) has to read back like the location layout
+
+
+def test_build_time_major():
+    months, locids = np.array([0, 0, 1, 3, 3]), np.array([0, 2, 1, 0, 2])
+    matrix, validity = build_time_major(np.array([5, 6, 7, 8, 9]), months, locids, 4, 3, 2)
+    np.testing.assert_array_equal(matrix, [[5, 0, 6], [0, 7, 0], [0, 0, 0], [8, 0, 9]])
+    np.testing.assert_array_equal(np.unpackbits(validity)[:12].reshape(4, 3), matrix > 0)
+    assert matrix.dtype == np.dtype('>u2')
+
+
+def test_choose_layout():
+    assert choose_layout("auto", int(TIME_MAJOR_MIN_DENSITY * 100), 10, 10) == "time"
+    assert choose_layout("auto", int(TIME_MAJOR_MIN_DENSITY * 100) - 1, 10, 10) == "location"
+    assert choose_layout("location", 100, 10, 10) == "location"
+    with pytest.raises(Exception):
+        choose_layout("rows", 100, 10, 10)
+
+
+@pytest.mark.parametrize("compression, lazy_blocks", [("none", False), ("lzma", False), ("lzma_blocks", False), ("lzma_blocks", True)])
+def test_time_layout_round_trip(df_synthetic, tmp_path, compression, lazy_blocks):
+    compress_dataset(df_synthetic, str(tmp_path), "location.cce", 2, compression, block_size=4096, workers=1, quiet=True, report_memory=None)
+    compress_dataset(df_synthetic, str(tmp_path), "time.cce", 2, compression, block_size=4096, workers=1, layout="time", quiet=True, report_memory=None)
+    with CCEReader(str(tmp_path / "location.cce"), workers=1) as db_location, CCEReader(str(tmp_path / "time.cce"), lazy_blocks=lazy_blocks, workers=1) as db_time:
+        assert db_time.layout == "time" and 'VALD' in db_time.sections
+        if not lazy_blocks:
+            pd.testing.assert_frame_equal(db_time.to_dataframe(), db_location.to_dataframe())
+        for location in [0, 7, db_location.header['count_locations'] - 1]:
+            for first_month, last_month in [(0, None), (30, 150)]:
+                months, temperatures = db_location.series(location, first_month, last_month)
+                months_time, temperatures_time = db_time.series(location, first_month, last_month)
+                np.testing.assert_array_equal(months_time, months)
+                np.testing.assert_array_equal(temperatures_time, temperatures)
+        for first_month, last_month in [(0, db_location.count_months - 1), (13, 13), (100, 160), (-5, 3)]:
+            valid, temperatures = db_location.time_slice(first_month, last_month)
+            valid_time, temperatures_time = db_time.time_slice(first_month, last_month)
+            np.testing.assert_array_equal(valid_time, valid)
+            np.testing.assert_array_equal(temperatures_time, temperatures)
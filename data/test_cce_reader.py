@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+from compress import compress_dataset
+from cce_reader import CCEReader
+from conftest import merged_frame
+
+# Round trip compress_dataset -> file -> CCEReader: every (location, year, month) of the input comes back with its
+# (averaged) temperature within the discretization error.
+
+def max_discretization_error(df_expected, discretizeresolution):
+    temperatures = df_expected['AverageTemperature']
+    return (temperatures.max() - temperatures.min()) / (2**(discretizeresolution*8)-1) + 1e-4
+
+
+@pytest.mark.parametrize("layout", ["location", "time"])
+@pytest.mark.parametrize("compression", ["none", "lzma", "lzma_blocks"])
+@pytest.mark.parametrize("discretizeresolution", [1, 2])
+def test_round_trip(df_synthetic, tmp_path, discretizeresolution, compression, layout):
+    compress_dataset(df_synthetic, str(tmp_path), "test.cce", discretizeresolution, compression, block_size=4096, workers=1, layout=layout, quiet=True, report_memory=None)
+    df_expected = merged_frame(df_synthetic)
+    with CCEReader(str(tmp_path / "test.cce"), workers=1) as db:
+        assert db.layout == layout
+        df = db.to_dataframe()
+        months, temperatures = db.series(3)
+        series_years, series_months = db.month_date(months)
+    df = df.sort_values(['Latitude', 'Longitude', 'Year', 'Month']).reset_index(drop=True)
+    assert len(df) == len(df_expected)
+    for column in ['Latitude', 'Longitude', 'Year', 'Month']:
+        np.testing.assert_array_equal(df[column].to_numpy(), df_expected[column].to_numpy())
+    error = max_discretization_error(df_expected, discretizeresolution)
+    np.testing.assert_allclose(df['AverageTemperature'].to_numpy(), df_expected['AverageTemperature'].to_numpy(), rtol=0, atol=error)
+
+    # series of one location returns the same rows as to_dataframe
+    df_location = df[df['locid'] == 3]
+    np.testing.assert_array_equal(series_years, df_location['Year'].to_numpy())
+    np.testing.assert_array_equal(series_months, df_location['Month'].to_numpy())
+    np.testing.assert_array_equal(temperatures, df_location['AverageTemperature'].to_numpy())
+
+
+def test_round_trip_lazy_blocks(df_synthetic, tmp_path):
+    compress_dataset(df_synthetic, str(tmp_path), "test.cce", 2, "lzma_blocks", block_size=4096, workers=1, quiet=True, report_memory=None)
+    with CCEReader(str(tmp_path / "test.cce"), workers=1) as db:
+        df = db.to_dataframe()
+    with CCEReader(str(tmp_path / "test.cce"), lazy_blocks=True, workers=1) as db:
+        assert db.temperatures is None
+        for location in range(db.header['count_locations']):
+            months, temperatures = db.series(location)
+            df_location = df[df['locid'] == location]
+            np.testing.assert_array_equal(db.month_date(months)[0], df_location['Year'].to_numpy())
+            np.testing.assert_array_equal(temperatures, df_location['AverageTemperature'].to_numpy())
@@ -0,0 +1,123 @@
+import numpy as np
+import pandas as pd
+import pytest
+from compress import compress_dataset
+from cce_format import unpack_header, HEADER_SIZE, HEADER_EXTENSION_SIZE
+from cce_reader import CCEReader
+from cce_segments import create_dataset, update_dataset, consolidate_dataset, read_segments
+from conftest import synthetic_frame, merged_frame
+
+# create_dataset + update_dataset has to end up with the same records as compress_dataset of all rows:
+# consolidate_dataset writes the same file as compress_dataset, if the temperaturebounds and location ids of the
+# first segment are already the final ones (the extremes are inside the first part, the new locations of the update
+# sort behind the existing ones).
+
+# The merged synthetic frame split into the rows of create_dataset and the rows of update_dataset. The update
+# repeats the last `overlap` years of the existing locations and adds the locations with the highest latitudes.
+def split_frame(count_new_locations = 5, cutoff_year = 1970, overlap = 2):
+    df = merged_frame(synthetic_frame(seed=3))
+    new_latitudes = np.sort(df['Latitude'].unique())[-count_new_locations:]
+    new = df['Latitude'].isin(new_latitudes)
+    existing = df.loc[~new, 'AverageTemperature']
+    df.loc[new, 'AverageTemperature'] = df.loc[new, 'AverageTemperature'].clip(existing.min(), existing.max())
+    extremes = df.index.isin([existing.idxmin(), existing.idxmax()])
+    df_first = df[~new & ((df['Year'] < cutoff_year) | extremes)]
+    df_update = df[new | (df['Year'] >= cutoff_year - overlap)]
+    return df, df_first, df_update
+
+def read_frame(path):
+    with CCEReader(str(path), workers=1) as db:
+        return db.to_dataframe()
+
+def header_of(path):
+    with open(path, "rb") as file:
+        return unpack_header(file.read(HEADER_SIZE + HEADER_EXTENSION_SIZE))
+
+
+@pytest.mark.parametrize("compression", ["none", "lzma", "lzma_blocks"])
+def test_update_matches_compress_dataset(tmp_path, compression):
+    df, df_first, df_update = split_frame()
+    path = str(tmp_path / "segmented.cce")
+    create_dataset(df_first, path, 2, compression, block_size=4096, workers=1, quiet=True)
+    info = update_dataset(path, df_update, block_size=4096, workers=1, quiet=True)
+    count_overlap = len(df_first.index.intersection(df_update.index))
+    assert info['skipped rows'] == count_overlap > 0
+    assert info['appended temperatures'] == len(df) - len(df_first)
+    assert info['new locations'] == 5 and info['merged rows'] == 0 and not info['requantized']
+    assert read_segments(path, temperatures=False)['count_segments'] == 2
+
+    compress_dataset(df, str(tmp_path), "reference.cce", 2, compression, block_size=4096, workers=1, quiet=True, report_memory=None)
+    consolidate_dataset(path, str(tmp_path / "consolidated.cce"), block_size=4096, workers=1)
+    assert (tmp_path / "consolidated.cce").read_bytes() == (tmp_path / "reference.cce").read_bytes()
+    assert read_frame(path).equals(read_frame(tmp_path / "reference.cce"))
+
+    # the same update again doesn't append anything
+    content = (tmp_path / "segmented.cce").read_bytes()
+    info = update_dataset(path, df_update, block_size=4096, workers=1, quiet=True)
+    assert info['appended temperatures'] == 0 and info['segment size'] == 0
+    assert info['skipped rows'] == len(df_update)
+    assert (tmp_path / "segmented.cce").read_bytes() == content
+
+
+def test_out_of_bounds(tmp_path):
+    _, df_first, _ = split_frame()
+    df_update = df_first[df_first['Year'] == 1969].copy()
+    df_update['Year'] = 1980
+    maximum = np.float32(df_first['AverageTemperature'].max())
+    df_update.iloc[0, df_update.columns.get_loc('AverageTemperature')] = maximum + 10
+    path = tmp_path / "segmented.cce"
+    create_dataset(df_first, str(path), 2, "lzma", quiet=True)
+    bounds = {key: header_of(path)[key] for key in ('db_min_temp', 'db_max_temp')}
+
+    content = path.read_bytes()
+    with pytest.raises(Exception, match="outside of the temperaturebounds"):
+        update_dataset(str(path), df_update, out_of_bounds="error", quiet=True)
+    assert path.read_bytes() == content
+
+    # clip: the bounds stay, the temperature is stored as the maximum
+    clipped = tmp_path / "clipped.cce"
+    clipped.write_bytes(content)
+    info = update_dataset(str(clipped), df_update, out_of_bounds="clip", quiet=True)
+    assert info['out of bounds'] == 1 and not info['requantized']
+    assert {key: header_of(clipped)[key] for key in bounds} == bounds
+    df_clipped = read_frame(clipped).set_index(['Latitude', 'Longitude', 'Year', 'Month'])['AverageTemperature']
+    row = df_update.iloc[0]
+    assert df_clipped[(row['Latitude'], row['Longitude'], 1980, row['Month'])] == pytest.approx(bounds['db_max_temp'], abs=1e-4)
+
+    # requantize: the whole file is rewritten with bounds containing the new temperature (one segment)
+    requantized = tmp_path / "requantized.cce"
+    requantized.write_bytes(content)
+    info = update_dataset(str(requantized), df_update, out_of_bounds="requantize", quiet=True)
+    assert info['out of bounds'] == 1 and info['requantized'] and info['appended temperatures'] == len(df_update)
+    header = header_of(requantized)
+    assert header['db_min_temp'] == bounds['db_min_temp'] and header['db_max_temp'] == pytest.approx(maximum + 10)
+    assert header['count_temperatures'] == len(df_first) + len(df_update)
+    assert read_segments(str(requantized), temperatures=False)['count_segments'] == 1
+    df_expected = merged_frame(pd.concat([df_first, df_update]))
+    df_requantized = read_frame(requantized).sort_values(['Latitude', 'Longitude', 'Year', 'Month'])
+    # discretized twice: once with the old, once with the new bounds
+    error = (bounds['db_max_temp'] - bounds['db_min_temp']) / (2**16 - 1) + (header['db_max_temp'] - header['db_min_temp']) / (2**16 - 1) + 1e-4
+    np.testing.assert_allclose(df_requantized['AverageTemperature'].to_numpy(), df_expected['AverageTemperature'].to_numpy(), rtol=0, atol=error)
+
+
+def test_interrupted_update(tmp_path):
+    _, df_first, df_update = split_frame()
+    path = tmp_path / "segmented.cce"
+    create_dataset(df_first, str(path), 2, "lzma", quiet=True)
+    content = path.read_bytes()
+    df_created = read_frame(path)
+
+    # an update interrupted before the header was rewritten: the segment is behind the counts of the header
+    interrupted = tmp_path / "interrupted.cce"
+    interrupted.write_bytes(content)
+    update_dataset(str(interrupted), df_update[df_update['Year'] >= 1975], quiet=True)
+    leftover = interrupted.read_bytes()[len(content):]
+    assert len(leftover) > 0
+    interrupted.write_bytes(content + leftover)
+    assert read_segments(str(interrupted), temperatures=False)['count_segments'] == 1
+    assert read_frame(interrupted).equals(df_created)
+
+    # the next update overwrites the leftover
+    update_dataset(str(path), df_update, quiet=True)
+    update_dataset(str(interrupted), df_update, quiet=True)
+    assert interrupted.read_bytes() == path.read_bytes()
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+from compress import compress_dataset
+from cce_reader import CCEReader
+from cce_server import AggregateIndex, QueryError
+
+# The aggregation of the service has to match the full scan of CCEReader for every kind of file
+
+
+@pytest.mark.parametrize("options", [
+    {},
+    {'compression': "lzma"},
+    {'quantization': "location"},
+    {'quantization': "ctilb"},
+    {'layout': "time"},
+    {'aggregates': ("prefix",)}
+], ids=["none", "lzma", "location", "ctilb", "time", "prefix"])
+def test_range_sums_match_scan(df_synthetic, tmp_path, options):
+    compress_dataset(df_synthetic, str(tmp_path), "test.cce", 2, quiet=True, report_memory=None, **options)
+    path = str(tmp_path / "test.cce")
+    index = AggregateIndex(path)
+    try:
+        assert index.prefix_step == (1 if options.get('aggregates') else 32)
+        with CCEReader(path) as db:
+            for first_month, last_month in [(0, db.count_months - 1), (5, 100), (37, 38), (200, 150)]:
+                for month in [None, 1, 7]:
+                    means, counts = db.aggregate_scan(first_month, last_month, month)
+                    sums, index_counts = index.range_sums(first_month, last_month, month)
+                    np.testing.assert_array_equal(index_counts, counts)
+                    with np.errstate(invalid='ignore', divide='ignore'):
+                        np.testing.assert_allclose(np.where(counts > 0, sums / counts, np.nan), means, rtol=1e-9, atol=1e-9)
+    finally:
+        index.close()
+
+
+def test_parse_month(df_synthetic, tmp_path):
+    compress_dataset(df_synthetic, str(tmp_path), "test.cce", 2, quiet=True, report_memory=None)
+    index = AggregateIndex(str(tmp_path / "test.cce"))
+    try:
+        assert index.parse_month("1951-01") == index.reader.month_index(1951, 1)
+        assert index.parse_month("12") == 12
+        for value in ["1950-13", "1950-00", "1950-x", "x"]:
+            with pytest.raises(QueryError):
+                index.parse_month(value)
+    finally:
+        index.close()
@@ -0,0 +1,96 @@
+import numpy as np
+import pandas as pd
+import pytest
+from compress import compress_dataset
+from cce_reader import CCEReader
+from cce_spatial import CURVE_BITS, hilbert_keys, morton_keys, location_ids, build_kdtree, kdtree_box_query
+
+# Curve orders, kd-tree and the round trip of files with reordered locations / KDTR section
+
+# Positions in the center of the cells of a side x side grid over the globe (aligned with the curve grid)
+def grid_positions(side):
+    cell = 2**CURVE_BITS // side
+    i, j = np.meshgrid(np.arange(side), np.arange(side), indexing='ij')
+    x, y = (i.ravel() * cell + cell // 2), (j.ravel() * cell + cell // 2)
+    longitudes = x / (2**CURVE_BITS - 1) * 360.0 - 180.0
+    latitudes = y / (2**CURVE_BITS - 1) * 180.0 - 90.0
+    return i.ravel(), j.ravel(), latitudes, longitudes
+
+
+def test_hilbert_neighbours():
+    i, j, latitudes, longitudes = grid_positions(64)
+    order = np.argsort(hilbert_keys(latitudes, longitudes))
+    assert len(np.unique(hilbert_keys(latitudes, longitudes))) == len(i)
+    # Consecutive cells on the Hilbert curve are always direct neighbours
+    steps = np.abs(np.diff(i[order])) + np.abs(np.diff(j[order]))
+    assert (steps == 1).all()
+
+
+def test_morton_interleaving():
+    i, j, latitudes, longitudes = grid_positions(64)
+    expected = np.zeros(len(i), dtype=np.int64)
+    for bit in range(6):
+        expected |= ((i >> bit) & 1) << (2 * bit) | ((j >> bit) & 1) << (2 * bit + 1)
+    np.testing.assert_array_equal(np.argsort(morton_keys(latitudes, longitudes)), np.argsort(expected))
+
+
+@pytest.mark.parametrize("order", ["latlon", "hilbert", "morton"])
+def test_location_ids_permutation(order):
+    rng = np.random.default_rng(0)
+    latitudes, longitudes = rng.uniform(-90, 90, 500).astype(np.float32), rng.uniform(-180, 180, 500).astype(np.float32)
+    ids = location_ids(latitudes, longitudes, order)
+    np.testing.assert_array_equal(np.sort(ids), np.arange(500))
+    if order == "latlon":
+        np.testing.assert_array_equal(ids[np.lexsort((longitudes, latitudes))], np.arange(500))
+
+
+@pytest.mark.parametrize("location_order", ["hilbert", "morton"])
+def test_location_order_round_trip(df_synthetic, tmp_path, location_order):
+    compress_dataset(df_synthetic, str(tmp_path), "latlon.cce", quiet=True, report_memory=None)
+    compress_dataset(df_synthetic, str(tmp_path), "curve.cce", location_order=location_order, quiet=True, report_memory=None)
+    with CCEReader(str(tmp_path / "latlon.cce")) as db:
+        df_latlon = db.to_dataframe()
+    with CCEReader(str(tmp_path / "curve.cce")) as db:
+        df_curve = db.to_dataframe()
+        latitudes, longitudes = db.locations['latitude'].astype(np.float32), db.locations['longitude'].astype(np.float32)
+        keys = (hilbert_keys if location_order == "hilbert" else morton_keys)(latitudes, longitudes)
+        assert (np.diff(keys) >= 0).all()
+    assert not np.array_equal(df_curve['locid'].to_numpy(), df_latlon['locid'].to_numpy())
+    columns = ['Latitude', 'Longitude', 'Year', 'Month', 'AverageTemperature']
+    df_latlon = df_latlon[columns].sort_values(columns[:4]).reset_index(drop=True)
+    df_curve = df_curve[columns].sort_values(columns[:4]).reset_index(drop=True)
+    pd.testing.assert_frame_equal(df_curve, df_latlon)
+
+
+def brute_force_box(latitudes, longitudes, lat_min, lat_max, lon_min, lon_max):
+    return np.flatnonzero((latitudes >= lat_min) & (latitudes <= lat_max) & (longitudes >= lon_min) & (longitudes <= lon_max))
+
+def random_boxes(rng, count):
+    for _ in range(count):
+        lat_min, lat_max = np.sort(rng.uniform(-90, 90, 2))
+        lon_min, lon_max = np.sort(rng.uniform(-180, 180, 2))
+        yield lat_min, lat_max, lon_min, lon_max
+
+
+@pytest.mark.parametrize("count", [0, 1, 2, 7, 1000])
+def test_kdtree_box_query(count):
+    rng = np.random.default_rng(count)
+    # Rounded positions, so there are ties on both axes
+    latitudes = np.round(rng.uniform(-90, 90, count), 0).astype(np.float32)
+    longitudes = np.round(rng.uniform(-180, 180, count), 0).astype(np.float32)
+    nodes = build_kdtree(latitudes, longitudes)
+    np.testing.assert_array_equal(np.sort(nodes['id']), np.arange(count))
+    boxes = list(random_boxes(rng, 50)) + [(-90, 90, -180, 180), (10, 10, 20, 20)]
+    if count:
+        boxes.append((latitudes[0], latitudes[0], longitudes[0], longitudes[0])) # exactly one position (inclusive bounds)
+    for box in boxes:
+        np.testing.assert_array_equal(kdtree_box_query(nodes, *box), brute_force_box(latitudes, longitudes, *box))
+
+
+def test_kdtree_file(df_synthetic, tmp_path):
+    compress_dataset(df_synthetic, str(tmp_path), "test.cce", kdtree=True, quiet=True, report_memory=None)
+    with CCEReader(str(tmp_path / "test.cce")) as db:
+        assert db.kdtree is not None
+        latitudes, longitudes = db.locations['latitude'].astype(np.float32), db.locations['longitude'].astype(np.float32)
+        for box in random_boxes(np.random.default_rng(0), 50):
+            np.testing.assert_array_equal(db.locations_in_box(*box), brute_force_box(latitudes, longitudes, *box))
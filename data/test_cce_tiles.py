@@ -0,0 +1,68 @@
+import json
+import numpy as np
+import pytest
+from compress import compress_dataset
+from cce_reader import CCEReader
+from cce_tiles import compress_tiled, TiledReader
+
+# compress_tiled has to write the same records as compress_dataset (only the location ids are ordered by tile) and
+# TiledReader only has to read the tiles of a box.
+
+columns = ['Latitude', 'Longitude', 'Year', 'Month']
+
+def sorted_frame(df):
+    return df.sort_values(columns).reset_index(drop=True)
+
+
+@pytest.mark.parametrize("compression", ["none", "lzma", "lzma_blocks"])
+def test_tiles_match_compress_dataset(df_synthetic, tmp_path, compression):
+    compress_dataset(df_synthetic, str(tmp_path), "reference.cce", 2, compression, block_size=4096, workers=1, quiet=True, report_memory=None)
+    with CCEReader(str(tmp_path / "reference.cce"), workers=1) as db:
+        df_expected = sorted_frame(db.to_dataframe())
+    manifest_path = compress_tiled(df_synthetic, str(tmp_path), tile_size=30.0, compression=compression, block_size=4096, workers=1, quiet=True)
+    with TiledReader(manifest_path, workers=1) as db:
+        assert len(db.tiles) > 1
+        df = db.to_dataframe(db.load_tiles(range(len(db.tiles))))
+        assert db.bytes_read == sum(tile['size'] for tile in db.tiles)
+    assert len(df) == db.manifest['count_temperatures'] == len(df_expected)
+    df = sorted_frame(df)
+    for column in columns + ['AverageTemperature']:
+        np.testing.assert_array_equal(df[column].to_numpy(), df_expected[column].to_numpy())
+    # the global ids are a permutation of the ids of compress_dataset
+    pairs = df[['locid']].assign(expected=df_expected['locid']).drop_duplicates()
+    assert len(pairs) == pairs['locid'].nunique() == pairs['expected'].nunique() == db.manifest['count_locations']
+
+    # every tile is a complete file
+    tile = db.tiles[1]
+    with open(manifest_path[:-len(".json")], "rb") as file:
+        file.seek(tile['offset'])
+        (tmp_path / "tile.cce").write_bytes(file.read(tile['size']))
+    with CCEReader(str(tmp_path / "tile.cce"), workers=1) as db_tile:
+        df_tile = db_tile.to_dataframe()
+    assert len(df_tile) == tile['count_temperatures'] and df_tile['locid'].nunique() == tile['count_locations']
+
+
+def test_load_box(df_synthetic, tmp_path):
+    manifest_path = compress_tiled(df_synthetic, str(tmp_path), tile_size=10.0, compression="lzma", workers=1, quiet=True)
+    with open(manifest_path) as file:
+        total = sum(tile['size'] for tile in json.load(file)['tiles'])
+    df_all = df_synthetic.dropna().drop_duplicates(['Latitude', 'Longitude']).astype({'Latitude': np.float32, 'Longitude': np.float32})
+    latitude, longitude = df_all['Latitude'].iloc[0], df_all['Longitude'].iloc[0]
+    box = (latitude - 15, latitude + 15, longitude - 25, longitude + 25)
+    inside = df_all[df_all['Latitude'].between(box[0], box[1]) & df_all['Longitude'].between(box[2], box[3])]
+    with TiledReader(manifest_path, workers=1) as db:
+        tiles = db.load_box(*box)
+        assert 0 < len(tiles) < len(db.tiles)
+        assert 0 < db.bytes_read < total
+        df = db.to_dataframe(tiles)
+        # loaded tiles are cached
+        bytes_read = db.bytes_read
+        db.load_box(*box)
+        assert db.bytes_read == bytes_read
+    loaded = set(zip(df['Latitude'], df['Longitude']))
+    assert len(inside) > 0 and set(zip(inside['Latitude'], inside['Longitude'])) <= loaded
+
+    # an empty box doesn't read anything
+    with TiledReader(manifest_path, workers=1) as db:
+        assert db.load_box(89, 90, 179, 180) == {} and db.bytes_read == 0
+        assert len(db.to_dataframe({})) == 0
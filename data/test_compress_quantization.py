@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+from compress import compress_dataset
+from cce_reader import CCEReader
+from conftest import merged_frame
+
+# With max_error the smallest byte-count meeting the error is chosen, the temperatures read back from the file
+# have to be inside the budget (measured like disError or disErrorUnc).
+
+def read_back(path):
+    with CCEReader(path) as db:
+        df = db.to_dataframe()
+    return df.sort_values(['Latitude', 'Longitude', 'Year', 'Month']).reset_index(drop=True)
+
+
+@pytest.mark.parametrize("low_memory", [False, True])
+@pytest.mark.parametrize("relative_to_uncertainty", [False, True])
+@pytest.mark.parametrize("max_error", [0.2, 0.05, 0.001])
+@pytest.mark.parametrize("quantization", ["global", "location", "ctilb"])
+def test_max_error(df_synthetic, tmp_path, quantization, max_error, relative_to_uncertainty, low_memory):
+    _, report = compress_dataset(df_synthetic, str(tmp_path), "test.cce", quantization=quantization, max_error=max_error, max_error_relative_to_uncertainty=relative_to_uncertainty, low_memory=low_memory, quiet=True, report_memory=None, return_report=True)
+    df_expected = merged_frame(df_synthetic)
+    df = read_back(str(tmp_path / "test.cce"))
+    errors = np.abs(df['AverageTemperature'].to_numpy() - df_expected['AverageTemperature'].to_numpy())
+    if relative_to_uncertainty:
+        errors = np.maximum(errors - df_expected['AverageTemperatureUncertainty'].to_numpy(), 0.0)
+    assert errors.max() <= max_error
+    statistic = 'Discretization error with Uncertainty' if relative_to_uncertainty else 'Discretization error'
+    assert report.info['discretization error'][statistic]['max'] <= max_error
+
+    # The next smaller byte-count would have missed the budget
+    bc_temperature = report.info['bc_temperature']
+    with CCEReader(str(tmp_path / "test.cce")) as db:
+        assert db.header['bc_temperature'] == bc_temperature
+        assert db.quantization_group == (None if quantization == "global" else quantization)
+    if bc_temperature > 1:
+        compress_dataset(df_synthetic, str(tmp_path), "smaller.cce", bc_temperature // 2, quantization=quantization, quiet=True, report_memory=None)
+        errors = np.abs(read_back(str(tmp_path / "smaller.cce"))['AverageTemperature'].to_numpy() - df_expected['AverageTemperature'].to_numpy())
+        if relative_to_uncertainty:
+            errors = np.maximum(errors - df_expected['AverageTemperatureUncertainty'].to_numpy(), 0.0)
+        assert errors.max() > max_error
+
+
+def test_max_error_unreachable(df_synthetic, tmp_path):
+    with pytest.raises(Exception, match="max_error"):
+        compress_dataset(df_synthetic, str(tmp_path), "test.cce", max_error=1e-9, quiet=True, report_memory=None)
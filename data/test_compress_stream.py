@@ -0,0 +1,41 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from compress import compress_dataset
+from compress_stream import compress_dataset_streaming
+
+# compress_dataset_streaming has to write the same file as compress_dataset, also if duplicates of a
+# (location, year, month) end up in different chunks/runs.
+
+# The synthetic frame with some rows repeated up to three more times (with other temperatures)
+def frame_with_duplicates(df_data, seed = 1):
+    rng = np.random.default_rng(seed)
+    copies = [df_data]
+    for _ in range(3):
+        df = df_data.sample(frac=0.05, random_state=rng.integers(2**31)).copy()
+        df['AverageTemperature'] += rng.normal(0, 1, len(df))
+        copies.append(df)
+    return pd.concat(copies, ignore_index=True).sample(frac=1, random_state=seed).reset_index(drop=True)
+
+def chunks(df, chunksize):
+    for start in range(0, len(df), chunksize):
+        yield df.iloc[start:start + chunksize]
+
+
+@pytest.mark.parametrize("compression", ["none", "lzma"])
+@pytest.mark.parametrize("discretizeresolution", [1, 2, 4])
+def test_streaming_matches_compress_dataset(df_synthetic, tmp_path, discretizeresolution, compression):
+    df = frame_with_duplicates(df_synthetic)
+    assert df.dropna().groupby(['Latitude', 'Longitude', 'Year', 'Month']).size().max() >= 3
+    compress_dataset(df, str(tmp_path), "reference.cce", discretizeresolution, compression, quiet=True, report_memory=None)
+    compress_dataset_streaming(chunks(df, 5000), str(tmp_path), "stream.cce", discretizeresolution, compression, chunksize=5000, temp_dir=str(tmp_path), quiet=True, report_memory=None)
+    assert (tmp_path / "stream.cce").read_bytes() == (tmp_path / "reference.cce").read_bytes()
+
+
+def test_streaming_quiet_report(df_synthetic, tmp_path, capsys):
+    filepath, report = compress_dataset_streaming(chunks(df_synthetic, 5000), str(tmp_path), "stream.cce", chunksize=5000, temp_dir=str(tmp_path), quiet=True, report_memory=None, return_report=True)
+    captured = capsys.readouterr()
+    assert captured.out == "" and captured.err == ""
+    assert [stage['stage'][:6] for stage in report.stages] == ["STEP 1", "STEP 2", "STEP 3", "STEP 5"]
+    assert sum(section['bytes'] for section in report.sections) == report.info['file size'] == os.path.getsize(filepath)
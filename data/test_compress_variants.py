@@ -0,0 +1,102 @@
+import json
+import os
+import numpy as np
+import pytest
+import compress_variants
+from compress import compress_dataset
+from cce_reader import CCEReader
+from compress_variants import build_variants, load_prepared, thin_rows, variant_filename, DB_FILES_NAME
+from conftest import merged_frame
+
+# build_variants has to write the same files as compress_dataset out of the cached preprocessing, thinned variants
+# keep the location with the most temperatures of every grid cell.
+
+variants = [
+    {'name': "Original", 'discretizeresolution': 2, 'compression': "lzma"},
+    {'name': "Original (1 byte)", 'discretizeresolution': 1, 'compression': "none"},
+    {'name': "Preview", 'discretizeresolution': 1, 'compression': "lzma", 'thinning': 30.0}
+]
+
+def cell_of(latitudes, longitudes, cell_size):
+    return np.floor((latitudes.astype(np.float64) + 90) / cell_size).astype(np.int64), np.floor((longitudes.astype(np.float64) + 180) / cell_size).astype(np.int64)
+
+
+@pytest.mark.parametrize("workers", [0, 1])
+def test_variants_match_compress_dataset(df_synthetic, tmp_path, workers):
+    output, cache_dir = tmp_path / "output", tmp_path / "cache"
+    output.mkdir()
+    db_files = build_variants(df_synthetic, str(output), variants, str(cache_dir), workers=workers, quiet=True)
+    assert [entry['filename'] for entry in db_files] == ["Original.cce", "Original_1_byte.cce", "Preview.cce"]
+    with open(output / DB_FILES_NAME) as file:
+        assert json.load(file) == db_files
+    for variant in variants[:2]:
+        filename = variant_filename(variant)
+        compress_dataset(df_synthetic, str(tmp_path), filename, variant['discretizeresolution'], variant['compression'], workers=1, quiet=True, report_memory=None)
+        assert (output / filename).read_bytes() == (tmp_path / filename).read_bytes()
+        assert db_files[variants.index(variant)]['temperatures'] == len(merged_frame(df_synthetic))
+
+
+def test_cache_reused(df_synthetic, tmp_path, monkeypatch):
+    output, cache_dir = tmp_path / "output", tmp_path / "cache"
+    output.mkdir()
+    build_variants(df_synthetic, str(output), variants[:1], str(cache_dir), workers=0, quiet=True)
+    assert len(os.listdir(cache_dir)) == 1 and os.listdir(cache_dir)[0].endswith(".npz")
+    content = (output / "Original.cce").read_bytes()
+
+    # the second run (also with other variants) doesn't prepare the rows again
+    def prepare_rows(*args, **kwargs):
+        raise AssertionError("The rows should come out of the cache")
+    monkeypatch.setattr(compress_variants, "prepare_rows", prepare_rows)
+    build_variants(df_synthetic, str(output), variants, str(cache_dir), workers=0, quiet=True)
+    assert (output / "Original.cce").read_bytes() == content
+    assert len(os.listdir(cache_dir)) == 1
+
+    # other preprocessing options or another input don't use the cached rows
+    monkeypatch.undo()
+    build_variants(df_synthetic, str(output), variants[:1], str(cache_dir), workers=0, years=(1955, 1964), quiet=True)
+    build_variants(df_synthetic.iloc[1:], str(output), variants[:1], str(cache_dir), workers=0, quiet=True)
+    assert len(os.listdir(cache_dir)) == 3
+
+
+def test_thin_rows(df_synthetic, tmp_path):
+    rows, _ = load_prepared(df_synthetic, str(tmp_path / "cache"))
+    counts = np.diff(np.r_[rows['location_starts'], len(rows['locids'])])
+    thinned = thin_rows(rows, 30.0)
+    thinned_counts = np.diff(np.r_[thinned['location_starts'], len(thinned['locids'])])
+
+    # one location per occupied cell, the one with the most temperatures
+    cells = list(zip(*cell_of(rows['latitudes'], rows['longitudes'], 30.0)))
+    thinned_cells = list(zip(*cell_of(thinned['latitudes'], thinned['longitudes'], 30.0)))
+    assert len(thinned_cells) == len(set(thinned_cells)) == len(set(cells)) < len(cells)
+    for cell, count in zip(thinned_cells, thinned_counts):
+        assert count == max(c for other, c in zip(cells, counts) if other == cell)
+
+    # the kept locations keep all their records
+    keys = list(zip(rows['latitudes'], rows['longitudes']))
+    for location, (latitude, longitude) in enumerate(zip(thinned['latitudes'], thinned['longitudes'])):
+        original = keys.index((latitude, longitude))
+        mask = rows['locids'] == original
+        thinned_mask = thinned['locids'] == location
+        np.testing.assert_array_equal(thinned['temperatures'][thinned_mask], rows['temperatures'][mask])
+        np.testing.assert_array_equal(thinned['years'][thinned_mask], rows['years'][mask])
+        np.testing.assert_array_equal(thinned['months'][thinned_mask], rows['months'][mask])
+
+    # the thinned variant is the file of the thinned rows
+    output = tmp_path / "output"
+    output.mkdir()
+    build_variants(df_synthetic, str(output), variants[2:], str(tmp_path / "cache"), workers=0, quiet=True)
+    with CCEReader(str(output / "Preview.cce"), workers=1) as db:
+        assert db.header['count_locations'] == len(thinned_cells)
+        assert db.header['count_temperatures'] == len(thinned['locids'])
+
+
+def test_invalid_variants(df_synthetic, tmp_path):
+    with pytest.raises(Exception, match="have to be unique \\(A_B.cce\\)"):
+        build_variants(df_synthetic, str(tmp_path), [{'name': "A B"}, {'name': "A_B"}], str(tmp_path / "cache"), workers=0, quiet=True)
+    with pytest.raises(Exception, match="have to be unique \\(same.cce\\)"):
+        build_variants(df_synthetic, str(tmp_path), [{'name': "A", 'filename': "same.cce"}, {'name': "B", 'filename': "same.cce"}], str(tmp_path / "cache"), workers=0, quiet=True)
+    with pytest.raises(Exception, match="apply to all variants"):
+        build_variants(df_synthetic, str(tmp_path), [{'name': "A", 'years': (1950, 1960)}], str(tmp_path / "cache"), workers=0, quiet=True)
+    with pytest.raises(Exception, match="needs a name"):
+        build_variants(df_synthetic, str(tmp_path), [{'compression': "lzma"}], str(tmp_path / "cache"), workers=0, quiet=True)
+    assert not (tmp_path / "cache").exists()
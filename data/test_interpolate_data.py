@@ -0,0 +1,110 @@
+import numpy as np
+import pandas as pd
+import pytest
+import interpolate_data
+from interpolate_data import fill_nans, fill_nans_grouped, compare_engines, main, main_sharded
+
+# The vectorized regression has to fill the same values as the sklearn one, and the sharded execution has to
+# write the same rows in the same order as main.
+
+# Frame in the layout of GlobalLandTemperaturesByCity.csv: NaN gaps, one location/month group which only consists
+# of NaNs, one group with a single known value and (with shared_cities) several locations with the same city name
+def berkeley_frame(count_locations = 12, first_year = 1900, last_year = 1939, shared_cities = False, seed = 0):
+    rng = np.random.default_rng(seed)
+    latitudes = np.round(rng.uniform(-60, 70, count_locations), 2)
+    longitudes = np.round(rng.uniform(-180, 180, count_locations), 2)
+    locids = np.repeat(np.arange(count_locations), (last_year - first_year + 1) * 12)
+    dms = np.tile(np.arange((last_year - first_year + 1) * 12), count_locations)
+    temperatures = 10 + 10 * np.sin(2 * np.pi * (dms % 12) / 12) + dms / 120 + rng.normal(0, 1, len(dms))
+    temperatures[rng.random(len(dms)) < 0.1] = np.nan
+    temperatures[(locids == 0) & (dms % 12 == 2)] = np.nan      # all-NaN group
+    single = np.flatnonzero((locids == 1) & (dms % 12 == 4))
+    temperatures[single[1:]] = np.nan                           # group with one known value
+    cities = np.array([f"City{i // 3 if shared_cities else i:02d}" for i in range(count_locations)], dtype=object)
+    df = pd.DataFrame({
+        'dt': [f"{first_year + dm // 12}-{dm % 12 + 1:02d}-01" for dm in dms],
+        'AverageTemperature': temperatures,
+        'AverageTemperatureUncertainty': rng.uniform(0.1, 2.0, len(dms)),
+        'City': cities[locids],
+        'Country': "Country",
+        'Latitude': [f"{abs(lat):.2f}{'N' if lat >= 0 else 'S'}" for lat in latitudes[locids]],
+        'Longitude': [f"{abs(lon):.2f}{'E' if lon >= 0 else 'W'}" for lon in longitudes[locids]]
+    })
+    return df.sample(frac=1, random_state=seed).reset_index(drop=True)
+
+def fill_nans_sklearn(df):
+    # The same call as main with engine="sklearn"
+    return df.groupby([df['dt'].dt.month, 'Latitude', 'Longitude'], sort=False, group_keys=True).apply(fill_nans).reset_index(drop=True)
+
+def prepared_frame(df):
+    df = df.assign(dt=pd.to_datetime(df['dt']))
+    df['src'] = 0
+    return df
+
+
+@pytest.mark.filterwarnings("ignore:DataFrameGroupBy.apply operated on the grouping columns")
+def test_fill_nans_grouped_matches_sklearn():
+    df = prepared_frame(berkeley_frame())
+    df_sklearn = fill_nans_sklearn(df.copy())
+    df_grouped = fill_nans_grouped(df)
+    pd.testing.assert_frame_equal(df_grouped, df_sklearn, check_exact=False, atol=1e-9, rtol=0)
+    # The all-NaN groups are dropped, all other NaNs are filled and marked as interpolated
+    all_nan = df['AverageTemperature'].isna().groupby([df['dt'].dt.month, df['Latitude'], df['Longitude']]).transform('all')
+    assert all_nan.any()
+    assert len(df_grouped) == len(df) - all_nan.sum()
+    assert not df_grouped['AverageTemperature'].isna().any()
+    assert df_grouped['src'].sum() == (df['AverageTemperature'].isna() & ~all_nan).sum()
+    compare_engines(df) # --check
+
+# Runs main or main_sharded on the frame (written as csv or parquet store into its own directory) and returns the
+# output (bytes of the csv or frame of the store)
+def run_main(tmp_path, monkeypatch, df, sharded, output_format = "csv", from_store = False, engine = "grouped", **kwargs):
+    directory = tmp_path / ("sharded" if sharded else "main")
+    directory.mkdir()
+    if from_store:
+        source = directory / "input"
+        interpolate_data.write_store(df, source)
+    else:
+        source = directory / "input.csv"
+        df.to_csv(source, index=False)
+    monkeypatch.setattr(interpolate_data, "input_filepath", str(source))
+    if sharded:
+        main_sharded(engine=engine, output_format=output_format, **kwargs)
+    else:
+        main(engine=engine, output_format=output_format)
+    dest_path = interpolate_data.get_dest_path(source, output_format)
+    if output_format == "csv":
+        return dest_path.read_bytes()
+    return interpolate_data.read_store(dest_path)
+
+
+@pytest.mark.parametrize("workers, shards", [(1, 1), (2, 3)])
+def test_main_sharded_matches_main(tmp_path, monkeypatch, workers, shards):
+    df = berkeley_frame()
+    output = run_main(tmp_path, monkeypatch, df, False)
+    output_sharded = run_main(tmp_path, monkeypatch, df, True, workers=workers, shards=shards)
+    assert output_sharded == output
+
+
+@pytest.mark.parametrize("from_store", [False, True], ids=["csv", "store"])
+@pytest.mark.parametrize("output_format", ["csv", "parquet"])
+def test_main_sharded_store(tmp_path, monkeypatch, output_format, from_store):
+    df = berkeley_frame(seed=1)
+    output = run_main(tmp_path, monkeypatch, df, False, output_format, from_store)
+    output_sharded = run_main(tmp_path, monkeypatch, df, True, output_format, from_store, workers=2, shards=4)
+    if output_format == "csv":
+        assert output_sharded == output
+    else:
+        pd.testing.assert_frame_equal(output_sharded, output)
+
+
+# Rows with the same City and dt are in shard order (main sorts unstable), the sorted rows have to be equal
+@pytest.mark.filterwarnings("ignore:DataFrameGroupBy.apply operated on the grouping columns")
+@pytest.mark.parametrize("engine", ["grouped", "sklearn"])
+def test_main_sharded_shared_cities(tmp_path, monkeypatch, engine):
+    df = berkeley_frame(shared_cities=True, seed=2)
+    output = run_main(tmp_path, monkeypatch, df, False, "parquet", engine=engine)
+    output_sharded = run_main(tmp_path, monkeypatch, df, True, "parquet", engine=engine, workers=2, shards=3)
+    columns = ['City', 'Year', 'Month', 'Latitude', 'Longitude']
+    assert output_sharded['City'].tolist() == output['City'].tolist()
+    pd.testing.assert_frame_equal(output_sharded.sort_values(columns).reset_index(drop=True), output.sort_values(columns).reset_index(drop=True))
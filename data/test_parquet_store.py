@@ -0,0 +1,22 @@
+from compress import compress_dataset
+from parquet_store import write_store, read_store
+
+# A store written from a frame has to compress to the same file as the frame itself
+
+
+def test_compress_store_without_uncertainty(df_synthetic, tmp_path):
+    df = df_synthetic.drop(columns=['AverageTemperatureUncertainty']).drop_duplicates(['Latitude', 'Longitude', 'Year', 'Month'])
+    write_store(df, str(tmp_path / "store"))
+    assert (read_store(str(tmp_path / "store"))['AverageTemperatureUncertainty'] == 0.0).all()
+    for low_memory in [False, True]:
+        compress_dataset(df, str(tmp_path), "frame.cce", quiet=True, report_memory=None, low_memory=low_memory)
+        compress_dataset(str(tmp_path / "store"), str(tmp_path), "store.cce", quiet=True, report_memory=None, low_memory=low_memory)
+        assert (tmp_path / "store.cce").read_bytes() == (tmp_path / "frame.cce").read_bytes()
+
+
+def test_compress_store_years(df_synthetic, tmp_path):
+    df = df_synthetic.drop_duplicates(['Latitude', 'Longitude', 'Year', 'Month'])
+    write_store(df, str(tmp_path / "store"))
+    compress_dataset(df, str(tmp_path), "frame.cce", quiet=True, report_memory=None, years=(1955, 1964))
+    compress_dataset(str(tmp_path / "store"), str(tmp_path), "store.cce", quiet=True, report_memory=None, years=(1955, 1964))
+    assert (tmp_path / "store.cce").read_bytes() == (tmp_path / "frame.cce").read_bytes()
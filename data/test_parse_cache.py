@@ -0,0 +1,93 @@
+import os
+import pandas as pd
+import pytest
+from parse_cache import ParseCache
+
+# Only keys with added, changed or removed source files may get parsed again
+
+
+def write_source(directory, key, values):
+    path = os.path.join(directory, f"{key}.txt")
+    with open(path, "w") as file:
+        file.write("\n".join(str(value) for value in values))
+    return path
+
+def read_source(path):
+    with open(path) as file:
+        return [float(line) for line in file.read().split()]
+
+# Module level, so it can be used with the process pool
+def parse_key(key):
+    directory, name = os.path.split(key)
+    values = read_source(os.path.join(directory, f"{name}.txt"))
+    return pd.DataFrame({'key': name, 'value': values}) if values else None
+
+
+class RecordingParser:
+    def __init__(self):
+        self.keys = []
+
+    def __call__(self, key):
+        self.keys.append(os.path.basename(key))
+        return parse_key(key)
+
+
+@pytest.fixture
+def sources(tmp_path):
+    directory = tmp_path / "sources"
+    directory.mkdir()
+    return {str(directory / name): [write_source(str(directory), name, values)] for name, values in [("a", [1, 2]), ("b", [3]), ("c", [4, 5, 6]), ("empty", [])]}
+
+
+def load(cache_dir, sources, version = "1"):
+    parser = RecordingParser()
+    df = ParseCache(str(cache_dir), version=version).load(sources, parser, workers=0)
+    return df, sorted(parser.keys)
+
+
+def test_only_changed_keys_get_parsed(tmp_path, sources):
+    cache_dir = tmp_path / "cache"
+    df, parsed = load(cache_dir, sources)
+    assert parsed == ["a", "b", "c", "empty"]
+    assert df['value'].tolist() == [1, 2, 3, 4, 5, 6]
+
+    # Unchanged
+    df_cached, parsed = load(cache_dir, sources)
+    assert parsed == []
+    pd.testing.assert_frame_equal(df_cached, df)
+
+    # Touched only (new mtime, same content)
+    path_a = sources[next(key for key in sources if key.endswith("a"))][0]
+    stat = os.stat(path_a)
+    os.utime(path_a, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    df_cached, parsed = load(cache_dir, sources)
+    assert parsed == []
+    pd.testing.assert_frame_equal(df_cached, df)
+
+    # Edited
+    path_b = sources[next(key for key in sources if key.endswith("b"))][0]
+    write_source(os.path.dirname(path_b), "b", [30, 31])
+    df_edited, parsed = load(cache_dir, sources)
+    assert parsed == ["b"]
+    assert df_edited['value'].tolist() == [1, 2, 30, 31, 4, 5, 6]
+
+    # Added and removed keys
+    directory = os.path.dirname(path_a)
+    sources = {key: paths for key, paths in sources.items() if not key.endswith("c")}
+    sources[os.path.join(directory, "d")] = [write_source(directory, "d", [7])]
+    df_changed, parsed = load(cache_dir, sources)
+    assert parsed == ["d"]
+    assert df_changed['value'].tolist() == [1, 2, 30, 31, 7]
+    assert len([name for name in os.listdir(cache_dir) if name.endswith(".parquet")]) == 3
+
+    # New version of the parser
+    _, parsed = load(cache_dir, sources, version="2")
+    assert parsed == ["a", "b", "d", "empty"]
+
+
+def test_process_pool(tmp_path, sources):
+    df = ParseCache(str(tmp_path / "cache")).load(sources, parse_key, workers=1)
+    df_cached, parsed = load(tmp_path / "cache", sources, version="")
+    assert parsed == []
+    pd.testing.assert_frame_equal(df_cached, df)
+    assert df['value'].tolist() == [1, 2, 3, 4, 5, 6]
@@ -20,4 +20,35 @@ def df_print_rows(df, rowCount):
         display(df.head(1500)) #need display to show the dataframe when using with in jupyter
 
 def formatUIntNumber(n):
-    return f"{math.floor(n / 1000000)}M" if n > 1000000 else f"{math.floor(n / 1000)}k" if n > 1000 else f"{math.floor(n)}"
\ No newline at end of file
+    return f"{math.floor(n / 1000000)}M" if n > 1000000 else f"{math.floor(n / 1000)}k" if n > 1000 else f"{math.floor(n)}"
+
+# Accumulates count, mean, standard deviation, min and max of a value stream batch by batch
+# (parallel variant of Welford's algorithm), so statistics don't require all values in memory
+class RunningStats:
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def update(self, values):
+        n = len(values)
+        if n == 0:
+            return
+        values = values.astype("float64")
+        batch_mean = values.mean()
+        batch_m2 = ((values - batch_mean) ** 2).sum()
+        delta = batch_mean - self.mean
+        total = self.count + n
+        self.mean += delta * n / total
+        self.m2 += batch_m2 + delta ** 2 * self.count * n / total
+        self.count = total
+        self.min = min(self.min, values.min().item())
+        self.max = max(self.max, values.max().item())
+
+    def std(self):
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else math.nan
+
+    def describe(self):
+        return pd.Series({"count": self.count, "mean": self.mean, "std": self.std(), "min": self.min, "max": self.max})
@@ -8,9 +8,18 @@ import * as renderer from './renderer';
 
 enum compression_methods {
     none = 0,
-    lzma = 1
+    lzma = 1,
+    lzma_blocks = 2,
+    lz4 = 3,
+    zstd = 4,
+    zstd_blocks = 5
 }
 
+// The viewer can only decode uncompressed and LZMA files, the block-wise codecs, lz4 and zstd are written by
+// data/compress.py but have no decode path here
+const decodable_compression_methods = [compression_methods.none, compression_methods.lzma];
+const HEADER_SIZE = 32;
+
 export interface Database {
     header: DatabaseHeader,
     buffer: DatabaseBuffer,
@@ -169,6 +178,7 @@ const fetchAndUnpackDatabase = async (): Promise<Database> => {
     let binData = await downloadData(url);
     ui.loadingDialogAddHistory(`Fetched dataset [${formatFileSize(binData.byteLength)}; ${formatMilliseconds(performance.now() - bufferTime)}]`);
     ui.loadingDialogProgress(-1);
+    checkCompression(binData);
 
 
     /// LZMA Decompression
@@ -187,6 +197,18 @@ const fetchAndUnpackDatabase = async (): Promise<Database> => {
     return db;
 }
 
+// Rejects files whose payload was compressed with a method the viewer can't decode (file_compression is the last
+// byte of the header). Files without the CCE identification (e.g. whole-file LZMA) are left to the decoders.
+const checkCompression = (data: Uint8Array) => {
+    if (data.byteLength < HEADER_SIZE || String.fromCharCode(data[0], data[1], data[2]) != "CCE") {
+        return;
+    }
+    let file_compression = data[HEADER_SIZE - 1];
+    if (decodable_compression_methods.indexOf(file_compression) == -1) {
+        throw `Unsupported compression (${compression_methods[file_compression] ?? file_compression}), only "none" and "lzma" files can be read`;
+    }
+}
+
 const downloadData = (url: string): Promise<Uint8Array> => {
     return new Promise<Uint8Array>(function(resolve, reject) {
         let oReq = new XMLHttpRequest();